@@ -0,0 +1,168 @@
+"""
+Benchmark of the non-stream aggregation path on recorded-like multi-KB responses,
+against the original decode-every-frame / string concatenation implementation.
+Fails when the fast path is slower or its peak memory is above the original's. The claude path may hold its
+merged chunks next to the joined answer: TextBuffer joins them once at the end, where the original grew a single
+string in place, which is linear only as long as CPython can resize it without copying.
+
+    python benchmark/bench_aggregation.py [answer_chars]
+"""
+import sys
+import json
+import time
+import asyncio
+import tracemalloc
+from typing import Any
+
+sys.path.append(".")
+sys.path.append("..")
+from openai.types import Completion, CompletionChoice
+from openai.types.chat import ChatCompletion
+from openai.types.chat.chat_completion import Choice as ChatChoice
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from src.reverse.aggregator import TextBuffer
+from src.reverse.base_reverse import RequestContext
+from src.reverse.chatgpt_reverse import ChatGPTReverse
+from src.reverse.claude_reverse import ClaudeReverse
+
+
+class NewCompletionChoice(CompletionChoice):
+    # the choice of the original implementation, finish_reason may be None
+    finish_reason: Any = None
+
+
+SENTENCE = "Performance matters when answers get long, 长回答也一样. "
+
+
+def answer(size: int) -> str:
+    return (SENTENCE * (size // len(SENTENCE) + 1))[:size]
+
+
+def chatgpt_frames(text: str, step: int = 8) -> list:
+    frames = []
+    for end in list(range(step, len(text), step)) + [len(text)]:
+        status = 'finished_successfully' if end == len(text) else 'in_progress'
+        data = {"message": {"id": "m", "author": {"role": "assistant"}, "create_time": 1.0,
+                            "content": {"content_type": "text", "parts": [text[:end]]}, "status": status,
+                            "metadata": {"model_slug": "text-davinci-002-render-sha"}},
+                "conversation_id": "c", "error": None}
+        frames.append(b"data: " + json.dumps(data).encode('utf-8'))
+        frames.append(b"")
+    frames.append(b"data: [DONE]")
+    return frames
+
+
+def claude_frames(text: str, step: int = 4) -> list:
+    frames = []
+    for start in range(0, len(text), step):
+        stop = "stop_sequence" if start + step >= len(text) else None
+        data = {"type": "completion", "id": "chatcompl_01", "completion": text[start:start + step],
+                "stop_reason": stop, "model": "claude-2.1", "stop": None, "log_id": "log"}
+        frames.append(b"event: completion")
+        frames.append(b"data: " + json.dumps(data).encode('utf-8'))
+        frames.append(b"")
+    return frames
+
+
+async def legacy_chatgpt(chunks):
+    async for chunk in chunks:
+        if not chunk or chunk == b'data: [DONE]':
+            continue
+        json_data = json.loads(chunk[len("data:"):])
+        if json_data['message']['author']['role'] != "assistant":
+            continue
+        if json_data['message']['status'] == 'finished_successfully':
+            choices = [ChatChoice(index=i, message=ChatCompletionMessage(role='assistant', content=p),
+                                  finish_reason='stop')
+                       for i, p in enumerate(json_data['message']['content']['parts'])]
+            return ChatCompletion(id='c', created=int(time.time()), choices=choices, model='gpt-3.5-turbo',
+                                  object='chat.completion').model_dump(exclude_unset=True)
+
+
+async def legacy_claude(chunks):
+    c_id = None
+    model = None
+    message = ""
+    async for chunk in chunks:
+        if not chunk or not chunk.decode('utf-8').startswith('data:'):
+            continue
+        json_data = json.loads(chunk[len("data:"):])
+        if json_data['type'] != 'completion':
+            continue
+        c_id = c_id or json_data['id']
+        model = model or json_data['model']
+        message = message + json_data['completion']
+    choice = NewCompletionChoice(index=0, text=message, finish_reason='stop')
+    return Completion(id=c_id, created=int(time.time()), choices=[choice], model=model,
+                      object='text_completion').model_dump(exclude_unset=True)
+
+
+def chunk_bytes(frames) -> int:
+    # the merged chunks a TextBuffer holds for the claude frames when it joins them
+    buffer = TextBuffer()
+    for frame in frames:
+        if frame.startswith(b'data:'):
+            buffer.append(json.loads(frame[5:])['completion'])
+    buffer.chunks.append(''.join(buffer.pieces))
+    return sys.getsizeof(buffer.chunks) + sum(sys.getsizeof(chunk) for chunk in buffer.chunks)
+
+
+async def iterate(frames):
+    for frame in frames:
+        yield frame
+
+
+def aggregate(reverse, is_chat: bool = False):
+    async def collect(chunks):
+        result = await reverse.collect(RequestContext(headers={}, proxy={}), chunks)
+        return result.to_dict(is_chat)
+    return collect
+
+
+def run(func, frames, rounds: int = 3):
+    best = float('inf')
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = asyncio.run(func(iterate(frames)))
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    asyncio.run(func(iterate(frames)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def report(label: str, legacy, fast, frames, allowance: int = 0):
+    # allowance: bytes the fast path may hold at its peak on top of the original's
+    legacy_result, legacy_time, legacy_peak = run(legacy, frames)
+    fast_result, fast_time, fast_peak = run(fast, frames)
+    if legacy_result['choices'] != fast_result['choices']:
+        raise SystemExit(f"{label}: aggregated result differs from the original implementation")
+    size = sum(len(f) for f in frames)
+    print(f"{label}: {len(frames)} lines, {size / 1024:.0f} KiB upstream")
+    print(f"  legacy {legacy_time * 1000:9.2f} ms  peak {legacy_peak / 1024:8.0f} KiB")
+    print(f"  fast   {fast_time * 1000:9.2f} ms  peak {fast_peak / 1024:8.0f} KiB")
+    print(f"  speedup x{legacy_time / fast_time:.1f}, peak memory x{legacy_peak / max(fast_peak, 1):.1f}")
+    if allowance:
+        print(f"  allowed peak {(legacy_peak + allowance) / 1024:.0f} KiB (original + {allowance / 1024:.0f} KiB)")
+    if fast_peak > legacy_peak + allowance:
+        raise SystemExit(f"{label}: peak memory above the original implementation")
+    if fast_time > legacy_time:
+        raise SystemExit(f"{label}: slower than the original implementation")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 16384
+    text = answer(size)
+    # the aggregation methods don't touch any instance state, so the backends are not constructed
+    chatgpt = ChatGPTReverse.__new__(ChatGPTReverse)
+    claude = ClaudeReverse.__new__(ClaudeReverse)
+    report('chatgpt chat', legacy_chatgpt, aggregate(chatgpt, is_chat=True), chatgpt_frames(text))
+    frames = claude_frames(text)
+    report('claude completion', legacy_claude, aggregate(claude), frames, allowance=chunk_bytes(frames))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Converter throughput on recorded upstream streams, offline and without any timing of the upstream.
+
+Record streams by running the proxy with UPSTREAM_RECORD_PATH set, e.g. against the fake upstream:
+
+    python benchmark/load_test.py --concurrency 8 --requests 100 --env UPSTREAM_RECORD_PATH=.cache/upstream.rec
+    python benchmark/bench_replay.py .cache/upstream.rec --rounds 3
+
+For end-to-end latency, serve the recording to the load test through the replay backends instead:
+
+    python benchmark/load_test.py --env UPSTREAM_REPLAY_PATH=.cache/upstream.rec --env UPSTREAM_REPLAY_SPEED=1 \\
+        --env 'MODEL_ROUTES={"claude*": ["claude-replay"], "*": ["chatgpt-replay"]}'
+"""
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.append(".")
+sys.path.append("..")
+from src.reverse.base_reverse import RequestContext, encode_stream
+from src.reverse.chatgpt_reverse import ChatGPTReverse
+from src.reverse.claude_reverse import ClaudeReverse
+from src.reverse.recording import Recording
+
+BACKENDS = {'chatgpt': ChatGPTReverse, 'claude': ClaudeReverse}
+
+
+async def lines(recording: Recording, stream):
+    for _, begin, end in stream.lines:
+        yield recording.line(begin, end)
+
+
+async def convert_stream(reverse, recording: Recording, stream) -> int:
+    # upstream lines to the bytes of the openai stream, as iter_frames and encode_stream do
+    ctx = RequestContext(headers={}, proxy={})
+
+    async def frames():
+        async for choices in reverse.iter_deltas(ctx, lines(recording, stream)):
+            yield ctx.completion_id, ctx.model, choices
+
+    size = 0
+    async for data in encode_stream(frames(), is_chat=True):
+        size += len(data)
+    return size
+
+
+async def convert_result(reverse, recording: Recording, stream) -> int:
+    result = await reverse.collect(RequestContext(headers={}, proxy={}), lines(recording, stream))
+    return len(str(result.to_dict(is_chat=True))) if result else 0
+
+
+def run(convert, reverse, recording: Recording, streams: list, rounds: int) -> float:
+    async def once():
+        for stream in streams:
+            await convert(reverse, recording, stream)
+
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        asyncio.run(once())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='file written with UPSTREAM_RECORD_PATH')
+    parser.add_argument('--rounds', type=int, default=3, help='runs per converter, the fastest is kept')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    recording = Recording(args.recording)
+    print(f"{args.recording}: {len(recording.streams)} complete streams, {recording.incomplete} incomplete")
+    for backend, reverse_class in BACKENDS.items():
+        streams = [stream for stream in recording.streams if stream.backend == backend]
+        if not streams:
+            continue
+        # the converters don't touch the state set up by __init__, so the backends are not constructed
+        reverse = reverse_class.__new__(reverse_class)
+        count = sum(len(stream.lines) for stream in streams)
+        size = sum(end - begin for stream in streams for _, begin, end in stream.lines)
+        upstream = sum(stream.duration for stream in streams)
+        print(f"{backend}: {len(streams)} streams, {count} lines, {size / 1024:.0f} KiB, "
+              f"{upstream:.2f}s of upstream time")
+        for label, convert in (('stream', convert_stream), ('result', convert_result)):
+            seconds = run(convert, reverse, recording, streams, args.rounds)
+            print(f"  {label:6} {seconds * 1000:9.2f} ms  {count / seconds:10.0f} lines/s  "
+                  f"{size / seconds / 1024 / 1024:7.1f} MiB/s  {seconds / len(streams) * 1000:.3f} ms/stream")
+    recording.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
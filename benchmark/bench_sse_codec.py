@@ -0,0 +1,213 @@
+"""
+Micro-benchmark of the sse codec against the original json + pydantic path, on claude frames and on
+chatgpt's cumulative multi-part frames (choices past index 0 and a finish-only last frame).
+
+    python benchmark/bench_sse_codec.py [frames]
+"""
+import sys
+import json
+import time
+from typing import Any
+
+sys.path.append(".")
+sys.path.append("..")
+from openai.types import Completion, CompletionChoice
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice as ChatChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
+
+from src.reverse.delta_engine import PartsDeltaEngine
+from src.reverse.sse_codec import ChatChunkEncoder, CompletionChunkEncoder, data_payload, loads
+
+
+class NewCompletionChoice(CompletionChoice):
+    # the choice of the original implementation, finish_reason may be None
+    finish_reason: Any = None
+
+
+CREATED = 1712000000
+TEXT = "The quick brown fox 跳过了 the lazy dog. \"Quoted\"\n\tand escaped \\ text. "
+
+
+def claude_frames(count: int) -> list:
+    frames = []
+    for i in range(count):
+        data = {"type": "completion", "id": "chatcompl_01", "completion": TEXT[i % len(TEXT):][:4],
+                "stop_reason": "stop_sequence" if i == count - 1 else None, "model": "claude-2.1",
+                "stop": None, "log_id": "log"}
+        frames.append(b"data: " + json.dumps(data).encode('utf-8'))
+    return frames
+
+
+def chatgpt_frames(count: int, parts: int = 3) -> list:
+    # the answer grows part after part, the last frame only repeats it with the finished status
+    texts = [''] * parts
+    frames = []
+    for i in range(count + 1):
+        finished = i == count
+        if not finished:
+            part = min(i * parts // count, parts - 1)
+            texts[part] += TEXT[i % len(TEXT):][:4]
+        data = {"message": {"id": "m", "author": {"role": "assistant"},
+                            "content": {"content_type": "text", "parts": [t for t in texts if t]},
+                            "status": 'finished_successfully' if finished else 'in_progress'},
+                "conversation_id": "c", "error": None}
+        frames.append(b"data: " + json.dumps(data).encode('utf-8'))
+    frames.append(b"data: [DONE]")
+    return frames
+
+
+def chatgpt_choices(frames: list, decode) -> list:
+    # per frame the (index, delta, finish_reason) choices the chatgpt backend sends, with the original
+    # prefix diff. like ChatGPTReverse.iter_deltas, empty deltas are only sent with the finish reason
+    per_parts = []
+    out = []
+    for chunk in frames:
+        if not chunk or chunk == b'data: [DONE]':
+            continue
+        message = decode(chunk)['message']
+        finished = message['status'] == 'finished_successfully'
+        parts = message['content']['parts']
+        choices = [(i, p[len(per_parts[i]):] if i < len(per_parts) else p, 'stop' if finished else None)
+                   for i, p in enumerate(parts)]
+        per_parts = parts
+        out.append([choice for choice in choices if choice[1] or finished])
+    return out
+
+
+def legacy_chatgpt_completion(frames: list) -> list:
+    out = []
+    for choices in chatgpt_choices(frames, lambda chunk: json.loads(chunk[len("data:"):])):
+        completion = Completion(id='c', created=CREATED, model='gpt-3.5-turbo', object='text_completion',
+                                choices=[NewCompletionChoice(index=i, text=p, finish_reason=reason)
+                                         for i, p, reason in choices])
+        out.append(f"data: {completion.model_dump_json(exclude_unset=True)}\n")
+    return out
+
+
+def legacy_chatgpt_chat(frames: list) -> list:
+    out = []
+    for choices in chatgpt_choices(frames, lambda chunk: json.loads(chunk[len("data:"):])):
+        chunk_choices = []
+        for i, p, reason in choices:
+            delta = ChoiceDelta(role='assistant', content=p)
+            if reason is None:
+                chunk_choices.append(ChatChunkChoice(index=i, delta=delta))
+            else:
+                chunk_choices.append(ChatChunkChoice(index=i, delta=delta, finish_reason=reason))
+        completion = ChatCompletionChunk(id='c', created=CREATED, choices=chunk_choices, model='gpt-3.5-turbo',
+                                         object='chat.completion.chunk')
+        out.append(f"data: {completion.model_dump_json(exclude_unset=True)}\n")
+    return out
+
+
+def codec_chatgpt(encoder_class):
+    def encode(frames: list) -> list:
+        out = []
+        engine = PartsDeltaEngine()
+        encoder = encoder_class('c', 'gpt-3.5-turbo')
+        for chunk in frames:
+            payload = data_payload(chunk)
+            if payload is None or chunk == b'data: [DONE]':
+                continue
+            message = loads(payload)['message']
+            finished = message['status'] == 'finished_successfully'
+            finish_reason = 'stop' if finished else None
+            choices = [(i, delta, finish_reason) for i, delta in engine.feed(message['content']['parts'])
+                       if delta or finished]
+            out.append(encoder.encode(choices, created=CREATED))
+        return out
+    return encode
+
+
+def legacy_completion(frames: list) -> list:
+    out = []
+    for chunk in frames:
+        if not chunk or not chunk.decode('utf-8').startswith('data:'):
+            continue
+        json_data = json.loads(chunk[len("data:"):])
+        finish_reason = 'stop' if json_data['stop_reason'] == 'stop_sequence' else None
+        choice = NewCompletionChoice(index=0, text=json_data['completion'], finish_reason=finish_reason)
+        completion = Completion(id=json_data['id'], created=CREATED, choices=[choice], model=json_data['model'],
+                                object='text_completion')
+        out.append(f"data: {completion.model_dump_json(exclude_unset=True)}\n")
+    return out
+
+
+def codec_completion(frames: list) -> list:
+    out = []
+    encoder = None
+    for chunk in frames:
+        payload = data_payload(chunk)
+        if payload is None:
+            continue
+        json_data = loads(payload)
+        finish_reason = 'stop' if json_data['stop_reason'] == 'stop_sequence' else None
+        if encoder is None or encoder.c_id != json_data['id'] or encoder.model != json_data['model']:
+            encoder = CompletionChunkEncoder(json_data['id'], json_data['model'])
+        out.append(encoder.encode([(0, json_data['completion'], finish_reason)], created=CREATED))
+    return out
+
+
+def legacy_chat(frames: list) -> list:
+    out = []
+    for chunk in frames:
+        if not chunk or not chunk.decode('utf-8').startswith('data:'):
+            continue
+        json_data = json.loads(chunk[len("data:"):])
+        delta = ChoiceDelta(role='assistant', content=json_data['completion'])
+        if json_data['stop_reason'] != 'stop_sequence':
+            choice = ChatChunkChoice(index=0, delta=delta)
+        else:
+            choice = ChatChunkChoice(index=0, delta=delta, finish_reason='stop')
+        completion = ChatCompletionChunk(id=json_data['id'], created=CREATED, choices=[choice],
+                                         model=json_data['model'], object='chat.completion.chunk')
+        out.append(f"data: {completion.model_dump_json(exclude_unset=True)}\n")
+    return out
+
+
+def codec_chat(frames: list) -> list:
+    out = []
+    encoder = None
+    for chunk in frames:
+        payload = data_payload(chunk)
+        if payload is None:
+            continue
+        json_data = loads(payload)
+        if encoder is None or encoder.c_id != json_data['id'] or encoder.model != json_data['model']:
+            encoder = ChatChunkEncoder(json_data['id'], json_data['model'])
+        finish_reason = 'stop' if json_data['stop_reason'] == 'stop_sequence' else None
+        out.append(encoder.encode([(0, json_data['completion'], finish_reason)], created=CREATED))
+    return out
+
+
+def bench(name: str, func, frames: list, rounds: int = 5) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(frames)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<20} {best * 1000:9.2f} ms  {len(frames) / best:12.0f} frames/s")
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    frames = claude_frames(count)
+    # cumulative frames grow with the answer, so fewer of them
+    multi_part_frames = chatgpt_frames(max(count // 10, 3))
+
+    for label, legacy, codec, label_frames in [
+            ('completion', legacy_completion, codec_completion, frames),
+            ('chat', legacy_chat, codec_chat, frames),
+            ('chatgpt completion', legacy_chatgpt_completion, codec_chatgpt(CompletionChunkEncoder), multi_part_frames),
+            ('chatgpt chat', legacy_chatgpt_chat, codec_chatgpt(ChatChunkEncoder), multi_part_frames)]:
+        if legacy(label_frames) != codec(label_frames):
+            raise SystemExit(f"{label}: codec output differs from the pydantic output")
+        legacy_time = bench(f"{label} legacy", legacy, label_frames)
+        codec_time = bench(f"{label} codec", codec, label_frames)
+        print(f"{label:<20} speedup x{legacy_time / codec_time:.1f}\n")
+
+
+if __name__ == '__main__':
+    main()
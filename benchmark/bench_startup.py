@@ -0,0 +1,176 @@
+"""
+Cold start of the proxy as a serverless runtime sees it: a fresh interpreter imports the app from src/main.py
+and serves its first request without a startup event, against the fake upstream in benchmark/fake_upstream.py.
+
+    python benchmark/bench_startup.py --rounds 5
+    python benchmark/bench_startup.py --save-baseline main
+    python benchmark/bench_startup.py --baseline main --threshold 0.2 --max-import-ms 800
+
+Each backend is measured with only itself enabled (ENABLED_BACKENDS). A run fails when a metric regressed
+against the baseline by more than the threshold, exceeds its --max-* budget, or the openai package was imported.
+Proxy settings can be overridden with --env NAME=VALUE, remaining options are passed to the fake upstream,
+which answers without any delay unless told otherwise (see fake_upstream.py --help).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+from load_test import BASELINE_DIR, MODELS, PROXY_ENV, ROOT, free_port, percentile, start, wait_ready
+
+# the upstream answers at once, so the proxy's own work stands out
+UPSTREAM_ARGS = ['--token-rate', '0', '--ttfb', '0', '--jitter', '0']
+
+# metrics compared with the baseline, all get worse upwards
+REGRESSION_METRICS = ['import_ms', 'first_request_ms', 'cold_start_ms']
+
+
+def baseline_path(name: str) -> str:
+    # next to the load test baselines of the same name
+    return os.path.join(BASELINE_DIR, f"{name}.startup.json")
+
+
+async def serve_requests(app, model: str) -> list:
+    # no lifespan events are sent, as on a serverless runtime, so the backend is created by the first request
+    body = {'model': model, 'messages': [{'role': 'user', 'content': 'startup'}]}
+    durations = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://proxy',
+                                 timeout=60) as client:
+        for _ in range(2):
+            begin = time.perf_counter()
+            response = await client.post('/v1/chat/completions', json=body)
+            response.raise_for_status()
+            durations.append(time.perf_counter() - begin)
+    return durations
+
+
+def child(model: str):
+    # runs in the measured interpreter, prints its timings as one json line
+    begin = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from src.main import app
+    imported = time.perf_counter() - begin
+    modules = len(sys.modules)
+    first, warm = asyncio.run(serve_requests(app, model))
+    print(json.dumps({
+        'import_ms': imported * 1000,
+        'first_request_ms': first * 1000,
+        'warm_request_ms': warm * 1000,
+        'modules': modules,
+        'openai': 'openai' in sys.modules,
+    }))
+
+
+def measure(backend: str, env: dict) -> dict:
+    env = dict(env, ENABLED_BACKENDS=backend)
+    begin = time.perf_counter()
+    output = subprocess.run([sys.executable, __file__, '--child', MODELS[backend]], cwd=ROOT, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    # interpreter start, imports and the first answer, as the client of a cold instance waits for it
+    result['cold_start_ms'] = (time.perf_counter() - begin) * 1000 - result['warm_request_ms']
+    return result
+
+
+def summarize(rounds: list) -> dict:
+    summary = {metric: percentile([r[metric] for r in rounds], 0.5)
+               for metric in ('import_ms', 'first_request_ms', 'warm_request_ms', 'cold_start_ms')}
+    summary['modules'] = max(r['modules'] for r in rounds)
+    summary['openai'] = any(r['openai'] for r in rounds)
+    return summary
+
+
+def report(results: dict):
+    print(f"{'backend':<10}{'import':>10}{'first req':>12}{'warm req':>11}{'cold start':>13}{'modules':>9}  openai")
+    for name, r in results.items():
+        print(f"{name:<10}{r['import_ms']:>8.1f}ms{r['first_request_ms']:>10.1f}ms{r['warm_request_ms']:>9.1f}ms"
+              f"{r['cold_start_ms']:>11.1f}ms{r['modules']:>9}  {'imported' if r['openai'] else 'no'}")
+
+
+def check(results: dict, args) -> list:
+    failures = []
+    budgets = {'import_ms': args.max_import_ms, 'first_request_ms': args.max_first_request_ms}
+    for name, r in results.items():
+        if r['openai']:
+            failures.append(f"{name} imported the openai package")
+        for metric, budget in budgets.items():
+            if budget and r[metric] > budget:
+                failures.append(f"{name} {metric}: {r[metric]:.1f} over the budget of {budget:.0f}")
+    if args.baseline:
+        with open(baseline_path(args.baseline)) as f:
+            baseline = json.load(f)['results']
+        for name, r in results.items():
+            base = baseline.get(name)
+            if base is None:
+                continue
+            for metric in REGRESSION_METRICS:
+                if not base.get(metric):
+                    continue
+                change = (r[metric] - base[metric]) / base[metric]
+                if change > args.threshold:
+                    failures.append(f"{name} {metric}: {base[metric]:.4g} -> {r[metric]:.4g} ({change:+.0%}) "
+                                    f"against baseline {args.baseline}")
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5, help='fresh interpreters per backend, the median is kept')
+    parser.add_argument('--backends', default='chatgpt,claude')
+    parser.add_argument('--env', action='append', default=[], help='NAME=VALUE passed to the proxy')
+    parser.add_argument('--max-import-ms', type=float, default=0, help='import budget, 0 checks none')
+    parser.add_argument('--max-first-request-ms', type=float, default=0, help='first request budget, 0 checks none')
+    parser.add_argument('--baseline', help='name of a saved baseline to compare with')
+    parser.add_argument('--save-baseline', help='save the results under this name')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change flagged as a regression')
+    parser.add_argument('--child', metavar='MODEL', help=argparse.SUPPRESS)
+    return parser.parse_known_args(argv)
+
+
+def run(args, upstream_args: list) -> dict:
+    upstream_port = free_port()
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+    env = dict(os.environ, **PROXY_ENV, CHATGPT_BASE_URL=upstream_url, CLAUDE_BASE_URL=upstream_url)
+    env.update(item.split('=', 1) for item in args.env)
+
+    upstream = start([sys.executable, 'benchmark/fake_upstream.py', '--port', str(upstream_port)] + UPSTREAM_ARGS
+                     + upstream_args)
+    try:
+        asyncio.run(wait_ready(upstream_url + '/api/organizations'))
+        return {backend: summarize([measure(backend, env) for _ in range(args.rounds)])
+                for backend in args.backends.split(',')}
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+
+def main(argv=None):
+    args, upstream_args = parse_args(argv)
+    if args.child:
+        return child(args.child)
+    results = run(args, upstream_args)
+    report(results)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = baseline_path(args.save_baseline)
+        with open(path, 'w') as f:
+            json.dump({'args': sys.argv[1:], 'results': results}, f, indent=2)
+        print(f"baseline saved to {path}")
+
+    failures = check(results, args)
+    if failures:
+        print("startup regressions:")
+        for line in failures:
+            print("  " + line)
+        sys.exit(1)
+    print("no startup regression" + (f" against baseline {args.baseline}" if args.baseline else ""))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
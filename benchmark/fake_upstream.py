@@ -0,0 +1,142 @@
+"""
+Local stand-in for the chatgpt and claude web endpoints used by the proxy.
+Point the proxy at it with CHATGPT_BASE_URL / CLAUDE_BASE_URL.
+
+    python benchmark/fake_upstream.py --port 18080 --token-rate 50 --length 600 --jitter 0.2 --error-rate 0.01
+"""
+import sys
+import json
+import uuid
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+SENTENCE = "Benchmarks keep the proxy honest, 基准测试 too. "
+
+
+@dataclass
+class UpstreamConfig:
+    # generated tokens per second of one stream, 0 sends everything at once
+    token_rate: float = 50
+    # characters of one answer and characters per token
+    length: int = 600
+    token_chars: int = 4
+    # +- fraction applied to every inter-token delay
+    jitter: float = 0.2
+    # probability that a request answers 429 / 500 instead
+    error_rate: float = 0.0
+    # seconds before the response headers
+    ttfb: float = 0.05
+
+
+def answer(length: int) -> str:
+    return (SENTENCE * (length // len(SENTENCE) + 1))[:length]
+
+
+def create_app(config: UpstreamConfig) -> Starlette:
+    text = answer(config.length)
+    tokens = [text[i:i + config.token_chars] for i in range(0, len(text), config.token_chars)]
+
+    async def pause():
+        if config.token_rate > 0:
+            delay = 1 / config.token_rate
+            await asyncio.sleep(delay * random.uniform(1 - config.jitter, 1 + config.jitter))
+
+    async def injected_error():
+        await asyncio.sleep(config.ttfb)
+        if config.error_rate and random.random() < config.error_rate:
+            status = random.choice((429, 500))
+            return JSONResponse({'detail': 'injected error'}, status_code=status)
+        return None
+
+    async def sentinel(request):
+        return JSONResponse({'token': f"fake-{uuid.uuid4().hex}"})
+
+    async def conversation(request):
+        error = await injected_error()
+        if error:
+            return error
+
+        async def frames():
+            message_id = str(uuid.uuid4())
+            user = {"message": {"id": "u", "author": {"role": "user"}, "content": {"parts": ["q"]},
+                                "status": "finished_successfully"}, "conversation_id": "c", "error": None}
+            yield f"data: {json.dumps(user)}\n\n".encode('utf-8')
+            size = 0
+            for i, token in enumerate(tokens):
+                size += len(token)
+                status = 'finished_successfully' if i == len(tokens) - 1 else 'in_progress'
+                data = {"message": {"id": message_id, "author": {"role": "assistant"},
+                                    "content": {"content_type": "text", "parts": [text[:size]]}, "status": status,
+                                    "metadata": {}}, "conversation_id": "c", "error": None}
+                yield f"data: {json.dumps(data)}\n\n".encode('utf-8')
+                await pause()
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(frames(), media_type='text/event-stream')
+
+    async def organizations(request):
+        return JSONResponse([{'uuid': 'fake-org', 'capabilities': ['chat']}])
+
+    async def new_chat(request):
+        return JSONResponse(await request.json(), status_code=201)
+
+    async def delete_chat(request):
+        return Response(status_code=204)
+
+    async def completion(request):
+        error = await injected_error()
+        if error:
+            return error
+
+        async def frames():
+            for i, token in enumerate(tokens):
+                stop_reason = 'stop_sequence' if i == len(tokens) - 1 else None
+                data = {"type": "completion", "id": "chatcompl_fake", "completion": token,
+                        "stop_reason": stop_reason, "model": "claude-2.1", "stop": None, "log_id": "log"}
+                yield f"event: completion\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+                await pause()
+
+        return StreamingResponse(frames(), media_type='text/event-stream')
+
+    return Starlette(routes=[
+        Route('/backend-anon/sentinel/chat-requirements', sentinel, methods=['POST']),
+        Route('/backend-anon/conversation', conversation, methods=['POST']),
+        Route('/api/organizations', organizations),
+        Route('/api/organizations/{organization_id}/chat_conversations', new_chat, methods=['POST']),
+        Route('/api/organizations/{organization_id}/chat_conversations/{chat_id}', delete_chat,
+              methods=['DELETE']),
+        Route('/api/organizations/{organization_id}/chat_conversations/{chat_id}/completion', completion,
+              methods=['POST']),
+    ])
+
+
+def parse_config(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--token-rate', type=float, default=UpstreamConfig.token_rate)
+    parser.add_argument('--length', type=int, default=UpstreamConfig.length)
+    parser.add_argument('--token-chars', type=int, default=UpstreamConfig.token_chars)
+    parser.add_argument('--jitter', type=float, default=UpstreamConfig.jitter)
+    parser.add_argument('--error-rate', type=float, default=UpstreamConfig.error_rate)
+    parser.add_argument('--ttfb', type=float, default=UpstreamConfig.ttfb)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import uvicorn
+
+    args = parse_config(argv)
+    config = UpstreamConfig(token_rate=args.token_rate, length=args.length, token_chars=args.token_chars,
+                            jitter=args.jitter, error_rate=args.error_rate, ttfb=args.ttfb)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,247 @@
+"""
+Load test of the proxy against the local fake upstreams in benchmark/fake_upstream.py.
+Both run as their own uvicorn process, so the proxy's cpu and memory are measured alone.
+
+    python benchmark/load_test.py --concurrency 1,8,32 --requests 200
+    python benchmark/load_test.py --save-baseline main
+    python benchmark/load_test.py --baseline main --threshold 0.2
+
+Remaining options are passed to the fake upstream (see fake_upstream.py --help),
+proxy settings can be overridden with --env NAME=VALUE.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, 'benchmark', 'baselines')
+
+MODELS = {'chatgpt': 'gpt-3.5-turbo', 'claude': 'claude-2'}
+
+# the harness measures the proxy itself, so nothing may answer without going upstream
+PROXY_ENV = {
+    'RESPONSE_CACHE_ENABLE': 'false',
+    'COALESCE_ENABLE': 'false',
+    'ADMISSION_ACCOUNT_CONCURRENCY': '0',
+    'ADMISSION_BACKEND_CONCURRENCY': '100000',
+    'ADMISSION_QUEUE_SIZE': '100000',
+    'CHATGPT_ACCESS_TOKEN': '',
+    'CLAUDE_SESSION_KEY': 'benchmark',
+    'CLAUDE_METADATA_CACHE_PATH': '',
+    'PROXY_ENABLE': 'false',
+    'LOG_LEVEL': 'WARNING',
+}
+
+# metric -> direction in which it gets worse
+REGRESSION_METRICS = {
+    'throughput': -1,
+    'ttft_p99': 1,
+    'total_p99': 1,
+    'cpu_ms_per_request': 1,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def process_usage(pid: int):
+    # (cpu seconds, rss bytes) of a process
+    if psutil is not None:
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        return times.user + times.system, process.memory_info().rss
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+    return cpu, rss
+
+
+def start(args: list, env: dict = None) -> subprocess.Popen:
+    return subprocess.Popen(args, cwd=ROOT, env=env)
+
+
+async def wait_ready(url: str, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def one_request(client: httpx.AsyncClient, model: str, index: int) -> dict:
+    body = {'model': model, 'stream': True, 'messages': [{'role': 'user', 'content': f"benchmark {index}"}]}
+    start = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream('POST', '/v1/chat/completions', json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return {'error': response.status_code}
+            async for line in response.aiter_lines():
+                if ttft is None and line.startswith('data: {') and '"content":""' not in line:
+                    ttft = time.perf_counter() - start
+    except httpx.HTTPError as e:
+        return {'error': type(e).__name__}
+    total = time.perf_counter() - start
+    return {'ttft': ttft if ttft is not None else total, 'total': total}
+
+
+async def run_level(base_url: str, model: str, concurrency: int, requests: int, proxy_pid: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        counter = iter(range(requests))
+        results = []
+
+        async def worker():
+            for index in counter:
+                results.append(await one_request(client, model, index))
+
+        cpu_before, _ = process_usage(proxy_pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        cpu_after, rss = process_usage(proxy_pid)
+
+    ok = [r for r in results if 'error' not in r]
+    errors = {}
+    for r in results:
+        if 'error' in r:
+            errors[str(r['error'])] = errors.get(str(r['error']), 0) + 1
+    ttft = [r['ttft'] for r in ok]
+    total = [r['total'] for r in ok]
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': len(ok) / elapsed,
+        'ttft_p50': percentile(ttft, 0.5),
+        'ttft_p99': percentile(ttft, 0.99),
+        'total_p50': percentile(total, 0.5),
+        'total_p99': percentile(total, 0.99),
+        'cpu_ms_per_request': (cpu_after - cpu_before) * 1000 / max(len(results), 1),
+        'rss_mb': rss / 1024 / 1024,
+    }
+
+
+def report(results: dict):
+    header = (f"{'scenario':<16}{'req/s':>9}{'ttft p50':>10}{'ttft p99':>10}{'total p50':>11}{'total p99':>11}"
+              f"{'cpu ms/req':>12}{'rss MB':>8}  errors")
+    print(header)
+    for name, r in results.items():
+        print(f"{name:<16}{r['throughput']:>9.1f}{r['ttft_p50'] * 1000:>8.1f}ms{r['ttft_p99'] * 1000:>8.1f}ms"
+              f"{r['total_p50'] * 1000:>9.1f}ms{r['total_p99'] * 1000:>9.1f}ms{r['cpu_ms_per_request']:>12.2f}"
+              f"{r['rss_mb']:>8.1f}  {r['errors'] or ''}")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, worse in REGRESSION_METRICS.items():
+            if not base.get(metric):
+                continue
+            change = (r[metric] - base[metric]) / base[metric]
+            if change * worse > threshold:
+                regressions.append(f"{name} {metric}: {base[metric]:.4g} -> {r[metric]:.4g} ({change:+.0%})")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,8,32', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests per level')
+    parser.add_argument('--backends', default='chatgpt,claude')
+    parser.add_argument('--env', action='append', default=[], help='NAME=VALUE passed to the proxy')
+    parser.add_argument('--baseline', help='name of a saved baseline to compare with')
+    parser.add_argument('--save-baseline', help='save the results under this name')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change flagged as a regression')
+    return parser.parse_known_args(argv)
+
+
+async def run(args, upstream_args: list) -> dict:
+    upstream_port = free_port()
+    proxy_port = free_port()
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+    env = dict(os.environ, **PROXY_ENV, CHATGPT_BASE_URL=upstream_url, CLAUDE_BASE_URL=upstream_url)
+    env.update(item.split('=', 1) for item in args.env)
+
+    upstream = start([sys.executable, 'benchmark/fake_upstream.py', '--port', str(upstream_port)] + upstream_args)
+    proxy = start([sys.executable, '-m', 'uvicorn', 'src.api_proxy:app', '--port', str(proxy_port),
+                   '--log-level', 'warning'], env)
+    try:
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+        await wait_ready(upstream_url + '/api/organizations')
+        await wait_ready(proxy_url + '/')
+        results = {}
+        for backend in args.backends.split(','):
+            # one warm-up round so connection setup and token fetches aren't measured
+            await run_level(proxy_url, MODELS[backend], 1, 2, proxy.pid)
+            for concurrency in map(int, args.concurrency.split(',')):
+                name = f"{backend}@{concurrency}"
+                results[name] = await run_level(proxy_url, MODELS[backend], concurrency, args.requests, proxy.pid)
+        return results
+    finally:
+        for process in (proxy, upstream):
+            process.terminate()
+            process.wait(timeout=10)
+
+
+def main(argv=None):
+    args, upstream_args = parse_args(argv)
+    results = asyncio.run(run(args, upstream_args))
+    report(results)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, 'w') as f:
+            json.dump({'args': sys.argv[1:], 'results': results}, f, indent=2)
+        print(f"baseline saved to {path}")
+
+    if args.baseline:
+        with open(os.path.join(BASELINE_DIR, f"{args.baseline}.json")) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("regressions against baseline " + args.baseline + ":")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print(f"no regression above {args.threshold:.0%} against baseline {args.baseline}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,5 +2,3 @@ import sys
 
 sys.path.append(".")
 sys.path.append("..")
-from src.reverse.chatgpt_reverse import ChatGPTReverse
-from src.reverse.claude_reverse import ClaudeReverse
\ No newline at end of file
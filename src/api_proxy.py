@@ -3,12 +3,24 @@ import os
 import sys
 import logging
 
+import httpx
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 
 sys.path.append(".")
 sys.path.append("..")
-from src.reverse.base_reverse import BaseReverse
+from src.reverse.admission import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, Overloaded, request_priority
+from src.reverse.credential_pool import ACCOUNT_RATE_LIMIT_COOLDOWN
+from src.reverse.metrics import REGISTRY
+from src.reverse.proxy_pool import get_proxy_pool
+from src.reverse.registry import ReverseRegistry
+from src.reverse.stream_merge import flush_policy, stream_flush_policy
+from src.service.batch import BatchRunner, choice_count
+from src.service.coalescer import create_coalescer
+from src.service.profiling import ProfilingMiddleware, RequestProfiler, is_admin
+from src.service.response_cache import STATUS_HEADER, cache_key, create_response_cache
+from src.service.router import ModelRouter, load_routes, route_headers, route_trace
 
 logger = logging.getLogger(__name__)
 
@@ -21,9 +33,35 @@ SESSION_URL = f"{BASE_URL}/backend-anon/sentinel/chat-requirements"
 
 REFRESH_INTERVAL = int(os.environ.get('REFRESH_INTERVAL', 60))
 
+# api keys (the client's bearer token) whose requests are queued ahead of / behind the others
+ADMISSION_HIGH_PRIORITY_KEYS = set(filter(None, os.environ.get('ADMISSION_HIGH_PRIORITY_KEYS', '').split(',')))
+ADMISSION_LOW_PRIORITY_KEYS = set(filter(None, os.environ.get('ADMISSION_LOW_PRIORITY_KEYS', '').split(',')))
+
 app = FastAPI()
 
-token_tuple = (None, 0)
+registry = ReverseRegistry()
+
+router = ModelRouter(load_routes(), registry.get)
+
+response_cache = create_response_cache()
+
+coalescer = create_coalescer()
+
+batch_runner = BatchRunner()
+
+profiler = RequestProfiler()
+
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+
+@app.on_event('startup')
+async def startup():
+    await registry.startup()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await registry.shutdown()
 
 
 @app.get('/')
@@ -31,8 +69,104 @@ async def application():
     return "I'm GPT API Proxy"
 
 
+@app.get('/stats')
+async def stats():
+    stats = registry.stats()
+    if response_cache is not None:
+        stats['response_cache'] = response_cache.stats()
+    stats['batch'] = {'batches': batch_runner.batches, 'items': batch_runner.items}
+    stats['routes'] = router.stats()
+    if coalescer is not None:
+        stats['coalescer'] = coalescer.stats()
+    stats['profiles'] = profiler.stats()
+    return stats
+
+
+@app.get('/admin/profiles')
+async def list_profiles(req: Request):
+    if not is_admin(req.headers):
+        raise HTTPException(status_code=403, detail='admin api key required')
+    return [profile.summary() for profile in reversed(profiler.profiles.values())]
+
+
+@app.get('/admin/profiles/{profile_id}')
+async def get_profile(req: Request, profile_id: str):
+    if not is_admin(req.headers):
+        raise HTTPException(status_code=403, detail='admin api key required')
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"no profile {profile_id}")
+    return profile.to_dict()
+
+
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+def collect_admission(key: str) -> dict:
+    return {(llm_type,): instance.admission.stats()[key] for llm_type, instance in registry.instances.items()}
+
+
+def collect_accounts(key: str) -> dict:
+    values = {}
+    for llm_type, instance in registry.instances.items():
+        for account in instance.accounts.accounts:
+            values[(llm_type, account.name)] = getattr(account, key)
+    return values
+
+
+def collect_proxies(key: str) -> dict:
+    proxy_pool = get_proxy_pool()
+    if proxy_pool is None:
+        return {}
+    return {(proxy.name,): getattr(proxy, key) for proxy in proxy_pool.proxies}
+
+
+REGISTRY.callback('gpt_proxy_admission_in_flight', 'Admitted upstream conversations', ('backend',),
+                  lambda: collect_admission('in_flight'))
+REGISTRY.callback('gpt_proxy_admission_queued', 'Requests waiting for a slot', ('backend',),
+                  lambda: collect_admission('queued'))
+REGISTRY.callback('gpt_proxy_admission_shed_total', 'Requests rejected because the queue was full', ('backend',),
+                  lambda: collect_admission('shed'), 'counter')
+REGISTRY.callback('gpt_proxy_admission_timeouts_total', 'Requests rejected after waiting too long', ('backend',),
+                  lambda: collect_admission('timeouts'), 'counter')
+REGISTRY.callback('gpt_proxy_account_in_flight', 'Upstream conversations in flight per account',
+                  ('backend', 'account'), lambda: collect_accounts('in_flight'))
+REGISTRY.callback('gpt_proxy_account_latency_ewma_seconds', 'Smoothed time to first byte per account',
+                  ('backend', 'account'), lambda: collect_accounts('latency_ewma'))
+REGISTRY.callback('gpt_proxy_aborted_streams_total', 'Streams closed because every client went away', ('backend',),
+                  lambda: {(t,): i.aborted_streams for t, i in registry.instances.items()}, 'counter')
+REGISTRY.callback('gpt_proxy_egress_in_flight', 'Upstream conversations in flight per egress proxy', ('proxy',),
+                  lambda: collect_proxies('in_flight'))
+REGISTRY.callback('gpt_proxy_egress_latency_ewma_seconds', 'Smoothed health check round trip per egress proxy',
+                  ('proxy',), lambda: collect_proxies('latency_ewma'))
+REGISTRY.callback('gpt_proxy_egress_ejections_total', 'Times an egress proxy was taken out of rotation', ('proxy',),
+                  lambda: collect_proxies('ejections'), 'counter')
+REGISTRY.callback('gpt_proxy_route_breaker_open', 'Whether a backend of a model route is skipped by its breaker',
+                  ('route', 'backend'),
+                  lambda: {(name, target.name): int(target.breaker.state == 'open')
+                           for name, route in router.routes.items() for target in route.targets})
+REGISTRY.callback('gpt_proxy_hedged_requests_total', 'Duplicate requests sent because the first byte was late',
+                  ('backend',), lambda: {(t,): i.hedger.hedged for t, i in registry.instances.items()}, 'counter')
+REGISTRY.callback('gpt_proxy_hedge_wins_total', 'Hedged requests answered first by the duplicate', ('backend',),
+                  lambda: {(t,): i.hedger.hedge_wins for t, i in registry.instances.items()}, 'counter')
+REGISTRY.callback('gpt_proxy_conversation_reuse_bytes_saved_total',
+                  'History bytes not sent again because an upstream conversation was continued', ('backend',),
+                  lambda: {(t,): i.prefix_index.bytes_saved for t, i in registry.instances.items()
+                           if i.prefix_index is not None}, 'counter')
+if response_cache is not None:
+    REGISTRY.callback('gpt_proxy_response_cache_lookups_total', 'Response cache lookups by result', ('result',),
+                      lambda: {('hit',): response_cache.hits, ('miss',): response_cache.misses,
+                               ('bypass',): response_cache.bypasses}, 'counter')
+if coalescer is not None:
+    REGISTRY.callback('gpt_proxy_coalesced_requests_total', 'Requests served by an already running upstream call',
+                      (), lambda: {(): coalescer.coalesced}, 'counter')
+
+
 @app.post('/v1/completions')
 async def completion(req: Request):
+    request_priority.set(get_priority(req))
     try:
         request_body = await req.json()
         prompt = request_body['prompt']
@@ -42,31 +176,27 @@ async def completion(req: Request):
         elif isinstance(prompt, list):
             prompts.extend(prompt)
 
-        messages = []
+        # every prompt is its own conversation and gets its own choice
+        batch = []
         for p in prompts:
             msg_temp = {
                 "author": {"role": "user"},
                 "content": {"content_type": "text", "parts": [p]}
             }
-            messages.append(msg_temp)
+            batch.append([msg_temp])
 
-        is_stream = request_body.get('stream')
-
-        model = request_body.get('model')
-        reverse_instance = get_reverse_by_model(model)
-        return await reverse_instance.do_run(messages, is_stream=is_stream)
+        return await run_completion(req, request_body, batch)
     except Exception as e:
         error_msg = f"error: {str(e)}"
         logger.error(error_msg)
-        print("print: " + error_msg)
-        raise HTTPException(status_code=1004, detail=error_msg)
+        raise to_http_exception(e, error_msg)
 
 
 @app.post('/v1/chat/completions')
 async def chat_completion(req: Request):
+    request_priority.set(get_priority(req))
     try:
         request_body = await req.json()
-        is_stream = request_body.get('stream')
         messages = [
             {
                 "author": {"role": message["role"]},
@@ -74,27 +204,90 @@ async def chat_completion(req: Request):
             }
             for message in request_body["messages"]
         ]
-
-        model = request_body.get('model')
-        reverse_instance = get_reverse_by_model(model)
-        return await reverse_instance.do_run(messages, is_stream=is_stream, is_chat=True)
+        return await run_completion(req, request_body, [messages], is_chat=True)
     except Exception as e:
         error_msg = f"error: {str(e)}"
         logger.error(error_msg)
-        print("print: " + error_msg)
-        raise HTTPException(status_code=1004, detail=error_msg)
+        raise to_http_exception(e, error_msg)
+
+
+async def run_completion(req: Request, request_body: dict, batch: list, is_chat: bool = False):
+    model = request_body.get('model')
+    is_stream = request_body.get('stream')
+    n = choice_count(request_body.get('n'))
+    upstream = router.route(model)
+    # filled with the routing decisions of this request, reported in the response headers
+    trace = []
+    route_trace.set(trace)
+    if is_stream:
+        stream_flush_policy.set(flush_policy(request_body.get('stream_coalesce')))
+    key = None
+    if response_cache is not None or coalescer is not None:
+        key = cache_key(model, batch, request_body)
+    # choice i * n + j is the j-th answer to the i-th prompt
+    items = [messages for messages in batch for _ in range(n)]
+
+    async def run(on_result=None):
+        if len(items) != 1:
+            return await batch_runner.run(upstream, items, is_stream, is_chat, on_result)
+        if coalescer is not None:
+            return await coalescer.run(key, upstream, items[0], is_stream, is_chat, on_result)
+        return await upstream.do_run(items[0], is_stream=is_stream, is_chat=is_chat, on_result=on_result)
+
+    if response_cache is None:
+        response = await run()
+        return with_headers(response, route_headers(trace))
+
+    if response_cache.is_bypass(req.headers):
+        response_cache.bypasses += 1
+        response = await run()
+        return with_headers(response, {STATUS_HEADER: 'BYPASS', **route_headers(trace)})
+
+    result = await response_cache.get(key)
+    if result is not None:
+        if is_stream:
+            response = StreamingResponse(iter(result.to_stream(is_chat)), media_type="text/event-stream")
+        else:
+            response = result.to_dict(is_chat)
+        return with_headers(response, {STATUS_HEADER: 'HIT'})
+    response = await run(lambda r: response_cache.store(key, r))
+    return with_headers(response, {STATUS_HEADER: 'MISS', **route_headers(trace)})
+
+
+def with_headers(response, headers: dict):
+    if response is None or not headers:
+        return response
+    if isinstance(response, dict):
+        response = JSONResponse(response)
+    response.headers.update(headers)
+    return response
+
 
+def get_priority(req: Request) -> int:
+    api_key = req.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if api_key in ADMISSION_HIGH_PRIORITY_KEYS:
+        return PRIORITY_HIGH
+    if api_key in ADMISSION_LOW_PRIORITY_KEYS:
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
 
-def get_reverse_by_model(model: str):
-    llm_type = 'chatgpt'
-    if model.startswith('claude'):
-        llm_type = 'claude'
-    return get_instance_by_type(llm_type)
 
+def to_http_exception(e: Exception, error_msg: str) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, Overloaded):
+        return HTTPException(status_code=e.status_code, detail=error_msg, headers={'Retry-After': str(e.retry_after)})
+    if isinstance(e, httpx.HTTPStatusError):
+        if e.response.status_code == 429:
+            retry_after = e.response.headers.get('Retry-After') or str(int(ACCOUNT_RATE_LIMIT_COOLDOWN))
+            return HTTPException(status_code=429, detail=error_msg, headers={'Retry-After': retry_after})
+        return HTTPException(status_code=502, detail=error_msg)
+    if isinstance(e, httpx.TimeoutException):
+        return HTTPException(status_code=504, detail=error_msg)
+    if isinstance(e, httpx.TransportError):
+        return HTTPException(status_code=502, detail=error_msg)
+    if isinstance(e, (KeyError, ValueError, TypeError)):
+        # missing fields, malformed json or values of the wrong type in the request body
+        return HTTPException(status_code=400, detail=error_msg)
+    return HTTPException(status_code=500, detail=error_msg)
 
-def get_instance_by_type(llm_type):
-    subclasses = BaseReverse.__subclasses__()
-    for subclass in subclasses:
-        if subclass.llm_type == llm_type:
-            instance = subclass()
-            return instance
@@ -1,15 +1,48 @@
 import os
 import sys
+import logging
 
-import uvicorn
 from dotenv import load_dotenv
 
 sys.path.append(".")
 sys.path.append("..")
+# serverless runtimes (see vercel.json) serve the app of this module
 from src.api_proxy import app
 
+__all__ = ['app']
+
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+logger = logging.getLogger(__name__)
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 6080))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+SERVER_KEEP_ALIVE = int(os.environ.get('SERVER_KEEP_ALIVE', 5))
+# seconds in-flight requests get to finish on shutdown before they are cut
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+
+
+def share_caches():
+    # with several workers the expensive caches go to files every worker can read,
+    # the workers are started with this environment
+    if not os.environ.get('SHARED_STORE_PATH'):
+        os.environ['SHARED_STORE_PATH'] = '.cache/shared.db'
+    if not os.environ.get('CLAUDE_METADATA_CACHE_PATH'):
+        os.environ['CLAUDE_METADATA_CACHE_PATH'] = '.cache/claude_metadata.json'
+    cache_enabled = os.environ.get('RESPONSE_CACHE_ENABLE', 'false').upper() == 'TRUE'
+    if cache_enabled and os.environ.get('RESPONSE_CACHE_BACKEND', 'memory') == 'memory':
+        logger.warning("the memory response cache is not shared between workers, "
+                       "set RESPONSE_CACHE_BACKEND=disk to share it")
+
+
 if __name__ == '__main__':
-	port = int(os.environ.get('SERVER_PORT', 6080))
-	uvicorn.run(app, host="127.0.0.1", port=port)
+	import uvicorn
+
+	if SERVER_WORKERS > 1:
+		share_caches()
+	uvicorn.run("src.api_proxy:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS,
+				timeout_keep_alive=SERVER_KEEP_ALIVE, timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT)
@@ -0,0 +1,158 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from contextvars import ContextVar
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+ADMISSION_BACKEND_CONCURRENCY = int(os.environ.get('ADMISSION_BACKEND_CONCURRENCY', 32))
+ADMISSION_ACCOUNT_CONCURRENCY = int(os.environ.get('ADMISSION_ACCOUNT_CONCURRENCY', 8))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 64))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 30))
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# set by the api layer for the current request, inherited by the tasks it spawns
+request_priority: ContextVar[int] = ContextVar('request_priority', default=PRIORITY_NORMAL)
+
+# smoothing factor of the slot hold time used to estimate Retry-After
+HOLD_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+
+    def __init__(self, message: str, status_code: int = 503, retry_after: int = 1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Concurrency limit of one backend with a bounded priority wait queue.
+    A full queue sheds new requests right away, unless they outrank the lowest waiter, which is evicted instead.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = max(limit, 1)
+        self.queue_size = max(queue_size, 0)
+        self.timeout = timeout
+        self.in_flight = 0
+        # (priority, sequence, future), a released slot goes to the highest priority, then the oldest waiter
+        self.waiters = []
+        self._sequence = itertools.count()
+        self.hold_ewma = None
+
+        self.admitted = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.shed = 0
+        self.evicted = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def retry_after(self) -> int:
+        hold = self.hold_ewma or 1.0
+        return max(math.ceil(hold * (len(self.waiters) + 1) / self.limit), 1)
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL) -> float:
+        # returns the seconds spent in the queue
+        if self.has_room():
+            self.in_flight += 1
+            self.admitted += 1
+            return 0.0
+
+        if len(self.waiters) >= self.queue_size:
+            lowest = max(self.waiters) if self.waiters else None
+            if lowest is None or lowest[0] <= priority:
+                self.shed += 1
+                raise Overloaded(f"{self.name} is overloaded, retry later", 429, self.retry_after())
+            self.remove(lowest)
+            self.evicted += 1
+            lowest[2].set_exception(Overloaded(f"{self.name} is overloaded, retry later", 429, self.retry_after()))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(self.waiters, entry)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, len(self.waiters))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.remove(entry)
+            self.timeouts += 1
+            raise Overloaded(f"timed out waiting for {self.name}, retry later", 503, self.retry_after())
+        except asyncio.CancelledError:
+            self.remove(entry)
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # the slot was handed over just as the caller went away
+                self.release()
+            raise
+        wait = time.monotonic() - start
+        self.admitted += 1
+        self.wait_seconds_total += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+        return wait
+
+    def has_room(self) -> bool:
+        return self.in_flight < self.limit and not self.waiters
+
+    def try_acquire(self) -> bool:
+        # a free slot right away, for work that is only worth doing without waiting, e.g. a hedge
+        if not self.has_room():
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def remove(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+    def release(self, hold: float = None):
+        if hold is not None:
+            self.hold_ewma = hold if self.hold_ewma is None else self.hold_ewma + HOLD_ALPHA * (hold - self.hold_ewma)
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                # hand the slot over without letting a newcomer take it in between
+                future.set_result(None)
+                return
+        self.in_flight = max(self.in_flight - 1, 0)
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queued': len(self.waiters),
+            'max_queued': self.max_queued,
+            'admitted': self.admitted,
+            'queued_total': self.queued,
+            'shed': self.shed,
+            'evicted': self.evicted,
+            'timeouts': self.timeouts,
+            'wait_seconds_avg': self.wait_seconds_total / self.queued if self.queued else 0.0,
+            'wait_seconds_max': self.wait_seconds_max,
+            'hold_seconds_ewma': self.hold_ewma,
+        }
+
+
+def backend_limit(accounts: int) -> int:
+    if ADMISSION_ACCOUNT_CONCURRENCY > 0:
+        return min(ADMISSION_BACKEND_CONCURRENCY, accounts * ADMISSION_ACCOUNT_CONCURRENCY)
+    return ADMISSION_BACKEND_CONCURRENCY
@@ -0,0 +1,62 @@
+import os
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# upper bound of the characters kept for one non-stream response, longer answers are cut with finish_reason `length`
+MAX_RESPONSE_CHARS = int(os.environ.get('MAX_RESPONSE_CHARS', 1000000))
+
+# small upstream deltas are merged into chunks of this many pieces to keep the per-object overhead low
+MERGE_PIECES = 64
+
+
+class TextBuffer:
+    """
+    Linear-time accumulation of streamed text with a memory cap. Small pieces are merged into chunks,
+    getvalue joins the chunks once, so the answer is held twice only while it is read.
+    """
+
+    def __init__(self, limit: int = MAX_RESPONSE_CHARS):
+        self.limit = limit
+        self.chunks: List[str] = []
+        self.pieces: List[str] = []
+        self.size = 0
+        self.truncated = False
+
+    def append(self, text: str) -> bool:
+        # returns False once the cap is reached, the caller can stop reading
+        if self.truncated:
+            return False
+        if self.size + len(text) > self.limit:
+            text = text[:self.limit - self.size]
+            self.truncated = True
+        self.pieces.append(text)
+        self.size += len(text)
+        if len(self.pieces) >= MERGE_PIECES:
+            self.chunks.append(''.join(self.pieces))
+            self.pieces.clear()
+        return not self.truncated
+
+    def getvalue(self) -> str:
+        self.chunks.append(''.join(self.pieces))
+        self.pieces.clear()
+        self.chunks = [''.join(self.chunks)]
+        return self.chunks[0]
+
+    @property
+    def finish_reason(self) -> str:
+        return 'length' if self.truncated else 'stop'
+
+
+def cap_parts(parts: list, limit: int = MAX_RESPONSE_CHARS) -> Tuple[list, str]:
+    # applies the same cap to the final parts of a cumulative (chatgpt) response, in place
+    finish_reason = 'stop'
+    remaining = limit
+    for i, part in enumerate(parts):
+        if len(part) > remaining:
+            parts[i] = part = part[:remaining]
+            finish_reason = 'length'
+        remaining -= len(part)
+    return parts, finish_reason
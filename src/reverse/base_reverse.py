@@ -1,95 +1,637 @@
 import os
+import time
+import logging
+import dataclasses
 from abc import ABC, abstractmethod
-from typing import Iterator, Any
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, List, Optional, Protocol, Tuple
 
-import requests
+import httpx
 from starlette.responses import StreamingResponse
-from openai.types import CompletionChoice
 
+from src.reverse.admission import (ADMISSION_ACCOUNT_CONCURRENCY, AdmissionController, backend_limit,
+                                   request_priority)
+from src.reverse.aggregator import TextBuffer
+from src.reverse.credential_pool import Account, CredentialPool
+from src.reverse.hedging import Hedger, retry
+from src.reverse.prefix_index import ConversationEntry, create_prefix_index, extend, message_hasher, prefix_digests
+from src.reverse.profiler import request_profile
+from src.reverse.proxy_pool import get_proxy_pool
+from src.reverse.recording import get_recorder
+from src.reverse.metrics import BYTES, FRAMES, OUTPUT_CHARS, OUTPUT_CHARS_PER_SECOND, PHASE_SECONDS, REQUESTS
+from src.reverse.sse_codec import (Choice, ChatChunkEncoder, CompletionChunkEncoder, DONE_EVENT, build_chat_completion,
+                                   build_completion)
+from src.reverse.shared_store import get_shared_store
+from src.reverse.stream_merge import FlushPolicy, merge_frames, stream_flush_policy
+from src.reverse.transport import get_transport, iter_lines, shielded
 
-class NewCompletionChoice(CompletionChoice):
-    finish_reason: Any = None
+logger = logging.getLogger(__name__)
+
+DONE_EVENT_BYTES = DONE_EVENT.encode('utf-8')
+
+# smoothing factor of the average upstream stream duration
+STREAM_TIME_ALPHA = 0.1
+
+# (completion id, model, choices) of one upstream frame
+Frame = Tuple[str, str, List[Choice]]
+
+
+@dataclass
+class CompletionResult:
+    # a complete answer, independent of the endpoint and stream mode it is returned in
+    id: str
+    model: str
+    texts: List[str]
+    finish_reason: Optional[str] = 'stop'
+
+    def to_dict(self, is_chat: bool = False) -> dict:
+        build = build_chat_completion if is_chat else build_completion
+        return build(self.id, self.model, self.texts, self.finish_reason)
+
+    def to_stream(self, is_chat: bool = False) -> List[bytes]:
+        encoder_class = ChatChunkEncoder if is_chat else CompletionChunkEncoder
+        choices = [(i, text, self.finish_reason) for i, text in enumerate(self.texts)]
+        return [encoder_class(self.id, self.model).encode(choices).encode('utf-8'), DONE_EVENT_BYTES]
+
+
+class ResultBuilder:
+    """
+    Assembles the CompletionResult of a stream from its frames.
+    """
+
+    def __init__(self):
+        self.completion_id = None
+        self.model = None
+        self.buffers = {}
+        self.finish_reason = None
+
+    def add(self, frame: Frame):
+        self.completion_id, self.model, choices = frame
+        for index, text, finish_reason in choices:
+            if index not in self.buffers:
+                self.buffers[index] = TextBuffer()
+            self.buffers[index].append(text)
+            self.finish_reason = finish_reason or self.finish_reason
+
+    def result(self) -> Optional[CompletionResult]:
+        if not self.buffers:
+            return None
+        buffers = [self.buffers[i] for i in sorted(self.buffers)]
+        finish_reason = self.finish_reason
+        if any(buffer.truncated for buffer in buffers):
+            finish_reason = 'length'
+        return CompletionResult(self.completion_id, self.model, [buffer.getvalue() for buffer in buffers],
+                                finish_reason)
+
+
+async def encode_stream(frames: AsyncIterator[Frame], is_chat: bool = False, on_result: Callable = None,
+                        policy: FlushPolicy = None) -> AsyncIterator[bytes]:
+    # on_result is only called when the stream ran to its end, with a policy frames are merged, see merge_frames
+    encoder_class = ChatChunkEncoder if is_chat else CompletionChunkEncoder
+    encoder = None
+    builder = ResultBuilder() if on_result is not None else None
+    profile = request_profile.get()
+    if policy is not None:
+        frames = merge_frames(frames, policy)
+    try:
+        async for frame in frames:
+            start = time.perf_counter()
+            c_id, model, choices = frame
+            if encoder is None or encoder.c_id != c_id or encoder.model != model:
+                encoder = encoder_class(c_id, model)
+            data = encoder.encode(choices).encode('utf-8')
+            if profile is not None:
+                profile.serialized(time.perf_counter() - start, len(data))
+            yield data
+            if builder is not None:
+                builder.add(frame)
+    finally:
+        if policy is not None:
+            await shielded(frames.aclose())
+    yield DONE_EVENT_BYTES
+    if builder is not None:
+        on_result(builder.result())
+
+
+@dataclass
+class RequestContext:
+    # per-request state, the reverse instance itself is shared between concurrent requests
+    headers: dict
+    proxy: dict
+    account: Optional[Account] = None
+    conversation_id: Optional[str] = None
+    completion_id: Optional[str] = None
+    model: Optional[str] = None
+    start_time: float = field(default_factory=time.perf_counter)
+    ttfb: Optional[float] = None
+    bytes_in: int = 0
+    bytes_out: int = 0
+    status: Optional[int] = None
+    error: bool = False
+    # connection level failure, counted against the egress proxy rather than the account
+    transport_error: bool = False
+    # the upstream rejected metadata cached for the account (e.g. claude's organization) that is rediscovered next
+    metadata_refreshed: bool = False
+    admitted: bool = False
+    queue_wait: float = 0.0
+    # seconds spent in each phase of the request, see record_metrics
+    timings: dict = field(default_factory=dict)
+    first_token: Optional[float] = None
+    frames: int = 0
+    chars_out: int = 0
+    finished: bool = False
+    extra: dict = field(default_factory=dict)
+
+    def adopt(self, other: 'RequestContext'):
+        # takes over the upstream request of a hedge, the admission slot and start time stay with this context
+        for name in ('headers', 'proxy', 'account', 'conversation_id', 'status', 'error', 'transport_error',
+                     'metadata_refreshed', 'timings', 'extra'):
+            setattr(self, name, getattr(other, name))
+        if other.ttfb is not None:
+            self.ttfb = other.ttfb + other.start_time - self.start_time
+
+
+class Upstream(Protocol):
+    """
+    Something requests are run on: a backend itself, or a model route choosing between backends.
+    start returns the backend that took the request with its context and upstream lines.
+    """
+
+    async def start(self, messages: list) -> Tuple['BaseReverse', RequestContext, AsyncIterator[bytes]]:
+        ...
+
+    async def run_result(self, messages: list) -> Optional[CompletionResult]:
+        ...
+
+    async def do_run(self, messages: list, is_stream: bool = False, is_chat: bool = False,
+                     on_result: Callable = None):
+        ...
 
 
 class BaseReverse(ABC):
-    type: str = None
+    llm_type: str = None
 
     def __init__(self):
         self.headers = self.get_base_headers()
         self.proxy = self.get_proxy_info()
+        self.proxy_pool = get_proxy_pool(self.proxy)
+        self.accounts = CredentialPool(self.llm_type, self.get_credentials(), ADMISSION_ACCOUNT_CONCURRENCY,
+                                       get_shared_store())
+        self.admission = AdmissionController(self.llm_type, backend_limit(len(self.accounts)))
+        self.hedger = Hedger(self.llm_type)
+        self.prefix_index = create_prefix_index(self.release_conversation)
+        self.aborted_streams = 0
+        self.reclaimed_seconds = 0.0
+        self.stream_seconds_ewma = None
+
+    def new_context(self, prefer: Account = None, exclude: tuple = ()) -> RequestContext:
+        return self.account_context(self.accounts.acquire(exclude, prefer))
+
+    def account_context(self, account: Account) -> RequestContext:
+        headers = dict(self.headers)
+        headers.update(self.get_auth_headers(account.credential))
+        proxy = self.proxy
+        if self.proxy_pool is not None:
+            proxy = self.proxy_pool.acquire(account).proxies
+        return RequestContext(headers=headers, proxy=proxy, account=account)
+
+    def account_proxy(self, account: Account) -> dict:
+        # egress of the requests an account makes outside a conversation, e.g. its sentinel token
+        if self.proxy_pool is None:
+            return self.proxy
+        return self.proxy_pool.for_account(account).proxies
+
+    async def acquire_context(self, prefer: Account = None) -> RequestContext:
+        # waits for a free slot of the backend, then picks an account
+        queue_wait = await self.admission.acquire(request_priority.get())
+        try:
+            ctx = self.new_context(prefer)
+        except Exception:
+            self.admission.release()
+            raise
+        ctx.admitted = True
+        ctx.queue_wait = queue_wait
+        return ctx
+
+    def hedge_context(self, ctx: RequestContext) -> Optional[RequestContext]:
+        # a hedge needs a free slot and another healthy account, one on the same account and egress
+        # would only double the load that made it slow
+        if not self.admission.has_room():
+            return None
+        account = self.accounts.acquire_spare(exclude=(ctx.account,))
+        if account is None:
+            return None
+        # nothing ran since has_room, so the slot is still free
+        self.admission.try_acquire()
+        hedge_ctx = self.account_context(account)
+        hedge_ctx.admitted = True
+        return hedge_ctx
+
+    async def finish_context(self, ctx: RequestContext):
+        if ctx.finished:
+            return
+        ctx.finished = True
+        try:
+            await self.rev_exec_after(ctx)
+        finally:
+            self.accounts.release(ctx.account, latency=ctx.ttfb, status=ctx.status, error=ctx.error,
+                                  metadata_refreshed=ctx.metadata_refreshed)
+            if self.proxy_pool is not None:
+                self.proxy_pool.release(ctx.proxy, failed=ctx.transport_error)
+            if ctx.admitted:
+                self.admission.release(time.perf_counter() - ctx.start_time)
+            self.record_metrics(ctx)
+            profile = request_profile.get()
+            if profile is not None:
+                profile.add_context(self.llm_type, ctx)
+
+    def record_metrics(self, ctx: RequestContext):
+        # everything is collected on the context and flushed once, the stream loop only adds to integers
+        total = time.perf_counter() - ctx.start_time
+        account = ctx.account.name if ctx.account else ''
+        labels = (self.llm_type, account)
+        status = ctx.status or ('error' if ctx.error else 'ok')
+        REQUESTS.inc(labels + (str(status),))
+        timings = dict(ctx.timings)
+        timings['total'] = total
+        if ctx.admitted:
+            timings['queue'] = ctx.queue_wait
+        if ctx.first_token is not None:
+            timings['first_token'] = ctx.first_token
+        for phase, seconds in timings.items():
+            PHASE_SECONDS.observe(labels + (phase,), seconds)
+        if ctx.frames:
+            FRAMES.inc(labels, ctx.frames)
+        if ctx.chars_out:
+            OUTPUT_CHARS.inc(labels, ctx.chars_out)
+            generation = total - (ctx.ttfb or 0.0)
+            if generation > 0:
+                OUTPUT_CHARS_PER_SECOND.observe(labels, ctx.chars_out / generation)
+        BYTES.inc(labels + ('in',), ctx.bytes_in)
+        BYTES.inc(labels + ('out',), ctx.bytes_out)
+
+    async def warmup(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
 
     @abstractmethod
     def get_base_headers(self) -> dict:
         raise NotImplementedError
 
     @abstractmethod
-    def generate_request_body(self, messages: list) -> dict:
+    def get_credentials(self) -> list:
         raise NotImplementedError
 
     @abstractmethod
-    def rev_exec_before(self):
+    def get_auth_headers(self, credential) -> dict:
         raise NotImplementedError
 
     @abstractmethod
-    def rev_exec(self, body: dict):
+    def generate_request_body(self, messages: list) -> dict:
         raise NotImplementedError
 
     @abstractmethod
-    def rev_exec_after(self):
+    async def rev_exec_before(self, ctx: RequestContext):
         raise NotImplementedError
 
     @abstractmethod
-    async def to_openai_async_iterator(self, chunks: Iterator):
+    async def rev_exec(self, ctx: RequestContext, body: dict):
         raise NotImplementedError
 
     @abstractmethod
-    async def to_openai_chat_async_iterator(self, chunks: Iterator):
+    async def rev_exec_after(self, ctx: RequestContext):
         raise NotImplementedError
 
     @abstractmethod
-    def to_openai_nostream_content(self, chunks: Iterator):
+    async def iter_deltas(self, ctx: RequestContext, chunks: AsyncIterator) -> AsyncIterator[List[Choice]]:
+        # yields the new choices of every upstream frame and sets ctx.completion_id / ctx.model
         raise NotImplementedError
 
     @abstractmethod
-    def to_openai_chat_nostream_content(self, chunks: Iterator):
+    async def collect(self, ctx: RequestContext, chunks: AsyncIterator) -> Optional[CompletionResult]:
         raise NotImplementedError
 
-    def to_openai_response(self, chunks, is_stream: bool = False, is_chat: bool = False):
-        if is_chat and is_stream:
-            media_type = "text/event-stream"
-            async_iter = self.to_openai_chat_async_iterator(chunks)
-            return StreamingResponse(async_iter, media_type=media_type)
-        elif is_chat and not is_stream:
-            return self.to_openai_chat_nostream_content(chunks)
-        elif not is_chat and is_stream:
-            media_type = "text/event-stream"
-            async_iter = self.to_openai_async_iterator(chunks)
-            return StreamingResponse(async_iter, media_type=media_type)
-        elif not is_chat and not is_stream:
-            return self.to_openai_nostream_content(chunks)
-        raise Exception("Illegal parameter")
+    async def iter_frames(self, ctx: RequestContext, chunks: AsyncIterator) -> AsyncIterator[Frame]:
+        completed = False
+        # the answer as streamed is what the client sends back as history in its next turn
+        answer = message_hasher('assistant') if 'history' in ctx.extra else None
+        finish_reason = None
+        single = True
+        profile = request_profile.get()
+        if profile is not None:
+            profile.join()
+        try:
+            async for choices in self.iter_deltas(ctx, chunks):
+                ctx.frames += 1
+                chars = 0
+                for choice in choices:
+                    chars += len(choice[1])
+                if chars and ctx.first_token is None:
+                    ctx.first_token = time.perf_counter() - ctx.start_time
+                ctx.chars_out += chars
+                if profile is not None:
+                    profile.frame(self.llm_type, chars)
+                if answer is not None:
+                    for index, text, reason in choices:
+                        answer.update(text.encode('utf-8'))
+                        finish_reason = reason or finish_reason
+                        single = single and index == 0
+                yield ctx.completion_id, ctx.model, choices
+            completed = True
+            self.record_stream_time(ctx)
+            if answer is not None and single and finish_reason == 'stop':
+                self.remember(ctx, answer.digest())
+        except Exception as e:
+            self.record_error(ctx, e)
+            raise e
+        finally:
+            if not completed and not ctx.error:
+                # closed or cancelled before the upstream finished, i.e. every reader went away
+                self.record_abort(ctx)
+            await shielded(self.close_stream(ctx, chunks))
 
-    async def do_run(self, messages: list, is_stream: bool = False, is_chat: bool = False):
+    async def close_stream(self, ctx: RequestContext, chunks: AsyncIterator):
+        # closing the lines closes the upstream response, which frees its connection
         try:
-            body = self.generate_request_body(messages)
-            self.rev_exec_before()
-            response = self.rev_exec(body)
-            return self.to_openai_response(response.iter_lines(), is_stream, is_chat)
+            await chunks.aclose()
+        finally:
+            await self.finish_context(ctx)
+
+    def record_abort(self, ctx: RequestContext):
+        elapsed = time.perf_counter() - ctx.start_time
+        self.aborted_streams += 1
+        if self.stream_seconds_ewma is not None:
+            # the rest of an average stream is upstream time no longer spent on nobody
+            self.reclaimed_seconds += max(self.stream_seconds_ewma - elapsed, 0.0)
+
+    def record_stream_time(self, ctx: RequestContext):
+        elapsed = time.perf_counter() - ctx.start_time
+        if self.stream_seconds_ewma is None:
+            self.stream_seconds_ewma = elapsed
+        else:
+            self.stream_seconds_ewma += STREAM_TIME_ALPHA * (elapsed - self.stream_seconds_ewma)
+
+    def abort_stats(self) -> dict:
+        return {
+            'aborted_streams': self.aborted_streams,
+            'reclaimed_upstream_seconds': self.reclaimed_seconds,
+            'stream_seconds_ewma': self.stream_seconds_ewma,
+        }
+
+    async def to_openai_async_iterator(self, ctx: RequestContext, chunks: AsyncIterator, is_chat: bool = False,
+                                       on_result: Callable = None,
+                                       policy: FlushPolicy = None) -> AsyncIterator[bytes]:
+        # a client disconnect cancels this generator, which closes the upstream stream in iter_frames
+        frames = self.iter_frames(ctx, chunks)
+        encoded = encode_stream(frames, is_chat, on_result, policy)
+        try:
+            async for data in encoded:
+                ctx.bytes_out += len(data)
+                yield data
+        finally:
+            # a merging stream may be reading frames in a task of its own, it is stopped first
+            await encoded.aclose()
+            await frames.aclose()
+
+    async def collect_result(self, ctx: RequestContext, chunks: AsyncIterator) -> Optional[CompletionResult]:
+        try:
+            result = await self.collect(ctx, chunks)
+            if result is not None:
+                ctx.chars_out = sum(len(text) for text in result.texts)
+                if 'history' in ctx.extra and len(result.texts) == 1 and result.finish_reason == 'stop':
+                    answer = message_hasher('assistant')
+                    answer.update(result.texts[0].encode('utf-8'))
+                    self.remember(ctx, answer.digest())
+            return result
         except Exception as e:
+            self.record_error(ctx, e)
             raise e
         finally:
-            self.rev_exec_after()
+            await shielded(self.close_stream(ctx, chunks))
 
-    def post_request(self, url, data=None, headers=None, proxies=None, **kwargs):
-        response = requests.post(url, data=data, headers=headers, proxies=proxies, **kwargs)
-        response.raise_for_status()
-        return response
+    async def start(self, messages: list) -> Tuple['BaseReverse', RequestContext, AsyncIterator[bytes]]:
+        # admits the request and opens its upstream conversation, see Upstream
+        if self.prefix_index is None:
+            ctx = await self.acquire_context()
+            return self, ctx, await self.open(ctx, messages)
+
+        digests = prefix_digests(messages)
+        entry = self.prefix_index.take(messages, digests)
+        try:
+            ctx = await self.acquire_context(entry.account if entry else None)
+        except BaseException:
+            if entry is not None:
+                self.release_conversation(entry)
+            raise
+        ctx.extra['history'] = digests[-1]
+        if entry is not None:
+            if ctx.account is entry.account:
+                ctx.extra['reuse'] = entry
+            else:
+                # the account holding the conversation is cooling down or busy
+                self.release_conversation(entry)
+        try:
+            chunks = await self.open(ctx, messages)
+        except httpx.HTTPStatusError as e:
+            if 'reuse' not in ctx.extra:
+                raise e
+            logger.info(f"continuing {self.llm_type} conversation failed, sending the whole history: {e}")
+            ctx = await self.acquire_context()
+            ctx.extra['history'] = digests[-1]
+            return self, ctx, await self.open(ctx, messages)
+        if 'reuse' in ctx.extra:
+            self.prefix_index.record_saving(messages[:entry.length])
+        return self, ctx, chunks
+
+    def remember(self, ctx: RequestContext, answer_digest: bytes):
+        # the conversation now holds the request's history plus this answer
+        if ctx.conversation_id is None:
+            return
+        ctx.extra['kept'] = True
+        self.prefix_index.put(extend(ctx.extra['history'], answer_digest), self.conversation_entry(ctx))
+
+    def conversation_entry(self, ctx: RequestContext) -> ConversationEntry:
+        return ConversationEntry(ctx.conversation_id, ctx.account, ctx.extra.get('message_id'))
+
+    def continue_conversation(self, ctx: RequestContext, body: dict, entry: ConversationEntry):
+        # turns the body of the new messages into a continuation of the entry's conversation
+        ctx.conversation_id = entry.conversation_id
+
+    def release_conversation(self, entry: ConversationEntry):
+        # an upstream conversation that won't be continued
+        pass
+
+    async def run_result(self, messages: list) -> Optional[CompletionResult]:
+        reverse, ctx, chunks = await self.start(messages)
+        return await reverse.collect_result(ctx, chunks)
+
+    async def to_openai_nostream_content(self, ctx: RequestContext, chunks: AsyncIterator, is_chat: bool = False,
+                                         on_result: Callable = None):
+        result = await self.collect_result(ctx, chunks)
+        if result is None:
+            return None
+        if on_result is not None:
+            on_result(result)
+        profile = request_profile.get()
+        if profile is None:
+            return result.to_dict(is_chat)
+        start = time.perf_counter()
+        content = result.to_dict(is_chat)
+        profile.serialized(time.perf_counter() - start, 0)
+        return content
+
+    async def to_openai_response(self, ctx: RequestContext, chunks: AsyncIterator, is_stream: bool = False,
+                                 is_chat: bool = False, on_result: Callable = None):
+        if is_stream:
+            media_type = "text/event-stream"
+            async_iter = self.to_openai_async_iterator(ctx, chunks, is_chat, on_result, stream_flush_policy.get())
+            return StreamingResponse(async_iter, media_type=media_type)
+        return await self.to_openai_nostream_content(ctx, chunks, is_chat, on_result)
+
+    async def open(self, ctx: RequestContext, messages: list) -> AsyncIterator[bytes]:
+        # runs the upstream request up to the response headers and returns its lines
+        try:
+            entry = ctx.extra.get('reuse')
+            if entry is None:
+                body = self.generate_request_body(messages)
+            else:
+                body = self.generate_request_body(messages[entry.length:])
+                self.continue_conversation(ctx, body, entry)
+            # a continuation is bound to its account, so it isn't hedged on another one
+            if self.hedger.enabled and entry is None:
+                return await self.open_hedged(ctx, body)
+            response = await self.send(ctx, body)
+        except BaseException as e:
+            # cancelled too, e.g. by a route giving up on a slow backend
+            if isinstance(e, Exception):
+                self.record_error(ctx, e)
+            await shielded(self.finish_context(ctx))
+            raise e
+        return self.iter_response(ctx, response)
 
-    def get_request(self, url, params=None, headers=None, proxies=None, **kwargs):
-        response = requests.get(url, params=params, headers=headers, proxies=proxies, **kwargs)
-        response.raise_for_status()
+    async def send(self, ctx: RequestContext, body: dict):
+        start = time.perf_counter()
+        # nothing was sent to the upstream conversation yet, so failures here are retried
+        await retry(lambda: self.rev_exec_before(ctx))
+        exec_start = time.perf_counter()
+        ctx.timings['before'] = exec_start - start
+        response = await self.rev_exec(ctx, body)
+        now = time.perf_counter()
+        # rev_exec may record its own setup phases (e.g. claude's new chat), the rest is waiting for the upstream
+        ctx.timings['upstream_ttfb'] = now - exec_start - sum(
+            seconds for phase, seconds in ctx.timings.items() if phase != 'before')
+        ctx.ttfb = now - ctx.start_time
         return response
 
+    async def send_first_line(self, ctx: RequestContext, body: dict):
+        # returns the lines of the response and its first one, None when the answer was empty
+        lines = self.response_lines(ctx, await self.send(ctx, body))
+        try:
+            return lines, await lines.__anext__()
+        except StopAsyncIteration:
+            return lines, None
+        except BaseException:
+            await shielded(lines.aclose())
+            raise
+
+    async def open_hedged(self, ctx: RequestContext, body: dict) -> AsyncIterator[bytes]:
+        # a request whose first line is late gets a duplicate on another account, the slower one is cancelled
+        hedge_ctx = None
+
+        async def attempt(attempt_ctx: RequestContext):
+            try:
+                return await self.send_first_line(attempt_ctx, body)
+            except Exception as e:
+                self.record_error(attempt_ctx, e)
+                raise e
+
+        def hedge():
+            nonlocal hedge_ctx
+            hedge_ctx = self.hedge_context(ctx)
+            if hedge_ctx is None:
+                return None
+            if 'history' in ctx.extra:
+                hedge_ctx.extra['history'] = ctx.extra['history']
+            return attempt(hedge_ctx)
+
+        async def discard(result):
+            await result[0].aclose()
+
+        try:
+            winner, (lines, first) = await self.hedger.run(lambda: attempt(ctx), hedge, discard)
+            if winner == 1:
+                # the loser gives back the slot the hedge was admitted with
+                loser = dataclasses.replace(ctx, admitted=hedge_ctx.admitted, finished=False)
+                ctx.adopt(hedge_ctx)
+                hedge_ctx = loser
+        finally:
+            if hedge_ctx is not None:
+                await shielded(self.finish_context(hedge_ctx))
+        return self.count_lines(ctx, lines, first)
+
+    async def do_run(self, messages: list, is_stream: bool = False, is_chat: bool = False,
+                     on_result: Callable = None):
+        # on_result receives the CompletionResult once the answer is complete
+        reverse, ctx, chunks = await self.start(messages)
+        return await reverse.to_openai_response(ctx, chunks, is_stream, is_chat, on_result)
+
+    def iter_response(self, ctx: RequestContext, response) -> AsyncIterator[bytes]:
+        return self.count_lines(ctx, self.response_lines(ctx, response))
+
+    def response_lines(self, ctx: RequestContext, response) -> AsyncIterator[bytes]:
+        # the raw lines of what rev_exec returned, copied to the recording when UPSTREAM_RECORD_PATH is set
+        lines = iter_lines(response)
+        recorder = get_recorder()
+        if recorder is not None:
+            lines = recorder.tap(self.llm_type, ctx, lines)
+        return lines
+
+    async def count_lines(self, ctx: RequestContext, lines: AsyncIterator[bytes],
+                          first: Optional[bytes] = None) -> AsyncIterator[bytes]:
+        # first is a line already read from lines, e.g. while hedging
+        try:
+            if first is not None:
+                ctx.bytes_in += len(first)
+                yield first
+            async for line in lines:
+                ctx.bytes_in += len(line)
+                yield line
+        finally:
+            await lines.aclose()
+
+    @staticmethod
+    def mark_finished(ctx: RequestContext):
+        # the converter read the upstream's finish frame, so the answer is whole even if the lines are closed
+        # before their end. kept in extra, which a context shares with a hedge it adopted
+        ctx.extra['upstream_finished'] = True
+
+    @staticmethod
+    def record_error(ctx: RequestContext, e: Exception):
+        ctx.error = True
+        if isinstance(e, httpx.HTTPStatusError):
+            ctx.status = e.response.status_code
+            ctx.metadata_refreshed = getattr(e, 'metadata_refreshed', False)
+        elif isinstance(e, httpx.TransportError):
+            ctx.transport_error = True
+
+    async def post_request(self, url, data=None, headers=None, proxies=None, **kwargs):
+        return await get_transport().request('POST', url, data=data, headers=headers, proxies=proxies, **kwargs)
+
+    async def get_request(self, url, params=None, headers=None, proxies=None, **kwargs):
+        return await get_transport().request('GET', url, params=params, headers=headers, proxies=proxies, **kwargs)
+
+    async def delete_request(self, url, headers=None, proxies=None, **kwargs):
+        return await get_transport().request('DELETE', url, headers=headers, proxies=proxies, **kwargs)
+
+    async def stream_request(self, method, url, headers=None, proxies=None, **kwargs):
+        # the response body is not read here, iterate it with iter_lines
+        return await get_transport().stream(method, url, headers=headers, proxies=proxies, **kwargs)
+
     def get_proxy_info(self):
         proxy = {}
         enable = os.environ.get('PROXY_ENABLE', 'false')
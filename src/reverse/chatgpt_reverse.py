@@ -1,36 +1,41 @@
 import os
 import uuid
-import json
-import time
+import asyncio
+import logging
 from abc import ABC
-from typing import Iterator, AsyncIterator
+from typing import AsyncIterator, Optional
 
 from dotenv import load_dotenv
-from openai.types import Completion
-from openai.types.chat import ChatCompletion, ChatCompletionChunk
-from openai.types.chat.chat_completion_chunk import Choice as ChatChunkChoice
-from openai.types.chat.chat_completion_chunk import ChoiceDelta
-from openai.types.chat.chat_completion import Choice as ChatChoice
-from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
-from src.reverse.base_reverse import BaseReverse, NewCompletionChoice
+from src.reverse.aggregator import cap_parts
+from src.reverse.base_reverse import BaseReverse, CompletionResult, RequestContext
+from src.reverse.credential_pool import Account, split_credentials
+from src.reverse.delta_engine import PartsDeltaEngine
+from src.reverse.prefix_index import ConversationEntry
+from src.reverse.sse_codec import DATA_PREFIX, DONE_LINE, data_payload, loads, loads_large
+from src.reverse.shared_store import get_shared_store
+from src.reverse.token_manager import TokenManager
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-BASE_URL = "https://chat.openai.com"
+# can point at a local stand-in, see benchmark/fake_upstream.py
+BASE_URL = os.environ.get('CHATGPT_BASE_URL') or "https://chat.openai.com"
 CHAT_URL = f"{BASE_URL}/backend-anon/conversation"
 SESSION_URL = f"{BASE_URL}/backend-anon/sentinel/chat-requirements"
 
 REFRESH_INTERVAL = int(os.environ.get('REFRESH_INTERVAL', 60))
+SENTINEL_POOL_SIZE = int(os.environ.get('SENTINEL_POOL_SIZE', 2))
+SENTINEL_REFRESH_AHEAD = float(os.environ.get('SENTINEL_REFRESH_AHEAD', 10))
+SENTINEL_IDLE_TIMEOUT = float(os.environ.get('SENTINEL_IDLE_TIMEOUT', 600))
+
+FINISHED_MARK = b'finished_successfully'
 
 
 class ChatGPTReverse(BaseReverse, ABC):
     llm_type = 'chatgpt'
 
-    def __init__(self):
-        self.token_tuple = (None, 0)
-        super().__init__()
-
     def get_base_headers(self):
         base_headers = {
             "content-type": "application/json",
@@ -38,11 +43,58 @@ class ChatGPTReverse(BaseReverse, ABC):
             "sec-ch-ua": '"Google Chrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"',
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
         }
-        chatgpt_access_token = os.environ.get('CHATGPT_ACCESS_TOKEN')
-        if chatgpt_access_token:
-            base_headers['Authorization'] = f"Bearer {chatgpt_access_token}"
         return base_headers
 
+    def get_credentials(self) -> list:
+        return split_credentials(os.environ.get('CHATGPT_ACCESS_TOKEN'))
+
+    def get_auth_headers(self, credential) -> dict:
+        if credential:
+            return {'Authorization': f"Bearer {credential}"}
+        return {}
+
+    def __init__(self):
+        super().__init__()
+        self.delta_stats = dict.fromkeys(
+            ('streams', 'frames', 'decoded_frames', 'skipped_frames', 'rewrites', 'bytes_in', 'bytes_out'), 0)
+
+    def get_token_manager(self, account: Account) -> TokenManager:
+        token_manager = account.cache.get('token_manager')
+        if token_manager is None:
+            headers = dict(self.headers)
+            headers.update(self.get_auth_headers(account.credential))
+
+            async def fetch_chat_token():
+                res = await self.post_request(SESSION_URL, data={}, headers=headers,
+                                              proxies=self.account_proxy(account))
+                return res.json()['token']
+
+            token_manager = TokenManager(fetch_chat_token, ttl=REFRESH_INTERVAL, pool_size=SENTINEL_POOL_SIZE,
+                                         refresh_ahead=SENTINEL_REFRESH_AHEAD, idle_timeout=SENTINEL_IDLE_TIMEOUT,
+                                         name=f"{account.name} sentinel token", store=get_shared_store(),
+                                         store_key=account.key)
+            account.cache['token_manager'] = token_manager
+        return token_manager
+
+    async def warmup(self):
+        await asyncio.gather(*(self.get_token_manager(account).get_token() for account in self.accounts.accounts))
+
+    async def shutdown(self):
+        for account in self.accounts.accounts:
+            token_manager = account.cache.get('token_manager')
+            if token_manager:
+                await token_manager.stop()
+
+    def stats(self) -> dict:
+        accounts = []
+        for account in self.accounts.accounts:
+            account_stats = account.stats()
+            token_manager = account.cache.get('token_manager')
+            if token_manager:
+                account_stats['sentinel_token'] = token_manager.stats()
+            accounts.append(account_stats)
+        return {'accounts': accounts, 'stream_deltas': self.delta_stats}
+
     def generate_request_body(self, messages: list):
         body = {
             "action": "next",
@@ -57,152 +109,110 @@ class ChatGPTReverse(BaseReverse, ABC):
         }
         return body
 
-    def rev_exec_before(self):
-        # get and refresh chat token
-        cur_time = int(time.time())
-        if cur_time - self.token_tuple[1] > REFRESH_INTERVAL:
-            res = self.post_request(SESSION_URL, data={}, headers=self.get_base_headers(), proxies=self.proxy)
-            token = res.json()['token']
-            self.token_tuple = (token, cur_time)
-            self.headers['Openai-Sentinel-Chat-Requirements-Token'] = self.token_tuple[0]
-
-    def rev_exec(self, body: dict):
-        response = self.post_request(CHAT_URL, json=body, headers=self.headers, proxies=self.proxy)
-        return response
+    def continue_conversation(self, ctx: RequestContext, body: dict, entry: ConversationEntry):
+        super().continue_conversation(ctx, body, entry)
+        body['conversation_id'] = entry.conversation_id
+        body['parent_message_id'] = entry.message_id
 
-    def rev_exec_after(self):
-        pass
+    async def rev_exec_before(self, ctx: RequestContext):
+        # chat token is renewed in the background, this only waits when the pool is empty
+        token_manager = self.get_token_manager(ctx.account)
+        ctx.headers['Openai-Sentinel-Chat-Requirements-Token'] = await token_manager.get_token()
 
-    async def to_openai_async_iterator(self, chunks: Iterator) -> AsyncIterator:
-        c_id = f"chatcmpl-{str(uuid.uuid4())}"
-
-        per_parts = []
-
-        for chunk in chunks:
-            if not chunk:
-                continue
-            if chunk == b'data: [DONE]':
-                yield "data: [DONE]\n"
-                continue
-            json_data = json.loads(chunk[len("data:"):])
-
-            role = json_data['message']['author']['role']
-            if role != "assistant":
-                continue
-
-            finish_reason = None
-            if json_data['message']['status'] == 'finished_successfully':
-                finish_reason = 'stop'
-
-            choices = []
-            parts = json_data['message']['content']['parts']
-            for i, p in enumerate(parts):
-
-                parts_len = len(per_parts)
-                if parts_len > i:
-                    p = p[len(per_parts[i]):]
-
-                choice = NewCompletionChoice(index=i, text=p, finish_reason=finish_reason)
-                choices.append(choice)
-            per_parts = parts
-
-            completion = Completion(
-                id=c_id,
-                created=int(time.time()),
-                choices=choices,
-                model='gpt-3.5-turbo',
-                object='text_completion'
-            )
-            yield f"data: {completion.model_dump_json(exclude_unset=True)}\n"
-
-    def to_openai_nostream_content(self, chunks: Iterator):
-        c_id = f"chatcmpl-{str(uuid.uuid4())}"
+    async def rev_exec(self, ctx: RequestContext, body: dict):
+        response = await self.stream_request('POST', CHAT_URL, json=body, headers=ctx.headers, proxies=ctx.proxy)
+        return response
 
-        for chunk in chunks:
-            if not chunk or chunk == b'data: [DONE]':
+    async def rev_exec_after(self, ctx: RequestContext):
+        engine = ctx.extra.get('delta_engine')
+        if engine is not None:
+            engine.add_output(ctx.bytes_out)
+            self.record_stream_stats(engine)
+
+    @staticmethod
+    def new_completion_id() -> str:
+        return f"chatcmpl-{str(uuid.uuid4())}"
+
+    @staticmethod
+    def record_conversation(ctx: RequestContext, json_data: dict):
+        # the finished answer is where a follow-up turn continues, see continue_conversation
+        ctx.conversation_id = json_data.get('conversation_id')
+        ctx.extra['message_id'] = json_data['message']['id']
+
+    async def iter_part_deltas(self, ctx: RequestContext, chunks: AsyncIterator,
+                               engine: PartsDeltaEngine) -> AsyncIterator:
+        # yields (deltas, finished) for every decoded assistant frame
+        async for chunk in chunks:
+            if not chunk or chunk == DONE_LINE:
                 continue
-            json_data = json.loads(chunk[len("data:"):])
-            role = json_data['message']['author']['role']
-            if role != "assistant":
+            payload = data_payload(chunk)
+            if payload is None:
                 continue
-            if json_data['message']['status'] == 'finished_successfully':
-                choices = []
-                parts = json_data['message']['content']['parts']
-                for i, p in enumerate(parts):
-                    choice = NewCompletionChoice(index=i, text=p, finish_reason='stop')
-                    choices.append(choice)
-
-                completion = Completion(
-                    id=c_id,
-                    created=int(time.time()),
-                    choices=choices,
-                    model='gpt-3.5-turbo',
-                    object='text_completion'
-                )
-                return completion.model_dump(exclude_unset=True)
-        return None
-
-    async def to_openai_chat_async_iterator(self, chunks: Iterator) -> AsyncIterator:
-        c_id = f"chatcmpl-{str(uuid.uuid4())}"
-        per_parts = []
-        for chunk in chunks:
-            if not chunk:
+            if not engine.should_decode(payload, final=FINISHED_MARK in payload):
                 continue
-            if chunk == b'data: [DONE]':
-                yield "data: [DONE]\n"
+            frame = self.decode_parts_frame(ctx, engine, payload)
+            if frame is not None:
+                yield frame
+        # the text of a skipped last frame is only in that frame
+        payload = engine.take_pending()
+        if payload is not None:
+            frame = self.decode_parts_frame(ctx, engine, payload)
+            if frame is not None:
+                yield frame
+
+    def decode_parts_frame(self, ctx: RequestContext, engine: PartsDeltaEngine, payload: bytes):
+        json_data = loads(payload)
+        message = json_data['message']
+        if message['author']['role'] != "assistant":
+            return None
+
+        deltas = engine.feed(message['content']['parts'], payload)
+        finished = message['status'] == 'finished_successfully'
+        if finished:
+            self.mark_finished(ctx)
+            self.record_conversation(ctx, json_data)
+        return deltas, finished
+
+    async def iter_deltas(self, ctx: RequestContext, chunks: AsyncIterator) -> AsyncIterator:
+        ctx.completion_id = self.new_completion_id()
+        ctx.model = 'gpt-3.5-turbo'
+        engine = ctx.extra['delta_engine'] = PartsDeltaEngine()
+        async for deltas, finished in self.iter_part_deltas(ctx, chunks, engine):
+            finish_reason = 'stop' if finished else None
+            # only new text is sent, except the last frame which carries the finish reason
+            choices = [(i, delta, finish_reason) for i, delta in deltas if delta or finished]
+            if choices:
+                yield choices
+
+    def record_stream_stats(self, engine: PartsDeltaEngine):
+        stream_stats = engine.stats()
+        logger.debug(f"chatgpt stream stats: {stream_stats}")
+        self.delta_stats['streams'] += 1
+        for key in ('frames', 'decoded_frames', 'skipped_frames', 'rewrites', 'bytes_in', 'bytes_out'):
+            self.delta_stats[key] += stream_stats[key]
+
+    async def collect_final_parts(self, ctx: RequestContext, chunks: AsyncIterator):
+        # only the finished frame matters, the intermediate cumulative frames are never decoded
+        async for chunk in chunks:
+            if not chunk or chunk == DONE_LINE:
                 continue
-            json_data = json.loads(chunk[len("data:"):])
-
-            role = json_data['message']['author']['role']
-            if role != "assistant":
-                continue
-
-            choices = []
-            parts = json_data['message']['content']['parts']
-            for i, p in enumerate(parts):
-                parts_len = len(per_parts)
-                if parts_len > i:
-                    p = p[len(per_parts[i]):]
-                delta = ChoiceDelta(role='assistant', content=p)
-                if json_data['message']['status'] == 'finished_successfully':
-                    choice = ChatChunkChoice(index=i, delta=delta)
-                else:
-                    choice = ChatChunkChoice(index=i, delta=delta, finish_reason='stop')
-                choices.append(choice)
-            per_parts = parts
-
-            completion = ChatCompletionChunk(
-                id=c_id,
-                created=int(time.time()),
-                choices=choices,
-                model='gpt-3.5-turbo',
-                object='chat.completion.chunk'
-            )
-            yield f"data: {completion.model_dump_json(exclude_unset=True)}\n"
-
-    def to_openai_chat_nostream_content(self, chunks: Iterator):
-        c_id = f"chatcmpl-{str(uuid.uuid4())}"
-        for chunk in chunks:
-            if not chunk or chunk == b'data: [DONE]':
+            if not chunk.startswith(DATA_PREFIX) or FINISHED_MARK not in chunk:
                 continue
-            json_data = json.loads(chunk[len("data:"):])
-            role = json_data['message']['author']['role']
-            if role != "assistant":
+            # the finished frame carries the whole answer, decode it without any extra copy of it
+            json_data = loads_large(chunk)
+            message = json_data['message']
+            if message['author']['role'] != "assistant":
                 continue
-            if json_data['message']['status'] == 'finished_successfully':
-                choices = []
-                parts = json_data['message']['content']['parts']
-                for i, p in enumerate(parts):
-                    chat_msg = ChatCompletionMessage(role='assistant', content=p)
-                    choice = ChatChoice(index=i, message=chat_msg, finish_reason='stop')
-                    choices.append(choice)
-
-                completion = ChatCompletion(
-                    id=c_id,
-                    created=int(time.time()),
-                    choices=choices,
-                    model='gpt-3.5-turbo',
-                    object='chat.completion'
-                )
-                return completion.model_dump(exclude_unset=True)
-        return None
+            if message['status'] == 'finished_successfully':
+                self.mark_finished(ctx)
+                self.record_conversation(ctx, json_data)
+                return cap_parts(message['content']['parts'])
+        return None, None
+
+    async def collect(self, ctx: RequestContext, chunks: AsyncIterator) -> Optional[CompletionResult]:
+        ctx.completion_id = self.new_completion_id()
+        ctx.model = 'gpt-3.5-turbo'
+        parts, finish_reason = await self.collect_final_parts(ctx, chunks)
+        if parts is None:
+            return None
+        return CompletionResult(ctx.completion_id, ctx.model, parts, finish_reason)
@@ -1,35 +1,89 @@
 import os
-import uuid
-import json
 import time
+import uuid
+import asyncio
+import logging
 from abc import ABC
-from typing import Iterator
+from typing import AsyncIterator, Optional
 
+import httpx
 from dotenv import load_dotenv
-from openai.types import Completion
-from openai.types.chat import ChatCompletion, ChatCompletionChunk
-from openai.types.chat.chat_completion_chunk import Choice as ChatChunkChoice
-from openai.types.chat.chat_completion_chunk import ChoiceDelta
-from openai.types.chat.chat_completion import Choice as ChatChoice
-from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
-from src.reverse.base_reverse import BaseReverse, NewCompletionChoice
+from src.reverse.aggregator import TextBuffer
+from src.reverse.base_reverse import BaseReverse, CompletionResult, RequestContext
+from src.reverse.conversation_pool import ConversationPool, ConversationReaper
+from src.reverse.credential_pool import Account, split_credentials
+from src.reverse.hedging import retry
+from src.reverse.metadata_cache import MetadataCache
+from src.reverse.prefix_index import ConversationEntry
+from src.reverse.sse_codec import DATA_PREFIX, data_payload, loads, loads_data
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-BASE_URL = "https://claude.ai"
+# can point at a local stand-in, see benchmark/fake_upstream.py
+BASE_URL = os.environ.get('CLAUDE_BASE_URL') or "https://claude.ai"
 ORGANIZATION_URL = f"{BASE_URL}/api/organizations"
 NEW_CHAT_URL = "{BASE_URL}/api/organizations/{organization_id}/chat_conversations"
 CHAT_URL = "{BASE_URL}/api/organizations/{organization_id}/chat_conversations/{chat_id}/completion"
+DELETE_CHAT_URL = "{BASE_URL}/api/organizations/{organization_id}/chat_conversations/{chat_id}"
+
+COMPLETION_MARK = b'"completion"'
+
+CLAUDE_METADATA_CACHE_PATH = os.environ.get('CLAUDE_METADATA_CACHE_PATH')
+CLAUDE_METADATA_TTL = float(os.environ.get('CLAUDE_METADATA_TTL', 86400))
+CLAUDE_CONVERSATION_POOL_SIZE = int(os.environ.get('CLAUDE_CONVERSATION_POOL_SIZE', 4))
+CLAUDE_CONVERSATION_REFILL_CONCURRENCY = int(os.environ.get('CLAUDE_CONVERSATION_REFILL_CONCURRENCY', 2))
+CLAUDE_CONVERSATION_MAX_AGE = float(os.environ.get('CLAUDE_CONVERSATION_MAX_AGE', 3600))
+CLAUDE_CONVERSATION_REAP = os.environ.get('CLAUDE_CONVERSATION_REAP', 'true').upper() == 'TRUE'
+CLAUDE_REAP_BATCH_SIZE = int(os.environ.get('CLAUDE_REAP_BATCH_SIZE', 20))
+CLAUDE_REAP_INTERVAL = float(os.environ.get('CLAUDE_REAP_INTERVAL', 10))
+CLAUDE_REAP_CONCURRENCY = int(os.environ.get('CLAUDE_REAP_CONCURRENCY', 4))
 
 
 class ClaudeReverse(BaseReverse, ABC):
     llm_type = 'claude'
 
-    organization_id = None
-
     def __init__(self):
         super().__init__()
+        self.metadata_cache = MetadataCache(CLAUDE_METADATA_CACHE_PATH, ttl=CLAUDE_METADATA_TTL)
+        self.reaper = ConversationReaper(self.delete_conversation, batch_size=CLAUDE_REAP_BATCH_SIZE,
+                                         interval=CLAUDE_REAP_INTERVAL, concurrency=CLAUDE_REAP_CONCURRENCY,
+                                         name='claude conversation')
+
+    async def warmup(self):
+        async def warmup_account(account):
+            organization_id = await self.get_organization_id(account)
+            self.get_conversation_pool(account, organization_id).refill()
+
+        await asyncio.gather(*(warmup_account(account) for account in self.accounts.accounts))
+
+    async def shutdown(self):
+        for account in self.accounts.accounts:
+            pool = account.cache.pop('conversation_pool', None)
+            if pool:
+                for chat_id in await pool.stop():
+                    self.reap_conversation(account, pool.organization_id, chat_id)
+        if self.prefix_index is not None:
+            for entry in self.prefix_index.clear():
+                self.release_conversation(entry)
+        await self.reaper.stop()
+
+    def stats(self) -> dict:
+        accounts = []
+        for account in self.accounts.accounts:
+            account_stats = account.stats()
+            account_stats['organization_id'] = account.cache.get('organization_id')
+            pool = account.cache.get('conversation_pool')
+            if pool:
+                account_stats['conversation_pool'] = pool.stats()
+            accounts.append(account_stats)
+        return {
+            'accounts': accounts,
+            'conversation_reaper': self.reaper.stats(),
+            'metadata_cache': self.metadata_cache.stats(),
+        }
 
     def get_base_headers(self) -> dict:
         base_headers = {
@@ -45,12 +99,16 @@ class ClaudeReverse(BaseReverse, ABC):
             "Sec-Fetch-Site": "same-origin",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
         }
-
-        claude_session_key = os.environ.get('CLAUDE_SESSION_KEY')
-        if claude_session_key:
-            base_headers['Cookie'] = f"sessionKey={claude_session_key}"
         return base_headers
 
+    def get_credentials(self) -> list:
+        return split_credentials(os.environ.get('CLAUDE_SESSION_KEY'))
+
+    def get_auth_headers(self, credential) -> dict:
+        if credential:
+            return {'Cookie': f"sessionKey={credential}"}
+        return {}
+
     def generate_request_body(self, messages: list) -> dict:
         prompt = ""
         for msg in messages:
@@ -61,144 +119,171 @@ class ClaudeReverse(BaseReverse, ABC):
         body = {"prompt": prompt, "timezone": "Asia/Shanghai", "attachments": [], "files": []}
         return body
 
-    def rev_exec_before(self):
-        if not self.organization_id:
-            headers = self.headers
-            proxy = self.proxy
-            response = self.get_request(ORGANIZATION_URL, headers=headers, proxies=proxy)
+    async def get_organization_id(self, account: Account):
+        if account.cache.get('organization_id'):
+            return account.cache['organization_id']
+        lock = account.cache.setdefault('organization_lock', asyncio.Lock())
+        async with lock:
+            if account.cache.get('organization_id'):
+                return account.cache['organization_id']
+            entry = self.metadata_cache.get(account.credential)
+            if entry:
+                account.cache['organization_id'] = entry['organization_id']
+                return entry['organization_id']
+
+            headers = dict(self.headers)
+            headers.update(self.get_auth_headers(account.credential))
+            response = await self.get_request(ORGANIZATION_URL, headers=headers, proxies=self.account_proxy(account))
             data_json = response.json()
             for msg in data_json:
                 capabilities = msg['capabilities']
                 if 'chat' in capabilities:
-                    self.organization_id = msg['uuid']
+                    account.cache['organization_id'] = msg['uuid']
+                    if account.cache.pop('organization_invalidated', False):
+                        account.cache['rediscovered_organization'] = msg['uuid']
+                    self.metadata_cache.put(account.credential, msg['uuid'], capabilities)
                     break
-
-    def rev_exec(self, body: dict):
-        new_chat_url = NEW_CHAT_URL.format(BASE_URL=BASE_URL, organization_id=self.organization_id)
-        chat_id = str(uuid.uuid4())
-        new_chat_body = {"uuid": chat_id, "name": f"api-{chat_id}"}
-        self.post_request(new_chat_url, json=new_chat_body, headers=self.headers, proxies=self.proxy)
-
-        chat_url = CHAT_URL.format(BASE_URL=BASE_URL, organization_id=self.organization_id, chat_id=chat_id)
-        response = self.post_request(chat_url, json=body, headers=self.headers, proxies=self.proxy)
+            return account.cache.get('organization_id')
+
+    async def check_organization(self, account: Account, organization_id: str, e: Exception):
+        # a cached organization the session can no longer use answers 403/404, discover it again next time
+        if not isinstance(e, httpx.HTTPStatusError) or e.response.status_code not in (403, 404):
+            return
+        if organization_id != account.cache.get('rediscovered_organization'):
+            # a cached organization going stale says nothing about the session, so the account isn't cooled down
+            # for it. one that was just discovered again and is still refused does count against the account
+            e.metadata_refreshed = True
+        if account.cache.get('organization_id') != organization_id:
+            return
+        logger.warning(f"organization of {account.name} answered {e.response.status_code}, invalidating it")
+        account.cache.pop('organization_id', None)
+        account.cache['organization_invalidated'] = True
+        self.metadata_cache.invalidate(account.credential)
+        pool = account.cache.pop('conversation_pool', None)
+        if pool:
+            # may be called from one of the pool's own refill workers, so don't wait for it here
+            asyncio.ensure_future(pool.stop())
+
+    async def rev_exec_before(self, ctx: RequestContext):
+        ctx.extra['organization_id'] = await self.get_organization_id(ctx.account)
+
+    def get_conversation_pool(self, account: Account, organization_id: str) -> ConversationPool:
+        pool = account.cache.get('conversation_pool')
+        if pool is None or pool.organization_id != organization_id:
+            headers = dict(self.headers)
+            headers.update(self.get_auth_headers(account.credential))
+
+            async def create_conversation():
+                return await self.create_conversation(account, organization_id, headers, self.account_proxy(account))
+
+            pool = ConversationPool(create_conversation, target_size=CLAUDE_CONVERSATION_POOL_SIZE,
+                                    refill_concurrency=CLAUDE_CONVERSATION_REFILL_CONCURRENCY,
+                                    max_age=CLAUDE_CONVERSATION_MAX_AGE, name=f"{account.name} conversation")
+            pool.organization_id = organization_id
+            account.cache['conversation_pool'] = pool
+        return pool
+
+    async def create_conversation(self, account: Account, organization_id: str, headers: dict, proxy: dict) -> str:
+        new_chat_url = NEW_CHAT_URL.format(BASE_URL=BASE_URL, organization_id=organization_id)
+
+        async def new_chat():
+            # a fresh uuid per attempt, an attempt that timed out may still have created its conversation
+            chat_id = str(uuid.uuid4())
+            new_chat_body = {"uuid": chat_id, "name": f"api-{chat_id}"}
+            await self.post_request(new_chat_url, json=new_chat_body, headers=headers, proxies=proxy)
+            return chat_id
+
+        try:
+            return await retry(new_chat)
+        except Exception as e:
+            await self.check_organization(account, organization_id, e)
+            raise e
+
+    def reap_conversation(self, account: Account, organization_id: str, chat_id: str):
+        if CLAUDE_CONVERSATION_REAP:
+            self.reaper.add((account, organization_id, chat_id))
+
+    async def delete_conversation(self, item):
+        account, organization_id, chat_id = item
+        headers = dict(self.headers)
+        headers.update(self.get_auth_headers(account.credential))
+        delete_url = DELETE_CHAT_URL.format(BASE_URL=BASE_URL, organization_id=organization_id, chat_id=chat_id)
+        await self.delete_request(delete_url, headers=headers, proxies=self.account_proxy(account))
+
+    async def rev_exec(self, ctx: RequestContext, body: dict):
+        organization_id = ctx.extra['organization_id']
+        # set when the request continues a conversation, see continue_conversation
+        chat_id = ctx.conversation_id
+        continued = chat_id is not None
+        if not continued:
+            start = time.perf_counter()
+            chat_id = await self.get_conversation_pool(ctx.account, organization_id).acquire()
+            # near zero when a pre-created conversation was ready
+            ctx.timings['new_chat'] = time.perf_counter() - start
+            ctx.conversation_id = chat_id
+
+        chat_url = CHAT_URL.format(BASE_URL=BASE_URL, organization_id=organization_id, chat_id=chat_id)
+        try:
+            response = await self.stream_request('POST', chat_url, json=body, headers=ctx.headers, proxies=ctx.proxy)
+        except Exception as e:
+            # a continued conversation may simply be gone, which says nothing about the organization
+            if not continued:
+                await self.check_organization(ctx.account, organization_id, e)
+            raise e
         return response
 
-    def rev_exec_after(self):
-        pass
-
-    async def to_openai_async_iterator(self, chunks: Iterator):
-        for chunk in chunks:
-            if not chunk or not chunk.decode('utf-8').startswith('data:'):
+    def conversation_entry(self, ctx: RequestContext) -> ConversationEntry:
+        entry = super().conversation_entry(ctx)
+        entry.extra['organization_id'] = ctx.extra['organization_id']
+        return entry
+
+    def release_conversation(self, entry: ConversationEntry):
+        self.reap_conversation(entry.account, entry.extra['organization_id'], entry.conversation_id)
+
+    async def rev_exec_after(self, ctx: RequestContext):
+        if not ctx.error and ctx.extra.get('organization_id') == ctx.account.cache.get('rediscovered_organization'):
+            # the rediscovered organization works, a later 403 on it is a stale organization again
+            ctx.account.cache.pop('rediscovered_organization', None)
+        # a conversation kept for the next turn is reaped once the prefix index lets go of it
+        if ctx.conversation_id and not ctx.extra.get('kept'):
+            self.reap_conversation(ctx.account, ctx.extra['organization_id'], ctx.conversation_id)
+
+    async def iter_deltas(self, ctx: RequestContext, chunks: AsyncIterator) -> AsyncIterator:
+        async for chunk in chunks:
+            payload = data_payload(chunk)
+            if payload is None:
                 continue
 
-            json_data = json.loads(chunk[len("data:"):])
+            json_data = loads(payload)
             if json_data['type'] != 'completion':
                 continue
 
             finish_reason = None
             if json_data['stop_reason'] == 'stop_sequence':
                 finish_reason = 'stop'
-            content = json_data['completion']
-            choice = NewCompletionChoice(index=0, text=content, finish_reason=finish_reason)
-            choices = [choice]
-            model = json_data['model']
-            c_id = json_data['id']
-            completion = Completion(
-                id=c_id,
-                created=int(time.time()),
-                choices=choices,
-                model=model,
-                object='text_completion'
-            )
-            yield f"data: {completion.model_dump_json(exclude_unset=True)}\n"
-
-    async def to_openai_chat_async_iterator(self, chunks: Iterator):
-        for chunk in chunks:
-            if not chunk or not chunk.decode('utf-8').startswith('data:'):
+                self.mark_finished(ctx)
+            ctx.completion_id = json_data['id']
+            ctx.model = json_data['model']
+            yield [(0, json_data['completion'], finish_reason)]
+
+    async def collect(self, ctx: RequestContext, chunks: AsyncIterator) -> Optional[CompletionResult]:
+        message = TextBuffer()
+        async for chunk in chunks:
+            if not chunk.startswith(DATA_PREFIX) or COMPLETION_MARK not in chunk:
                 continue
 
-            json_data = json.loads(chunk[len("data:"):])
+            json_data = loads_data(chunk)
             if json_data['type'] != 'completion':
                 continue
 
-            c_id = json_data['id']
-            content = json_data['completion']
-            model = json_data['model']
-
-            delta = ChoiceDelta(role='assistant', content=content)
-            if json_data['stop_reason'] != 'stop_sequence':
-                choice = ChatChunkChoice(index=0, delta=delta)
-            else:
-                choice = ChatChunkChoice(index=0, delta=delta, finish_reason='stop')
-            choices = [choice]
-            completion = ChatCompletionChunk(
-                id=c_id,
-                created=int(time.time()),
-                choices=choices,
-                model=model,
-                object='chat.completion.chunk'
-            )
-            yield f"data: {completion.model_dump_json(exclude_unset=True)}\n"
-
-    def to_openai_nostream_content(self, chunks: Iterator):
-        c_id = None
-        model = None
-        message = ""
-        for chunk in chunks:
-            if not chunk or not chunk.decode('utf-8').startswith('data:'):
-                continue
+            if not ctx.completion_id:
+                ctx.completion_id = json_data['id']
 
-            json_data = json.loads(chunk[len("data:"):])
-            if json_data['type'] != 'completion':
-                continue
+            if not ctx.model:
+                ctx.model = json_data['model']
 
-            if not c_id:
-                c_id = json_data['id']
-
-            if not model:
-                model = json_data['model']
-
-            content = json_data['completion']
-            message = message + content
-        choice = NewCompletionChoice(index=0, text=message, finish_reason='stop')
-        choices = [choice]
-        completion = Completion(
-            id=c_id,
-            created=int(time.time()),
-            choices=choices,
-            model=model,
-            object='text_completion'
-        )
-        return completion.model_dump(exclude_unset=True)
-
-    def to_openai_chat_nostream_content(self, chunks: Iterator):
-        c_id = None
-        model = None
-        message = ""
-        for chunk in chunks:
-            if not chunk or not chunk.decode('utf-8').startswith('data:'):
-                continue
-
-            json_data = json.loads(chunk[len("data:"):])
-            if json_data['type'] != 'completion':
-                continue
-
-            if not c_id:
-                c_id = json_data['id']
-
-            if not model:
-                model = json_data['model']
-
-            content = json_data['completion']
-            message = message + content
-        chat_msg = ChatCompletionMessage(role='assistant', content=message)
-        choice = ChatChoice(index=0, message=chat_msg, finish_reason='stop')
-        choices = [choice]
-        completion = ChatCompletion(
-            id=c_id,
-            created=int(time.time()),
-            choices=choices,
-            model=model,
-            object='chat.completion'
-        )
-        return completion.model_dump(exclude_unset=True)
+            if not message.append(json_data['completion']):
+                break
+            if json_data['stop_reason'] == 'stop_sequence':
+                self.mark_finished(ctx)
+        return CompletionResult(ctx.completion_id, ctx.model, [message.getvalue()], message.finish_reason)
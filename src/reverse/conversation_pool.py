@@ -0,0 +1,171 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationPool:
+    """
+    Keeps pre-created upstream conversations ready, so the request path only issues the completion call.
+    """
+
+    def __init__(self, create: Callable[[], Awaitable[str]], target_size: int, refill_concurrency: int = 2,
+                 max_age: float = 3600, name: str = 'conversation'):
+        self.create = create
+        self.target_size = target_size
+        self.refill_concurrency = max(refill_concurrency, 1)
+        self.max_age = max_age
+        self.name = name
+        self.ready = deque()
+        self.pending = 0
+        self.workers = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.create_errors = 0
+        self.expired = 0
+
+    def prune(self, now: float) -> list:
+        expired = []
+        while self.ready and now - self.ready[0][1] > self.max_age:
+            expired.append(self.ready.popleft()[0])
+        self.expired += len(expired)
+        return expired
+
+    async def acquire(self) -> str:
+        self.prune(time.monotonic())
+        if self.ready:
+            self.hits += 1
+            chat_id = self.ready.popleft()[0]
+        else:
+            self.misses += 1
+            chat_id = await self._create()
+        self.refill()
+        return chat_id
+
+    async def _create(self) -> str:
+        try:
+            chat_id = await self.create()
+        except Exception:
+            self.create_errors += 1
+            raise
+        self.created += 1
+        return chat_id
+
+    def refill(self):
+        if self.target_size <= 0:
+            return
+        deficit = self.target_size - len(self.ready) - self.pending
+        while deficit > 0 and len(self.workers) < self.refill_concurrency:
+            worker = asyncio.ensure_future(self._refill_worker())
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+            deficit -= 1
+
+    async def _refill_worker(self):
+        while len(self.ready) + self.pending < self.target_size:
+            self.pending += 1
+            try:
+                chat_id = await self._create()
+            except Exception as e:
+                logger.warning(f"refill {self.name} failed: {e}")
+                return
+            finally:
+                self.pending -= 1
+            self.ready.append((chat_id, time.monotonic()))
+
+    async def stop(self) -> list:
+        # returns the unused conversations so the caller can delete them
+        workers = list(self.workers)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        chat_ids = [chat_id for chat_id, _ in self.ready]
+        self.ready.clear()
+        return chat_ids
+
+    def stats(self) -> dict:
+        return {
+            'ready': len(self.ready),
+            'pending': self.pending,
+            'hits': self.hits,
+            'misses': self.misses,
+            'created': self.created,
+            'create_errors': self.create_errors,
+            'expired': self.expired,
+        }
+
+
+class ConversationReaper:
+    """
+    Deletes used upstream conversations asynchronously in batches.
+    """
+
+    def __init__(self, delete: Callable[[Any], Awaitable], batch_size: int = 20, interval: float = 10,
+                 concurrency: int = 4, name: str = 'conversation'):
+        self.delete = delete
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.name = name
+        self.queue = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._full = asyncio.Event()
+
+        self.deleted = 0
+        self.delete_errors = 0
+
+    def add(self, item):
+        self.queue.append(item)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        if len(self.queue) >= self.batch_size:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.reap_batch()
+
+    async def reap_batch(self):
+        batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+        if batch:
+            await asyncio.gather(*(self._delete(item) for item in batch))
+
+    async def _delete(self, item):
+        async with self.semaphore:
+            try:
+                await self.delete(item)
+                self.deleted += 1
+            except Exception as e:
+                self.delete_errors += 1
+                logger.debug(f"delete {self.name} failed: {e}")
+
+    async def stop(self, flush_timeout: float = 10):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await asyncio.wait_for(self._flush(), timeout=flush_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(self.queue)} {self.name}s left undeleted on shutdown")
+
+    async def _flush(self):
+        while self.queue:
+            await self.reap_batch()
+
+    def stats(self) -> dict:
+        return {
+            'queued': len(self.queue),
+            'deleted': self.deleted,
+            'delete_errors': self.delete_errors,
+        }
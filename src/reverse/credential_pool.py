@@ -0,0 +1,180 @@
+import os
+import time
+import hashlib
+import logging
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+ACCOUNT_RATE_LIMIT_COOLDOWN = float(os.environ.get('ACCOUNT_RATE_LIMIT_COOLDOWN', 60))
+ACCOUNT_AUTH_COOLDOWN = float(os.environ.get('ACCOUNT_AUTH_COOLDOWN', 300))
+ACCOUNT_ERROR_WINDOW = int(os.environ.get('ACCOUNT_ERROR_WINDOW', 20))
+ACCOUNT_LATENCY_ALPHA = float(os.environ.get('ACCOUNT_LATENCY_ALPHA', 0.2))
+
+# an account's error rate multiplies its load by up to this factor when choosing an account
+ERROR_PENALTY = 4
+
+# seconds between two reads of the cooldowns other workers put on the shared store
+COOLDOWN_SYNC_INTERVAL = 1
+
+# names of the accounts the current request may use, set by model routes limited to some accounts
+route_accounts: ContextVar[Optional[frozenset]] = ContextVar('route_accounts', default=None)
+
+
+class Account:
+
+    def __init__(self, name: str, credential: Any):
+        self.name = name
+        self.credential = credential
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.results = deque(maxlen=ACCOUNT_ERROR_WINDOW)
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        # per-account upstream state, e.g. the sentinel token manager or the claude organization id
+        self.cache = {}
+        # identifies the account across workers without exposing the credential
+        self.key = hashlib.sha256(f"{name}|{credential or ''}".encode('utf-8')).hexdigest()[:32]
+
+    @property
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(self.results) / len(self.results)
+
+    @property
+    def load(self) -> float:
+        return (self.in_flight + 1) * (1 + ERROR_PENALTY * self.error_rate)
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'error_rate': self.error_rate,
+            'latency_ewma': self.latency_ewma,
+            'cooldown_seconds': max(self.cooldown_until - time.monotonic(), 0.0),
+        }
+
+
+class CredentialPool:
+    """
+    Routes each request to the least-loaded healthy account of a backend.
+    Accounts answering 429 or 401/403 are put into a timed cooldown, except for a 403 caused by stale cached
+    metadata the backend rediscovers (metadata_refreshed).
+    """
+
+    def __init__(self, name: str, credentials: list, max_in_flight: int = 0, store=None):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.accounts = [Account(f"{name}-{i}", credential) for i, credential in enumerate(credentials)]
+        self._offset = 0
+        # optional SharedStore, a cooldown set by one worker then applies to all of them
+        self.store = store
+        self._synced = 0.0
+
+    def sync_cooldowns(self, now: float):
+        if self.store is None or now - self._synced < COOLDOWN_SYNC_INTERVAL:
+            return
+        self._synced = now
+        cooldowns = self.store.items('cooldown')
+        if not cooldowns:
+            return
+        wall_now = time.time()
+        for account in self.accounts:
+            until = cooldowns.get(account.key)
+            if until:
+                account.cooldown_until = max(account.cooldown_until, now + until - wall_now)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def allowed_accounts(self) -> list:
+        accounts = self.accounts
+        allowed = route_accounts.get()
+        if allowed is not None:
+            accounts = [a for a in accounts if a.name in allowed]
+            if not accounts:
+                raise Exception(f"no {self.name} account among {', '.join(sorted(allowed))}")
+        return accounts
+
+    def acquire(self, exclude: tuple = (), prefer: Account = None) -> Account:
+        # prefer is taken when it is healthy and has room, e.g. the account holding a conversation to continue
+        now = time.monotonic()
+        self.sync_cooldowns(now)
+        accounts = self.allowed_accounts()
+        candidates = [a for a in accounts if a not in exclude] or accounts
+        healthy = [a for a in candidates if a.is_available(now)]
+        if self.max_in_flight > 0:
+            # prefer accounts under their concurrency cap, the admission queue keeps the total below the sum of caps
+            healthy = [a for a in healthy if a.in_flight < self.max_in_flight] or healthy
+        if prefer is not None and prefer in healthy:
+            account = prefer
+        elif not healthy:
+            # every account is cooling down, use the one that recovers first rather than failing
+            account = min(candidates, key=lambda a: a.cooldown_until)
+        else:
+            # rotate the starting point so equally loaded accounts share the traffic
+            self._offset = (self._offset + 1) % len(healthy)
+            ordered = healthy[self._offset:] + healthy[:self._offset]
+            account = min(ordered, key=lambda a: (a.load, a.latency_ewma or 0.0))
+        account.in_flight += 1
+        account.requests += 1
+        return account
+
+    def acquire_spare(self, exclude: tuple) -> Optional[Account]:
+        # a healthy account under its cap other than exclude, e.g. for a hedge, None instead of falling back
+        now = time.monotonic()
+        self.sync_cooldowns(now)
+        spare = [a for a in self.allowed_accounts() if a not in exclude and a.is_available(now)
+                 and (self.max_in_flight <= 0 or a.in_flight < self.max_in_flight)]
+        if not spare:
+            return None
+        account = min(spare, key=lambda a: (a.load, a.latency_ewma or 0.0))
+        account.in_flight += 1
+        account.requests += 1
+        return account
+
+    def release(self, account: Account, latency: Optional[float] = None, status: Optional[int] = None,
+                error: bool = False, metadata_refreshed: bool = False):
+        account.in_flight = max(account.in_flight - 1, 0)
+        failed = error or (status is not None and status >= 400)
+        account.results.append(1 if failed else 0)
+        if failed:
+            account.errors += 1
+        if latency is not None and not failed:
+            if account.latency_ewma is None:
+                account.latency_ewma = latency
+            else:
+                account.latency_ewma += ACCOUNT_LATENCY_ALPHA * (latency - account.latency_ewma)
+
+        cooldown = 0
+        if status == 429:
+            cooldown = ACCOUNT_RATE_LIMIT_COOLDOWN
+        elif status == 401 or (status == 403 and not metadata_refreshed):
+            cooldown = ACCOUNT_AUTH_COOLDOWN
+        if cooldown:
+            account.cooldown_until = time.monotonic() + cooldown
+            if self.store is not None:
+                self.store.set('cooldown', account.key, time.time() + cooldown, cooldown)
+            logger.warning(f"account {account.name} got {status}, cooling down for {cooldown}s")
+
+    def stats(self) -> list:
+        return [account.stats() for account in self.accounts]
+
+
+def split_credentials(value: Optional[str]) -> list:
+    # several credentials can be configured separated by commas, no credential means one anonymous account
+    credentials = [v.strip() for v in (value or '').split(',') if v.strip()]
+    return credentials or [None]
@@ -0,0 +1,90 @@
+import logging
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# number of characters compared to tell whether a part was appended to or rewritten
+CHECK_WINDOW = 16
+
+
+class PartsDeltaEngine:
+    """
+    Turns chatgpt's cumulative `message.content.parts` frames into per-part suffixes.
+    Keeps the emitted offset of every part instead of re-diffing the whole text, and lets
+    frames that did not grow be skipped before they are decoded.
+    """
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.offsets: List[int] = []
+        self.last_size = -1
+        # the last skipped frame, decoded when the stream ends without a later one, see take_pending
+        self.pending: Optional[bytes] = None
+        self.frames = 0
+        self.decoded_frames = 0
+        self.skipped_frames = 0
+        self.rewrites = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def should_decode(self, payload: bytes, final: bool = False) -> bool:
+        # content is cumulative, so skipping a frame only defers its text to the next decoded one. metadata
+        # counts in the size too, so a frame can add text and still shrink, it is kept until then
+        self.frames += 1
+        self.bytes_in += len(payload)
+        if not final and len(payload) <= self.last_size:
+            self.skipped_frames += 1
+            self.pending = payload
+            return False
+        self.decoded_frames += 1
+        self.pending = None
+        return True
+
+    def take_pending(self) -> Optional[bytes]:
+        # the skipped frame no decoded frame followed, e.g. when the stream was cut before its finished frame
+        payload, self.pending = self.pending, None
+        if payload is not None:
+            self.skipped_frames -= 1
+            self.decoded_frames += 1
+        return payload
+
+    def feed(self, parts: list, payload: bytes = None) -> List[Tuple[int, str]]:
+        if payload is not None:
+            self.last_size = len(payload)
+        deltas = []
+        for i, part in enumerate(parts):
+            if i < len(self.offsets):
+                offset = self.offsets[i]
+                if not self.is_appended(self.parts[i], part, offset):
+                    # the part was rewritten, the emitted text can't be taken back so continue after it
+                    self.rewrites += 1
+                delta = part[offset:]
+                self.offsets[i] = max(offset, len(part))
+                self.parts[i] = part
+            else:
+                delta = part
+                self.offsets.append(len(part))
+                self.parts.append(part)
+            deltas.append((i, delta))
+        return deltas
+
+    @staticmethod
+    def is_appended(previous: str, current: str, offset: int) -> bool:
+        if len(current) < offset:
+            return False
+        start = max(offset - CHECK_WINDOW, 0)
+        return current[start:offset] == previous[start:offset]
+
+    def add_output(self, size: int):
+        self.bytes_out += size
+
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames,
+            'decoded_frames': self.decoded_frames,
+            'skipped_frames': self.skipped_frames,
+            'rewrites': self.rewrites,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'amplification': self.bytes_in / self.bytes_out if self.bytes_out else 0.0,
+        }
@@ -0,0 +1,150 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from src.reverse.transport import shielded
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+HEDGE_ENABLE = os.environ.get('HEDGE_ENABLE', 'false').upper() == 'TRUE'
+# seconds without a first byte before a duplicate request is sent, 0 derives it from the observed first bytes
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 0))
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.95))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 1))
+# extra upstream requests hedging may add, as a fraction of all requests
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.1))
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 3))
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', 0.2))
+RETRY_MAX_BACKOFF = float(os.environ.get('RETRY_MAX_BACKOFF', 2))
+
+# first byte latencies the percentile is taken from, and how many are needed before it is trusted
+HEDGE_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+# unused budget saved up for a burst of slow requests
+HEDGE_BUDGET_BURST = 10
+
+
+def is_retryable(e: Exception) -> bool:
+    # connection problems and upstream 5xx, a 4xx would only be answered the same way again
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+async def retry(call: Callable[[], Awaitable], attempts: int = RETRY_ATTEMPTS, backoff: float = RETRY_BACKOFF,
+                max_backoff: float = RETRY_MAX_BACKOFF):
+    # only for idempotent calls made before anything was sent to the client
+    for attempt in range(max(attempts, 1)):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt >= attempts - 1 or not is_retryable(e):
+                raise e
+            # full jitter, so callers failing together don't retry together
+            delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            logger.debug(f"retrying in {delay:.2f}s after {type(e).__name__}: {e}")
+            await asyncio.sleep(delay)
+
+
+class Hedger:
+    """
+    Sends a duplicate of a request whose first byte is late and keeps whichever answers first.
+    Every request adds HEDGE_BUDGET to a budget and every hedge spends one, which caps the extra load.
+    """
+
+    def __init__(self, name: str, enabled: bool = HEDGE_ENABLE, delay: float = HEDGE_DELAY,
+                 percentile: float = HEDGE_PERCENTILE, min_delay: float = HEDGE_MIN_DELAY,
+                 budget: float = HEDGE_BUDGET):
+        self.name = name
+        self.enabled = enabled
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget = budget
+        self.balance = 1.0
+        self.samples = deque(maxlen=HEDGE_SAMPLES)
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+        self.unavailable = 0
+
+    def delay(self) -> Optional[float]:
+        if self.fixed_delay > 0:
+            return self.fixed_delay
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        return max(samples[min(int(self.percentile * len(samples)), len(samples) - 1)], self.min_delay)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            self.over_budget += 1
+            return False
+        self.balance -= 1
+        return True
+
+    async def run(self, primary: Callable[[], Awaitable], hedge: Callable[[], Optional[Awaitable]],
+                  discard: Callable[[Any], Awaitable]) -> Tuple[int, Any]:
+        # returns (0 for the primary or 1 for the hedge, its result), a late success of the other goes to discard,
+        # hedge returns None when there is nothing to hedge on
+        self.requests += 1
+        self.balance = min(self.balance + self.budget, HEDGE_BUDGET_BURST)
+        starts = [time.perf_counter()]
+        tasks = [asyncio.ensure_future(primary())]
+        winner = None
+        try:
+            delay = self.delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.withdraw():
+                    call = hedge()
+                    if call is None:
+                        # no spare account or slot to hedge on, the budget is kept for a later request
+                        self.balance += 1
+                        self.unavailable += 1
+                    else:
+                        self.hedged += 1
+                        starts.append(time.perf_counter())
+                        tasks.append(asyncio.ensure_future(call))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # the primary wins a tie
+                for index, task in enumerate(tasks):
+                    if task in done and task.exception() is None:
+                        winner = task
+                        self.samples.append(time.perf_counter() - starts[index])
+                        if index:
+                            self.hedge_wins += 1
+                        return index, task.result()
+            raise tasks[0].exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await shielded(asyncio.gather(*tasks, return_exceptions=True))
+            for task in tasks:
+                if task is not winner and not task.cancelled() and task.exception() is None:
+                    await shielded(discard(task.result()))
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'delay': self.delay(),
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'over_budget': self.over_budget,
+            'unavailable': self.unavailable,
+            'budget_balance': self.balance,
+        }
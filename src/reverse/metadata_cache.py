@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """
+    Session metadata (e.g. the claude organization) keyed by a hash of the session key.
+    Kept in memory and optionally persisted to a json file, so restarts and other workers skip discovery.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 86400):
+        self.path = path or None
+        self.ttl = ttl
+        self.entries = {}
+        self._mtime = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.load()
+
+    @staticmethod
+    def key(session_key: Optional[str]) -> str:
+        # never keep the raw session key in the cache file
+        return hashlib.sha256((session_key or 'anonymous').encode('utf-8')).hexdigest()
+
+    def is_valid(self, entry: dict) -> bool:
+        return time.time() - entry.get('discovered_at', 0) < self.ttl
+
+    def get(self, session_key: Optional[str]) -> Optional[dict]:
+        # another process may have discovered or invalidated it in the meantime, a stat when the file is unchanged
+        self.load()
+        entry = self.entries.get(self.key(session_key))
+        if entry is not None and self.is_valid(entry):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, session_key: Optional[str], organization_id: str, capabilities: list):
+        self.entries[self.key(session_key)] = {
+            'organization_id': organization_id,
+            'capabilities': capabilities,
+            'discovered_at': time.time(),
+        }
+        self.save()
+
+    def invalidate(self, session_key: Optional[str]):
+        self.invalidations += 1
+        self.entries.pop(self.key(session_key), None)
+        self.save(removed=self.key(session_key))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self._mtime:
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            self._mtime = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"load metadata cache {self.path} failed: {e}")
+            return
+        # the file replaces what is in memory, so entries other processes invalidated are dropped here too,
+        # only entries discovered after the file was written are kept
+        entries.update((key, entry) for key, entry in self.entries.items() if entry.get('discovered_at', 0) > mtime)
+        self.entries = entries
+
+    def save(self, removed: str = None):
+        if not self.path:
+            return
+        try:
+            # merge with what other processes wrote, then replace the file atomically
+            self._mtime = None
+            self.load()
+            if removed:
+                self.entries.pop(removed, None)
+            entries = {k: v for k, v in self.entries.items() if self.is_valid(v)}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.warning(f"save metadata cache {self.path} failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
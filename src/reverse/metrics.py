@@ -0,0 +1,148 @@
+import bisect
+from typing import Callable, Dict, Iterable, Tuple
+
+# seconds, from sub-millisecond proxy overhead up to long generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """
+    Labelled counter, label values are passed as a tuple in the order of the label names.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    """
+    Labelled histogram with fixed buckets, an observation is one bisect and two additions.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, labels: Tuple, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, (counts, total) in self.values.items():
+            names = self.labelnames + ('le',)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class CallbackMetric:
+    """
+    Gauge or counter read from existing state when scraped, e.g. queue depths or pool counters.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str],
+                 collect: Callable[[], Dict[Tuple, float]], metric_type: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.type = metric_type
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.collect().items():
+            if value is not None:
+                yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # registering a name twice returns the first metric, so modules can be reloaded safely
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, labelnames: Iterable[str],
+                 collect: Callable[[], Dict[Tuple, float]], metric_type: str = 'gauge') -> CallbackMetric:
+        metric = CallbackMetric(name, documentation, labelnames, collect, metric_type)
+        self.metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        # prometheus text exposition format 0.0.4
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+PHASE_SECONDS = REGISTRY.histogram(
+    'gpt_proxy_phase_seconds', 'Duration of each phase of a request',
+    ('backend', 'account', 'phase'))
+OUTPUT_CHARS_PER_SECOND = REGISTRY.histogram(
+    'gpt_proxy_output_chars_per_second', 'Generated characters per second of a request',
+    ('backend', 'account'), RATE_BUCKETS)
+REQUESTS = REGISTRY.counter(
+    'gpt_proxy_upstream_requests_total', 'Upstream conversations by final status',
+    ('backend', 'account', 'status'))
+FRAMES = REGISTRY.counter(
+    'gpt_proxy_frames_total', 'Upstream frames turned into chunks', ('backend', 'account'))
+BYTES = REGISTRY.counter(
+    'gpt_proxy_bytes_total', 'Bytes read from the upstream and sent to clients', ('backend', 'account', 'direction'))
+OUTPUT_CHARS = REGISTRY.counter(
+    'gpt_proxy_output_chars_total', 'Generated characters', ('backend', 'account'))
+ROUTE_DECISIONS = REGISTRY.counter(
+    'gpt_proxy_route_decisions_total', 'Backend each model route sent a request to and why',
+    ('route', 'backend', 'reason'))
+STREAM_FLUSHES = REGISTRY.counter(
+    'gpt_proxy_stream_flushes_total', 'Downstream events of coalesced streams by what flushed them', ('reason',))
+STREAM_EVENTS_SAVED = REGISTRY.counter(
+    'gpt_proxy_stream_events_saved_total', 'Upstream frames merged into the downstream event of another one')
@@ -0,0 +1,139 @@
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+from dotenv import load_dotenv
+
+from src.reverse.sse_codec import dumps
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+CONVERSATION_REUSE_ENABLE = os.environ.get('CONVERSATION_REUSE_ENABLE', 'false').upper() == 'TRUE'
+CONVERSATION_REUSE_MAX_ENTRIES = int(os.environ.get('CONVERSATION_REUSE_MAX_ENTRIES', 1024))
+# seconds an upstream conversation is kept for a follow-up turn
+CONVERSATION_REUSE_TTL = float(os.environ.get('CONVERSATION_REUSE_TTL', 1800))
+
+
+def message_hasher(role: str):
+    # the text of a message may arrive in pieces, feed them with update()
+    return hashlib.sha256(role.encode('utf-8') + b'\0')
+
+
+def extend(prefix: bytes, message_digest: bytes) -> bytes:
+    # digest of a history is chained from the digest of its prefix, so every prefix is hashed once
+    return hashlib.sha256(prefix + message_digest).digest()
+
+
+def prefix_digests(messages: list) -> List[bytes]:
+    # digests[k] identifies messages[:k], messages are in the upstream format
+    digests = [b'']
+    for message in messages:
+        hasher = message_hasher(message['author']['role'])
+        for part in message['content']['parts']:
+            hasher.update(str(part).encode('utf-8'))
+        digests.append(extend(digests[-1], hasher.digest()))
+    return digests
+
+
+@dataclass
+class ConversationEntry:
+    # an upstream conversation whose history ends with the assistant answer to a known prefix
+    conversation_id: str
+    account: Any
+    message_id: Optional[str] = None
+    extra: dict = field(default_factory=dict)
+    created: float = field(default_factory=time.monotonic)
+    # messages of the history it continues, filled in when taken
+    length: int = 0
+
+
+class PrefixIndex:
+    """
+    Maps the digest of a message history to the upstream conversation that already holds it,
+    so a request extending that history only sends its new messages.
+    An entry is taken by the request continuing it and put back under the longer history afterwards.
+    """
+
+    def __init__(self, max_entries: int = CONVERSATION_REUSE_MAX_ENTRIES, ttl: float = CONVERSATION_REUSE_TTL,
+                 on_evict: Callable[[ConversationEntry], None] = None):
+        self.max_entries = max(max_entries, 1)
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.bytes_saved = 0
+
+    def take(self, messages: list, digests: List[bytes]) -> Optional[ConversationEntry]:
+        # digests are the prefix_digests of messages, the longest known prefix ending with an answer wins,
+        # at least one new message has to follow it
+        for length in range(len(messages) - 1, 0, -1):
+            if messages[length - 1]['author']['role'] != 'assistant':
+                continue
+            entry = self.entries.pop(digests[length], None)
+            if entry is None:
+                continue
+            if time.monotonic() - entry.created > self.ttl:
+                self.evict(entry)
+                continue
+            self.hits += 1
+            entry.length = length
+            return entry
+        self.misses += 1
+        return None
+
+    def record_saving(self, messages: list):
+        # payload of the history that was not sent again
+        self.bytes_saved += len(dumps(messages))
+
+    def put(self, digest: bytes, entry: ConversationEntry):
+        self.prune(time.monotonic())
+        self.entries[digest] = entry
+        self.entries.move_to_end(digest)
+        self.stored += 1
+        while len(self.entries) > self.max_entries:
+            self.evict(self.entries.popitem(last=False)[1])
+
+    def prune(self, now: float):
+        # entries are only ever added at the end, so the expired ones are at the front
+        while self.entries:
+            digest, entry = next(iter(self.entries.items()))
+            if now - entry.created <= self.ttl:
+                break
+            del self.entries[digest]
+            self.evict(entry)
+
+    def evict(self, entry: ConversationEntry):
+        self.evicted += 1
+        if self.on_evict is not None:
+            self.on_evict(entry)
+
+    def clear(self) -> List[ConversationEntry]:
+        entries = list(self.entries.values())
+        self.entries.clear()
+        return entries
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+def create_prefix_index(on_evict: Callable[[ConversationEntry], None] = None) -> Optional[PrefixIndex]:
+    if not CONVERSATION_REUSE_ENABLE:
+        return None
+    return PrefixIndex(on_evict=on_evict)
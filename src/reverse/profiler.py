@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import uuid
+import asyncio
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# seconds between two stack samples of a profiled request
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+# frame arrivals and serialized chunks kept per request, the counts and totals cover all of them
+PROFILE_MAX_EVENTS = int(os.environ.get('PROFILE_MAX_EVENTS', 2000))
+
+# frames of a stack kept from the innermost one, and distinct stacks reported per profile
+STACK_DEPTH = 40
+TOP_STACKS = 50
+
+
+def collapse(frame) -> str:
+    # outermost first, in the format flame graph tools read
+    names = []
+    while frame is not None and len(names) < STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfile:
+    """
+    Timeline of one api request: the upstream contexts it ran, when each frame arrived, how long each chunk took
+    to serialize, and with sampling on, where the event loop spent its time while the request was in flight.
+    """
+
+    def __init__(self, path: str, reason: Optional[str] = None, sampled: bool = False):
+        self.id = uuid.uuid4().hex[:16]
+        self.path = path
+        # why the profile is kept: 'header' or 'sampled', 'slow' is decided when it finishes
+        self.reason = reason
+        self.sampled = sampled
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status: Optional[int] = None
+        self.contexts = []
+        self.frames: List[tuple] = []
+        self.frame_count = 0
+        self.chunks: List[tuple] = []
+        self.chunk_count = 0
+        self.serialize_seconds = 0.0
+        # tasks that worked on this request, samples taken while another task ran belong to someone else
+        self.tasks = set()
+        self.samples = Counter()
+        self.stacks = Counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def join(self):
+        task = asyncio.current_task()
+        if task is not None:
+            self.tasks.add(task)
+
+    def frame(self, backend: str, chars: int):
+        self.frame_count += 1
+        if len(self.frames) < PROFILE_MAX_EVENTS:
+            self.frames.append((round(self.elapsed(), 6), backend, chars))
+
+    def serialized(self, seconds: float, size: int):
+        self.chunk_count += 1
+        self.serialize_seconds += seconds
+        if len(self.chunks) < PROFILE_MAX_EVENTS:
+            self.chunks.append((round(self.elapsed(), 6), round(seconds, 6), size))
+
+    def add_context(self, backend: str, ctx):
+        self.contexts.append({
+            'backend': backend,
+            'account': ctx.account.name if ctx.account else None,
+            'started': round(ctx.start_time - self.start_time, 6),
+            'queue_wait': ctx.queue_wait,
+            'ttfb': ctx.ttfb,
+            'first_token': ctx.first_token,
+            'phases': dict(ctx.timings),
+            'frames': ctx.frames,
+            'bytes_in': ctx.bytes_in,
+            'bytes_out': ctx.bytes_out,
+            'status': ctx.status,
+            'error': ctx.error,
+        })
+
+    def add_sample(self, task, stack: Optional[str]):
+        # called from the sampler thread
+        if task is None:
+            self.samples['idle'] += 1
+        elif task in self.tasks:
+            self.samples['request'] += 1
+            if stack:
+                self.stacks[stack] += 1
+        else:
+            self.samples['other_tasks'] += 1
+
+    def summary(self) -> dict:
+        return {
+            'id': self.id,
+            'path': self.path,
+            'reason': self.reason,
+            'started': self.started,
+            'duration': self.duration,
+            'status': self.status,
+            'backends': [c['backend'] for c in self.contexts],
+        }
+
+    def to_dict(self) -> dict:
+        dump = self.summary()
+        dump['contexts'] = self.contexts
+        dump['frames'] = {'count': self.frame_count, 'arrivals': self.frames}
+        dump['serialization'] = {'chunks': self.chunk_count, 'seconds': self.serialize_seconds,
+                                 'per_chunk': self.chunks}
+        if self.sampled:
+            # idle: the loop waited on sockets, other_tasks: it ran other requests
+            dump['samples'] = {'interval': PROFILE_SAMPLE_INTERVAL, **self.samples,
+                               'stacks': dict(self.stacks.most_common(TOP_STACKS))}
+        return dump
+
+
+class StackSampler:
+    """
+    A thread that samples the stack of the event loop thread while any profile asks for it.
+    Nothing runs while no request is sampled.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.profiles = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.loop = None
+        self.loop_thread_id = None
+
+    def add(self, profile: RequestProfile):
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.loop_thread_id = threading.get_ident()
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+                self.thread.start()
+
+    def remove(self, profile: RequestProfile):
+        with self.lock:
+            self.profiles.discard(profile)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                profiles = list(self.profiles)
+            frame = sys._current_frames().get(self.loop_thread_id)
+            task = asyncio.current_task(self.loop)
+            stack = collapse(frame) if task is not None else None
+            for profile in profiles:
+                profile.add_sample(task, stack)
+
+
+_sampler = StackSampler()
+
+# profile of the current api request, None when it isn't profiled
+request_profile: ContextVar[Optional[RequestProfile]] = ContextVar('request_profile', default=None)
+
+
+def start_sampling(profile: RequestProfile):
+    _sampler.add(profile)
+
+
+def stop_sampling(profile: RequestProfile):
+    _sampler.remove(profile)
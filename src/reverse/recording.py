@@ -0,0 +1,196 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+from dataclasses import dataclass, field
+from typing import AsyncIterator, List, Optional
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# file the raw upstream streams are appended to, empty records nothing
+UPSTREAM_RECORD_PATH = os.environ.get('UPSTREAM_RECORD_PATH', '')
+
+FORMAT = 'gpt-api-proxy-recording/1'
+
+# a recording is a sequence of streams, each written in one append as
+#   S record: json metadata of the stream
+#   L record per upstream line: the raw line, seconds are its arrival after the response headers
+#   E record: json outcome of the stream, seconds are its duration
+# every record is a kind byte, the payload length and the seconds as little endian uint32 / float64,
+# followed by the payload. a stream cut short by a crash is ignored by the reader
+RECORD = struct.Struct('<cId')
+KIND_START = b'S'
+KIND_LINE = b'L'
+KIND_END = b'E'
+
+# request headers whose values never go to a recording
+REDACTED_HEADERS = {'authorization', 'cookie', 'proxy-authorization', 'openai-sentinel-chat-requirements-token',
+                    'x-api-key'}
+REDACTED = '<redacted>'
+
+
+def redact(headers: dict) -> dict:
+    return {name: REDACTED if name.lower() in REDACTED_HEADERS else value for name, value in headers.items()}
+
+
+def pack(kind: bytes, seconds: float, payload: bytes) -> bytes:
+    return RECORD.pack(kind, len(payload), seconds) + payload
+
+
+class StreamRecorder:
+    """
+    Appends every upstream stream that passes through tap to a recording. Several workers can share the file,
+    a stream is written with a single O_APPEND write.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.streams = 0
+        self.bytes = 0
+
+    async def tap(self, backend: str, ctx, lines: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        # ctx is the RequestContext of the stream, its ttfb is known once lines are read
+        start = time.perf_counter()
+        records = []
+        complete = False
+        error = None
+        try:
+            async for line in lines:
+                records.append(pack(KIND_LINE, time.perf_counter() - start, line))
+                yield line
+            complete = True
+        except GeneratorExit:
+            # closed early, whole only when the reader got to the finish frame, e.g. chatgpt's finished message,
+            # see mark_finished. not a hedge loser, a cancelled read or a converter error
+            complete = ctx.extra.get('upstream_finished', False)
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise e
+        finally:
+            meta = {
+                'format': FORMAT,
+                'backend': backend,
+                'recorded': time.time(),
+                'ttfb': ctx.ttfb,
+                'model': ctx.model,
+                'account': ctx.account.name if ctx.account else None,
+                'headers': redact(ctx.headers),
+            }
+            outcome = {'complete': complete, 'error': error, 'lines': len(records)}
+            self.write(b''.join([pack(KIND_START, 0.0, json.dumps(meta).encode('utf-8')), *records,
+                                 pack(KIND_END, time.perf_counter() - start, json.dumps(outcome).encode('utf-8'))]))
+
+    def write(self, data: bytes):
+        if self.fd is None:
+            return
+        try:
+            os.write(self.fd, data)
+        except OSError as e:
+            logger.warning(f"writing the upstream recording {self.path} failed: {e}")
+            return
+        self.streams += 1
+        self.bytes += len(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def stats(self) -> dict:
+        return {'path': self.path, 'streams': self.streams, 'bytes': self.bytes}
+
+
+@dataclass
+class RecordedStream:
+    meta: dict
+    # (seconds after the response headers, start, end) of every line in the mapped file
+    lines: List[tuple] = field(default_factory=list)
+    outcome: dict = field(default_factory=dict)
+    duration: float = 0.0
+
+    @property
+    def backend(self) -> str:
+        return self.meta['backend']
+
+
+class Recording:
+    """
+    The streams of a recording file, mapped into memory. Lines are only copied out when they are replayed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.streams: List[RecordedStream] = []
+        self.incomplete = 0
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # an empty file can't be mapped
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.parse()
+
+    def parse(self):
+        offset = 0
+        stream = None
+        while offset + RECORD.size <= len(self.map):
+            kind, length, seconds = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            end = start + length
+            if end > len(self.map):
+                break
+            if kind == KIND_START:
+                stream = RecordedStream(json.loads(self.map[start:end]))
+                if stream.meta.get('format') != FORMAT:
+                    raise ValueError(f"{self.path} is not a recording of format {FORMAT}")
+            elif stream is None:
+                raise ValueError(f"{self.path} is corrupt at byte {offset}")
+            elif kind == KIND_LINE:
+                stream.lines.append((seconds, start, end))
+            elif kind == KIND_END:
+                stream.outcome = json.loads(self.map[start:end])
+                stream.duration = seconds
+                # a stream whose reader went away early doesn't hold a whole answer
+                if stream.outcome.get('complete'):
+                    self.streams.append(stream)
+                else:
+                    self.incomplete += 1
+                stream = None
+            else:
+                raise ValueError(f"{self.path} is corrupt at byte {offset}")
+            offset = end
+
+    def line(self, start: int, end: int) -> bytes:
+        return self.map[start:end]
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self._file.close()
+
+
+_recorder: Optional[StreamRecorder] = None
+
+
+def get_recorder() -> Optional[StreamRecorder]:
+    # one recorder per process, None when UPSTREAM_RECORD_PATH isn't set
+    global _recorder
+    if _recorder is None and UPSTREAM_RECORD_PATH:
+        _recorder = StreamRecorder(UPSTREAM_RECORD_PATH)
+    return _recorder
+
+
+def close_recorder():
+    global _recorder
+    if _recorder is not None:
+        recorder, _recorder = _recorder, None
+        recorder.close()
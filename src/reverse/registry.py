@@ -0,0 +1,119 @@
+import os
+import asyncio
+import logging
+import importlib
+
+from dotenv import load_dotenv
+
+from src.reverse.base_reverse import BaseReverse
+from src.reverse.proxy_pool import close_proxy_pool, get_proxy_pool
+from src.reverse.recording import close_recorder, get_recorder
+from src.reverse.shared_store import close_shared_store, get_shared_store
+from src.reverse.transport import close_transport
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# module of every backend, only imported once the backend is enabled and used
+BACKEND_MODULES = {
+    'chatgpt': 'src.reverse.chatgpt_reverse',
+    'claude': 'src.reverse.claude_reverse',
+    'chatgpt-replay': 'src.reverse.replay_reverse',
+    'claude-replay': 'src.reverse.replay_reverse',
+}
+# comma separated backends that can be used, empty enables chatgpt and claude,
+# and the replay backends when UPSTREAM_REPLAY_PATH is set
+ENABLED_BACKENDS = [name.strip() for name in os.environ.get('ENABLED_BACKENDS', '').split(',') if name.strip()]
+
+
+def enabled_backends() -> list:
+    if ENABLED_BACKENDS:
+        unknown = [name for name in ENABLED_BACKENDS if name not in BACKEND_MODULES]
+        if unknown:
+            raise ValueError(f"unknown backends in ENABLED_BACKENDS: {', '.join(unknown)}")
+        return ENABLED_BACKENDS
+    backends = ['chatgpt', 'claude']
+    if os.environ.get('UPSTREAM_REPLAY_PATH'):
+        backends += ['chatgpt-replay', 'claude-replay']
+    return backends
+
+
+def backend_classes(cls) -> list:
+    # subclasses of subclasses too, e.g. the replay backends
+    classes = []
+    for subclass in cls.__subclasses__():
+        classes.append(subclass)
+        classes.extend(backend_classes(subclass))
+    return classes
+
+
+class ReverseRegistry:
+    """
+    Holds one long-lived instance per enabled backend, shared by all requests. A backend's module is imported
+    when the backend is created, at startup or, where no startup event is run, at its first request.
+    """
+
+    def __init__(self, backends: list = None):
+        self.backends = enabled_backends() if backends is None else backends
+        self.instances = {}
+
+    def create(self, llm_type: str) -> BaseReverse:
+        importlib.import_module(BACKEND_MODULES[llm_type])
+        for subclass in backend_classes(BaseReverse):
+            if subclass.llm_type == llm_type:
+                return subclass()
+        raise Exception(f"{BACKEND_MODULES[llm_type]} defines no backend {llm_type}")
+
+    def load(self):
+        for llm_type in self.backends:
+            if llm_type not in self.instances:
+                self.instances[llm_type] = self.create(llm_type)
+
+    def get(self, llm_type: str) -> BaseReverse:
+        instance = self.instances.get(llm_type)
+        if instance is None:
+            if llm_type not in self.backends:
+                raise Exception(f"Unsupported llm type: {llm_type}")
+            instance = self.instances[llm_type] = self.create(llm_type)
+        return instance
+
+    async def startup(self):
+        self.load()
+        results = await asyncio.gather(*(instance.warmup() for instance in self.instances.values()),
+                                       return_exceptions=True)
+        for llm_type, result in zip(self.instances.keys(), results):
+            if isinstance(result, Exception):
+                logger.warning(f"warmup {llm_type} failed: {result}")
+
+    def stats(self) -> dict:
+        stats = {}
+        for llm_type, instance in self.instances.items():
+            stats[llm_type] = instance.stats()
+            stats[llm_type]['admission'] = instance.admission.stats()
+            stats[llm_type]['streams'] = instance.abort_stats()
+            stats[llm_type]['hedging'] = instance.hedger.stats()
+            if instance.prefix_index is not None:
+                stats[llm_type]['conversation_reuse'] = instance.prefix_index.stats()
+        store = get_shared_store()
+        if store is not None:
+            stats['shared_store'] = store.stats()
+        proxy_pool = get_proxy_pool()
+        if proxy_pool is not None:
+            stats['egress_proxies'] = proxy_pool.stats()
+        recorder = get_recorder()
+        if recorder is not None:
+            stats['upstream_recording'] = recorder.stats()
+        return stats
+
+    async def shutdown(self):
+        for instance in self.instances.values():
+            try:
+                await instance.shutdown()
+            except Exception as e:
+                logger.warning(f"shutdown {instance.llm_type} failed: {e}")
+        self.instances.clear()
+        await close_proxy_pool()
+        await close_transport()
+        close_shared_store()
+        close_recorder()
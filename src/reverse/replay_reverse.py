@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator
+
+from dotenv import load_dotenv
+
+from src.reverse.base_reverse import RequestContext
+from src.reverse.chatgpt_reverse import ChatGPTReverse
+from src.reverse.claude_reverse import ClaudeReverse
+from src.reverse.recording import RecordedStream, Recording
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# recording served by the chatgpt-replay and claude-replay backends, see UPSTREAM_RECORD_PATH,
+# the backends are enabled when it is set
+UPSTREAM_REPLAY_PATH = os.environ.get('UPSTREAM_REPLAY_PATH', '')
+# 1 replays at the recorded pace, 10 ten times faster, 0 as fast as possible
+UPSTREAM_REPLAY_SPEED = float(os.environ.get('UPSTREAM_REPLAY_SPEED', 1))
+
+
+class ReplayMixin:
+    """
+    Answers every request with the next stream recorded from the backend it is mixed into, instead of calling
+    the upstream. Everything after the raw lines is the real backend's code, so the converters run as in production.
+    """
+    recorded_backend: str = None
+
+    def __init__(self):
+        super().__init__()
+        self.speed = UPSTREAM_REPLAY_SPEED
+        self.recording = Recording(UPSTREAM_REPLAY_PATH)
+        self.streams = [s for s in self.recording.streams if s.backend == self.recorded_backend]
+        self.next_stream = 0
+        self.replayed = 0
+        # there is no upstream conversation to continue
+        self.prefix_index = None
+        logger.info(f"{self.llm_type}: {len(self.streams)} streams from {UPSTREAM_REPLAY_PATH}")
+
+    def get_credentials(self) -> list:
+        return [None]
+
+    def get_auth_headers(self, credential) -> dict:
+        return {}
+
+    async def warmup(self):
+        pass
+
+    async def shutdown(self):
+        self.recording.close()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['replay'] = {'path': UPSTREAM_REPLAY_PATH, 'speed': self.speed, 'streams': len(self.streams),
+                           'replayed': self.replayed}
+        return stats
+
+    async def rev_exec_before(self, ctx: RequestContext):
+        pass
+
+    async def rev_exec(self, ctx: RequestContext, body: dict) -> RecordedStream:
+        if not self.streams:
+            raise Exception(f"{UPSTREAM_REPLAY_PATH} holds no complete {self.recorded_backend} stream")
+        stream = self.streams[self.next_stream]
+        self.next_stream = (self.next_stream + 1) % len(self.streams)
+        self.replayed += 1
+        ttfb = stream.meta.get('ttfb') or 0.0
+        if self.speed > 0 and ttfb > 0:
+            await asyncio.sleep(ttfb / self.speed)
+        return stream
+
+    def response_lines(self, ctx: RequestContext, response: RecordedStream) -> AsyncIterator[bytes]:
+        return self.replay_lines(response)
+
+    async def replay_lines(self, stream: RecordedStream) -> AsyncIterator[bytes]:
+        start = time.perf_counter()
+        for seconds, begin, end in stream.lines:
+            if self.speed > 0:
+                delay = start + seconds / self.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield self.recording.line(begin, end)
+
+
+class ChatGPTReplay(ReplayMixin, ChatGPTReverse):
+    llm_type = 'chatgpt-replay'
+    recorded_backend = 'chatgpt'
+
+
+class ClaudeReplay(ReplayMixin, ClaudeReverse):
+    llm_type = 'claude-replay'
+    recorded_backend = 'claude'
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# sqlite file shared by the workers of one host, empty keeps every cache local to its process
+SHARED_STORE_PATH = os.environ.get('SHARED_STORE_PATH')
+# seconds a call waits for another worker's write lock. the calls run on the event loop, so this is kept to a few
+# milliseconds and a busy store is skipped like any other failure
+SHARED_STORE_BUSY_TIMEOUT = float(os.environ.get('SHARED_STORE_BUSY_TIMEOUT', 0.005))
+
+
+class SharedStore:
+    """
+    Small key/value store with expiry shared by the worker processes of one host.
+    Backed by sqlite in WAL mode, so readers never wait for the writer and a crashed worker can't corrupt it.
+    Every failure is logged and treated as a miss, the store is only an optimization.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = SHARED_STORE_BUSY_TIMEOUT):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # workers starting together may wait for each other's setup, only the later calls get the short timeout
+        self.conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                          'value TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (namespace, key))')
+        self.conn.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)}')
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self.busy = 0
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        try:
+            row = self.conn.execute('SELECT value FROM entries WHERE namespace = ? AND key = ? AND expires_at > ?',
+                                    (namespace, key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            return self.failed('get', e)
+        self.reads += 1
+        return json.loads(row[0]) if row else None
+
+    def items(self, namespace: str) -> dict:
+        try:
+            rows = self.conn.execute('SELECT key, value FROM entries WHERE namespace = ? AND expires_at > ?',
+                                     (namespace, time.time())).fetchall()
+        except sqlite3.Error as e:
+            return self.failed('items', e) or {}
+        self.reads += 1
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float):
+        try:
+            self.conn.execute('INSERT OR REPLACE INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                              (namespace, key, json.dumps(value), time.time() + ttl))
+        except sqlite3.Error as e:
+            return self.failed('set', e)
+        self.writes += 1
+
+    def add(self, namespace: str, key: str, value: Any, ttl: float) -> bool:
+        # sets the entry only if there is no live one, returns whether it was set (a cross-process lease)
+        try:
+            now = time.time()
+            self.conn.execute('DELETE FROM entries WHERE namespace = ? AND key = ? AND expires_at <= ?',
+                              (namespace, key, now))
+            cursor = self.conn.execute('INSERT OR IGNORE INTO entries (namespace, key, value, expires_at) '
+                                       'VALUES (?, ?, ?, ?)', (namespace, key, json.dumps(value), now + ttl))
+        except sqlite3.Error as e:
+            self.failed('add', e)
+            # a busy store is tried again by the caller, any other failure doesn't hold it back
+            return not self.is_busy(e)
+        self.writes += 1
+        return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str, value: Any = None):
+        # with a value only an entry still holding it is deleted, e.g. a lease that may have passed to another worker
+        try:
+            if value is None:
+                self.conn.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+            else:
+                self.conn.execute('DELETE FROM entries WHERE namespace = ? AND key = ? AND value = ?',
+                                  (namespace, key, json.dumps(value)))
+        except sqlite3.Error as e:
+            return self.failed('delete', e)
+        self.writes += 1
+
+    def purge(self):
+        try:
+            self.conn.execute('DELETE FROM entries WHERE expires_at <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            return self.failed('purge', e)
+
+    @staticmethod
+    def is_busy(e: Exception) -> bool:
+        return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+
+    def failed(self, operation: str, e: Exception):
+        if self.is_busy(e):
+            # another worker is writing, expected now and then under load
+            self.busy += 1
+            logger.debug(f"shared store {operation} skipped: {e}")
+            return None
+        self.errors += 1
+        logger.warning(f"shared store {operation} failed: {e}")
+        return None
+
+    def close(self):
+        self.conn.close()
+
+    def stats(self) -> dict:
+        return {'path': self.path, 'reads': self.reads, 'writes': self.writes, 'errors': self.errors, 'busy': self.busy}
+
+
+_store: Optional[SharedStore] = None
+
+
+def get_shared_store() -> Optional[SharedStore]:
+    # one connection per process, created in the worker itself
+    global _store
+    if _store is None and SHARED_STORE_PATH:
+        _store = SharedStore(SHARED_STORE_PATH)
+        _store.purge()
+    return _store
+
+
+def close_shared_store():
+    global _store
+    if _store is not None:
+        store, _store = _store, None
+        store.close()
@@ -0,0 +1,118 @@
+import json
+import time
+from typing import Iterable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DATA_PREFIX = b'data:'
+DONE_LINE = b'data: [DONE]'
+DONE_EVENT = "data: [DONE]\n"
+
+# (index, text, finish_reason)
+Choice = Tuple[int, str, Optional[str]]
+
+
+_decoder = json.JSONDecoder()
+
+
+def json_loads_data(line: bytes):
+    # the stdlib decoding of a `data:` line's payload, straight from the decoded line and past the optional space
+    text = line.decode('utf-8')
+    return _decoder.raw_decode(text, 6 if text[5:6] == ' ' else 5)[0]
+
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def loads_data(line: bytes):
+        # decodes the payload of a `data:` line without first copying it out of the line like data_payload does
+        return orjson.loads(memoryview(line)[5:])
+
+    def dumps(value) -> str:
+        return orjson.dumps(value).decode('utf-8')
+else:
+    loads = json.loads
+    loads_data = json_loads_data
+
+    def dumps(value) -> str:
+        # same output as pydantic's model_dump_json: compact and without escaping non-ascii
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+# for one large payload, e.g. the finished frame of a cumulative stream. orjson reserves a parse buffer of several
+# times the input up front, json only holds the decoded line next to the result
+loads_large = json_loads_data
+
+
+def data_payload(line: bytes) -> Optional[bytes]:
+    # the payload of an sse `data:` line, or None for any other line
+    if line.startswith(DATA_PREFIX):
+        return line[5:]
+    return None
+
+
+class CompletionChunkEncoder:
+    """
+    Serializes `text_completion` chunks from a precompiled template, byte-for-byte equal to
+    Completion(...).model_dump_json(exclude_unset=True) with NewCompletionChoice choices (see benchmark/).
+    """
+
+    object = 'text_completion'
+
+    def __init__(self, c_id: str, model: str):
+        self.c_id = c_id
+        self.model = model
+        self.head = 'data: {"id":' + dumps(c_id) + ',"choices":['
+        self.tail = '],"created":%d,"model":' + dumps(model) + ',"object":"' + self.object + '"}\n'
+
+    def encode_choice(self, index: int, text: str, finish_reason: Optional[str]) -> str:
+        finish = 'null' if finish_reason is None else dumps(finish_reason)
+        return '{"finish_reason":' + finish + ',"index":' + str(index) + ',"text":' + dumps(text) + '}'
+
+    def encode(self, choices: Iterable[Choice], created: int = None) -> str:
+        body = ','.join([self.encode_choice(*choice) for choice in choices])
+        return self.head + body + self.tail % (int(time.time()) if created is None else created)
+
+
+class ChatChunkEncoder(CompletionChunkEncoder):
+    """
+    Serializes `chat.completion.chunk` chunks, byte-for-byte equal to
+    ChatCompletionChunk(...).model_dump_json(exclude_unset=True) with assistant deltas.
+    """
+
+    object = 'chat.completion.chunk'
+
+    def encode_choice(self, index: int, text: str, finish_reason: Optional[str]) -> str:
+        choice = '{"delta":{"content":' + dumps(text) + ',"role":"assistant"}'
+        if finish_reason is not None:
+            choice += ',"finish_reason":' + dumps(finish_reason)
+        return choice + ',"index":' + str(index) + '}'
+
+
+def build_completion(c_id: str, model: str, texts: list, finish_reason: Optional[str] = 'stop',
+                     created: int = None) -> dict:
+    # same dict as Completion(...).model_dump(exclude_unset=True) with NewCompletionChoice choices
+    return {
+        'id': c_id,
+        'choices': [{'finish_reason': finish_reason, 'index': i, 'text': text} for i, text in enumerate(texts)],
+        'created': int(time.time()) if created is None else created,
+        'model': model,
+        'object': 'text_completion',
+    }
+
+
+def build_chat_completion(c_id: str, model: str, texts: list, finish_reason: Optional[str] = 'stop',
+                          created: int = None) -> dict:
+    # same dict as ChatCompletion(...).model_dump(exclude_unset=True) with assistant messages
+    return {
+        'id': c_id,
+        'choices': [
+            {'finish_reason': finish_reason, 'index': i, 'message': {'content': text, 'role': 'assistant'}}
+            for i, text in enumerate(texts)
+        ],
+        'created': int(time.time()) if created is None else created,
+        'model': model,
+        'object': 'chat.completion',
+    }
@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass, fields, replace
+from typing import AsyncIterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from src.reverse.metrics import STREAM_EVENTS_SAVED, STREAM_FLUSHES
+from src.reverse.sse_codec import Choice
+from src.reverse.transport import shielded
+
+load_dotenv()
+
+# merge consecutive upstream frames into fewer downstream events, requests can override it with "stream_coalesce"
+STREAM_COALESCE_ENABLE = os.environ.get('STREAM_COALESCE_ENABLE', 'false').upper() == 'TRUE'
+# characters buffered before an event is sent
+STREAM_COALESCE_MIN_CHARS = int(os.environ.get('STREAM_COALESCE_MIN_CHARS', 32))
+# seconds the first buffered character may wait for more
+STREAM_COALESCE_MAX_DELAY = float(os.environ.get('STREAM_COALESCE_MAX_DELAY', 0.05))
+# send as soon as the buffered text ends a sentence or a line
+STREAM_COALESCE_SENTENCE = os.environ.get('STREAM_COALESCE_SENTENCE', 'true').upper() == 'TRUE'
+
+SENTENCE_ENDS = ('.', '!', '?', ';', ':', '\n', '。', '！', '？', '；', '：')
+
+# (completion id, model, choices), see base_reverse.Frame
+Frame = Tuple[str, str, List[Choice]]
+
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    min_chars: int = STREAM_COALESCE_MIN_CHARS
+    max_delay: float = STREAM_COALESCE_MAX_DELAY
+    sentence: bool = STREAM_COALESCE_SENTENCE
+
+
+# policy of the current request's stream, None sends every upstream frame as its own event
+stream_flush_policy: ContextVar[Optional[FlushPolicy]] = ContextVar('stream_flush_policy', default=None)
+
+
+def flush_policy(value=None) -> Optional[FlushPolicy]:
+    # value is the "stream_coalesce" of a request: true, false, or an object overriding fields of the default policy
+    if value is None:
+        return FlushPolicy() if STREAM_COALESCE_ENABLE else None
+    if isinstance(value, bool):
+        return FlushPolicy() if value else None
+    if not isinstance(value, dict):
+        raise ValueError("stream_coalesce must be a boolean or an object")
+    names = {f.name for f in fields(FlushPolicy)}
+    unknown = set(value) - names
+    if unknown:
+        raise ValueError(f"unknown stream_coalesce fields: {', '.join(sorted(unknown))}")
+    policy = replace(FlushPolicy(), **value)
+    if policy.min_chars < 0 or policy.max_delay < 0:
+        raise ValueError("stream_coalesce min_chars and max_delay can't be negative")
+    return policy
+
+
+class FrameBuffer:
+    """
+    Text of consecutive frames of one completion, per choice index.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.key = None
+        self.texts = {}
+        self.finish_reasons = {}
+        self.frames = 0
+        self.chars = 0
+        self.deadline = None
+
+    def add(self, frame: Frame, max_delay: float):
+        c_id, model, choices = frame
+        self.key = (c_id, model)
+        for index, text, finish_reason in choices:
+            self.texts.setdefault(index, []).append(text)
+            self.chars += len(text)
+            if finish_reason:
+                self.finish_reasons[index] = finish_reason
+        self.frames += 1
+        if self.deadline is None:
+            self.deadline = time.monotonic() + max_delay
+
+    def ends_sentence(self) -> bool:
+        return any(parts[-1].endswith(SENTENCE_ENDS) for parts in self.texts.values() if parts[-1])
+
+    def flush(self, reason: str) -> Frame:
+        STREAM_FLUSHES.inc((reason,))
+        STREAM_EVENTS_SAVED.inc((), self.frames - 1)
+        c_id, model = self.key
+        choices = [(index, ''.join(parts), self.finish_reasons.get(index)) for index, parts in self.texts.items()]
+        self.clear()
+        return c_id, model, choices
+
+
+async def merge_frames(frames: AsyncIterator[Frame], policy: FlushPolicy) -> AsyncIterator[Frame]:
+    # the first text is sent right away so the time to first token is unchanged,
+    # after that frames are merged until the policy flushes them. closing this closes frames
+    buffer = FrameBuffer()
+    started = False
+    pending: Optional[asyncio.Future] = None
+
+    async def pull():
+        try:
+            return await frames.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    try:
+        while True:
+            if pending is None and not buffer.frames:
+                frame = await pull()
+            else:
+                # the next frame is awaited in a task, so a deadline passing doesn't cancel the upstream read
+                if pending is None:
+                    pending = asyncio.ensure_future(pull())
+                timeout = max(buffer.deadline - time.monotonic(), 0) if buffer.frames else None
+                done, _ = await asyncio.wait((pending,), timeout=timeout)
+                if not done:
+                    yield buffer.flush('deadline')
+                    continue
+                frame, pending = pending.result(), None
+            if frame is None:
+                break
+            c_id, model, choices = frame
+            if buffer.frames and buffer.key != (c_id, model):
+                yield buffer.flush('completion')
+            if not started:
+                # everything up to the first text, e.g. an empty role frame, passes through
+                started = any(text for _, text, _ in choices)
+                STREAM_FLUSHES.inc(('first',))
+                yield frame
+                continue
+            buffer.add(frame, policy.max_delay)
+            if any(finish_reason for _, _, finish_reason in choices):
+                yield buffer.flush('finish')
+            elif buffer.chars >= policy.min_chars:
+                yield buffer.flush('size')
+            elif policy.sentence and buffer.ends_sentence():
+                yield buffer.flush('sentence')
+        if buffer.frames:
+            yield buffer.flush('end')
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await shielded(asyncio.gather(pending, return_exceptions=True))
+        await shielded(frames.aclose())
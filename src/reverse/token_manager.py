@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# seconds one worker may hold the right to fetch a shared token, and how long the others wait for it
+LEASE_TTL = 10
+LEASE_WAIT = 5
+
+
+class TokenManager:
+    """
+    Keeps a small pool of ready tokens that are renewed in the background before they expire.
+    Concurrent refreshes are collapsed into a single upstream call.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[str]], ttl: float, pool_size: int = 2,
+                 refresh_ahead: float = 10, idle_timeout: float = 600, name: str = 'token',
+                 store=None, store_key: str = None):
+        self.fetch = fetch
+        # optional SharedStore, the workers of a host then share the tokens instead of each fetching its own
+        self.store = store
+        self.store_key = store_key or name
+        self.ttl = ttl
+        self.pool_size = max(pool_size, 1)
+        self.refresh_ahead = min(refresh_ahead, ttl / 2)
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.tokens = deque()
+        self.last_used = time.monotonic()
+        self._inflight: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.refresh_seconds_total = 0.0
+        self.refresh_seconds_max = 0.0
+        self.last_refresh_seconds = 0.0
+
+    @property
+    def refresh_spacing(self):
+        # tokens are renewed at staggered ages so the pool never expires all at once
+        return (self.ttl - self.refresh_ahead) / self.pool_size
+
+    def prune(self, now: float):
+        while self.tokens and now - self.tokens[0][1] >= self.ttl - self.refresh_ahead:
+            self.tokens.popleft()
+
+    async def get_token(self) -> str:
+        now = time.monotonic()
+        self.last_used = now
+        self.start()
+        self.prune(now)
+        if self.tokens:
+            self.hits += 1
+            return self.tokens[-1][0]
+        self.misses += 1
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._do_refresh())
+        return await asyncio.shield(self._inflight)
+
+    async def _do_refresh(self) -> str:
+        start = time.perf_counter()
+        try:
+            token, age = await self.fetch_token()
+            if not self.tokens or self.tokens[-1][0] != token:
+                self.tokens.append((token, time.monotonic() - age))
+            while len(self.tokens) > self.pool_size:
+                self.tokens.popleft()
+            return token
+        except Exception:
+            self.refresh_errors += 1
+            raise
+        finally:
+            cost = time.perf_counter() - start
+            self.refreshes += 1
+            self.refresh_seconds_total += cost
+            self.refresh_seconds_max = max(self.refresh_seconds_max, cost)
+            self.last_refresh_seconds = cost
+            self._inflight = None
+
+    async def fetch_token(self) -> Tuple[str, float]:
+        # returns the token and its age
+        if self.store is None:
+            return await self.fetch(), 0.0
+        deadline = time.monotonic() + LEASE_WAIT
+        leased = False
+        while True:
+            shared = self.shared_token()
+            if shared is not None:
+                return shared
+            leased = self.store.add('token_lease', self.store_key, os.getpid(), LEASE_TTL)
+            if leased or time.monotonic() > deadline:
+                break
+            # another worker is fetching it
+            await asyncio.sleep(0.1)
+        if not leased:
+            # the other worker's fetch may have landed while the lease was tried a last time
+            shared = self.shared_token()
+            if shared is not None:
+                return shared
+            logger.warning(f"{self.name}: no shared token after waiting {LEASE_WAIT}s for another worker, "
+                           f"fetching one without the lease")
+        try:
+            token = await self.fetch()
+            self.store.set('token', self.store_key, {'token': token, 'issued_at': time.time()}, self.ttl)
+        finally:
+            # a lease held by another worker is left alone, it keeps the others waiting for that fetch
+            if leased:
+                self.store.delete('token_lease', self.store_key, os.getpid())
+        return token, 0.0
+
+    def shared_token(self) -> Optional[Tuple[str, float]]:
+        entry = self.store.get('token', self.store_key)
+        if not entry:
+            return None
+        age = max(time.time() - entry['issued_at'], 0.0)
+        # as fresh as the token this process would fetch on its own schedule
+        if age >= self.refresh_spacing:
+            return None
+        self.shared_hits += 1
+        return entry['token'], age
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        elif not self._wakeup.is_set():
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now - self.last_used > self.idle_timeout:
+                # nobody is asking for tokens, stop renewing until the next get_token
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            self.prune(now)
+            newest_age = now - self.tokens[-1][1] if self.tokens else float('inf')
+            delay = self.refresh_spacing - newest_age
+            if delay <= 0:
+                try:
+                    await self.refresh()
+                    delay = self.refresh_spacing
+                except Exception as e:
+                    logger.warning(f"background refresh {self.name} failed: {e}")
+                    delay = min(self.refresh_spacing, 5)
+            await asyncio.sleep(max(delay, 0.5))
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'pool_size': len(self.tokens),
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared_hits': self.shared_hits,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'refresh_seconds_avg': self.refresh_seconds_total / self.refreshes if self.refreshes else 0.0,
+            'refresh_seconds_max': self.refresh_seconds_max,
+            'last_refresh_seconds': self.last_refresh_seconds,
+        }
@@ -0,0 +1,112 @@
+import os
+import asyncio
+from typing import AsyncIterator, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 120))
+HTTP_POOL_TIMEOUT = float(os.environ.get('HTTP_POOL_TIMEOUT', 30))
+
+
+class AsyncTransport:
+    """
+    Shared upstream transport. One long-lived httpx client is kept per egress proxy,
+    so connections to chat.openai.com / claude.ai are pooled and kept alive across requests.
+    """
+
+    def __init__(self, limits: httpx.Limits = None, timeout: httpx.Timeout = None):
+        self.limits = limits or httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+        self.timeout = timeout or httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_CONNECT_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT
+        )
+        self._clients = {}
+
+    def get_client(self, proxies: dict = None) -> httpx.AsyncClient:
+        proxy = proxies.get('https') if proxies else None
+        client = self._clients.get(proxy)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(proxy=proxy, limits=self.limits, timeout=self.timeout)
+            self._clients[proxy] = client
+        return client
+
+    async def request(self, method: str, url: str, proxies: dict = None, **kwargs) -> httpx.Response:
+        response = await self.get_client(proxies).request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def stream(self, method: str, url: str, proxies: dict = None, **kwargs) -> httpx.Response:
+        client = self.get_client(proxies)
+        request = client.build_request(method, url, **kwargs)
+        response = await client.send(request, stream=True)
+        if response.is_error:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            response.raise_for_status()
+        return response
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+async def iter_lines(response: httpx.Response) -> AsyncIterator[bytes]:
+    # yield raw lines as bytes (without line endings) and release the connection when done
+    pending = b''
+    try:
+        async for data in response.aiter_bytes():
+            if pending:
+                data = pending + data
+            lines = data.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line[:-1] if line.endswith(b'\r') else line
+        if pending:
+            yield pending
+    finally:
+        await shielded(response.aclose())
+
+
+_cleanups = set()
+
+
+async def shielded(coro):
+    # cleanup that has to complete even when the calling task is being cancelled, e.g. after a client disconnect
+    task = asyncio.ensure_future(coro)
+    _cleanups.add(task)
+    task.add_done_callback(_cleanups.discard)
+    await asyncio.shield(task)
+
+
+_transport: Optional[AsyncTransport] = None
+
+
+def get_transport() -> AsyncTransport:
+    global _transport
+    if _transport is None:
+        _transport = AsyncTransport()
+    return _transport
+
+
+async def close_transport():
+    global _transport
+    if _transport is not None:
+        transport, _transport = _transport, None
+        await transport.aclose()
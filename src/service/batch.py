@@ -0,0 +1,148 @@
+import os
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, List
+
+from dotenv import load_dotenv
+from starlette.responses import StreamingResponse
+
+from src.reverse.base_reverse import CompletionResult, Frame, Upstream, encode_stream
+from src.reverse.stream_merge import stream_flush_policy
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# upstream conversations run at the same time for one batch request
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+# max choices (prompts x n) of one request
+BATCH_MAX_CHOICES = int(os.environ.get('BATCH_MAX_CHOICES', 64))
+
+
+def choice_count(value) -> int:
+    # the `n` of a request, answers wanted per prompt
+    if value is None:
+        return 1
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"n must be an integer of at least 1, got {value!r}")
+    return value
+
+
+class BatchRunner:
+    """
+    Runs every prompt (and every one of its n copies) of a request as its own upstream conversation,
+    with a bounded concurrency, and returns one choice per item in order.
+    """
+
+    def __init__(self, concurrency: int = BATCH_CONCURRENCY, max_choices: int = BATCH_MAX_CHOICES):
+        self.concurrency = max(concurrency, 1)
+        self.max_choices = max_choices
+        self.batches = 0
+        self.items = 0
+
+    def check(self, batch: list):
+        if not batch:
+            raise ValueError("prompt is empty")
+        if len(batch) > self.max_choices:
+            raise ValueError(f"too many choices in one request: {len(batch)} > {self.max_choices}")
+
+    async def run(self, upstream: Upstream, batch: List[list], is_stream: bool = False, is_chat: bool = False,
+                  on_result: Callable = None):
+        self.check(batch)
+        self.batches += 1
+        self.items += len(batch)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if is_stream:
+            return await self.run_stream(upstream, batch, semaphore, is_chat, on_result)
+
+        async def run_item(messages):
+            async with semaphore:
+                return await upstream.run_result(messages)
+
+        tasks = [asyncio.ensure_future(run_item(messages)) for messages in batch]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            await cancel(tasks)
+            raise
+        if any(result is None for result in results):
+            return None
+        result = merge_results(results)
+        if on_result is not None:
+            on_result(result)
+        body = result.to_dict(is_chat)
+        for choice, item in zip(body['choices'], results):
+            choice['finish_reason'] = item.finish_reason
+        return body
+
+    async def run_stream(self, upstream: Upstream, batch: List[list], semaphore: asyncio.Semaphore,
+                         is_chat: bool = False, on_result: Callable = None):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        opened = [loop.create_future() for _ in batch]
+
+        async def run_item(index, messages):
+            async with semaphore:
+                try:
+                    reverse, ctx, chunks = await upstream.start(messages)
+                except BaseException as e:
+                    opened[index].set_exception(e)
+                    # raised by the task as well, only the first wave's future is awaited
+                    opened[index].exception()
+                    raise
+                opened[index].set_result(None)
+                frames = reverse.iter_frames(ctx, chunks)
+                try:
+                    async for frame in frames:
+                        queue.put_nowait((index, frame))
+                finally:
+                    await frames.aclose()
+
+        tasks = []
+        for index, messages in enumerate(batch):
+            task = asyncio.ensure_future(run_item(index, messages))
+            task.add_done_callback(lambda _, i=index: queue.put_nowait((i, None)))
+            tasks.append(task)
+        try:
+            # the first wave is opened before answering, so upstream errors are still returned as a status
+            await asyncio.gather(*opened[:self.concurrency])
+        except BaseException:
+            await cancel(tasks)
+            raise
+        frames = self.interleave(tasks, queue)
+        return StreamingResponse(encode_stream(frames, is_chat, on_result, stream_flush_policy.get()),
+                                 media_type="text/event-stream")
+
+    async def interleave(self, tasks: list, queue: asyncio.Queue) -> AsyncIterator[Frame]:
+        # chunks of every item are sent as they come, tagged with the item's index, under one completion id
+        c_id = None
+        remaining = len(tasks)
+        try:
+            while remaining:
+                index, frame = await queue.get()
+                if frame is None:
+                    remaining -= 1
+                    task = tasks[index]
+                    if not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+                    continue
+                item_id, model, choices = frame
+                c_id = c_id or item_id
+                yield c_id, model, [(index, text, finish_reason) for _, text, finish_reason in choices]
+        finally:
+            await cancel(tasks)
+
+
+def merge_results(results: List[CompletionResult]) -> CompletionResult:
+    finish_reason = 'stop'
+    for result in results:
+        if result.finish_reason != 'stop':
+            finish_reason = result.finish_reason
+    texts = [result.texts[0] if result.texts else '' for result in results]
+    return CompletionResult(results[0].id, results[0].model, texts, finish_reason)
+
+
+async def cancel(tasks: list):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
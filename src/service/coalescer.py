@@ -0,0 +1,188 @@
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Optional
+
+from dotenv import load_dotenv
+from starlette.responses import StreamingResponse
+
+from src.reverse.base_reverse import CompletionResult, Frame, ResultBuilder, Upstream, encode_stream
+from src.reverse.stream_merge import stream_flush_policy
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+COALESCE_ENABLE = os.environ.get('COALESCE_ENABLE', 'false').upper() == 'TRUE'
+# seconds after its start during which an upstream call can still be joined
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', 30))
+COALESCE_MAX_FANOUT = int(os.environ.get('COALESCE_MAX_FANOUT', 32))
+
+
+class Flight:
+    """
+    One upstream call shared by every identical request that joins it.
+    Frames are kept so a late joiner first gets the already emitted prefix.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.started = time.monotonic()
+        self.frames = []
+        self.subscribers = 0
+        self.opened = asyncio.get_running_loop().create_future()
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.result: Optional[CompletionResult] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def is_joinable(self, window: float, max_fanout: int) -> bool:
+        return (not self.done and self.subscribers < max_fanout
+                and time.monotonic() - self.started < window)
+
+    def append(self, frame: Frame):
+        self.frames.append(frame)
+        self.notify()
+
+    def finish(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        if not self.opened.done():
+            if isinstance(error, asyncio.CancelledError):
+                self.opened.cancel()
+            elif error is not None:
+                self.opened.set_exception(error)
+            else:
+                self.opened.set_result(None)
+        self.notify()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class RequestCoalescer:
+    """
+    Single-flight for identical in-flight requests: the first one calls the upstream,
+    the others subscribe to its frames, whatever their stream mode.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_fanout: int = COALESCE_MAX_FANOUT):
+        self.window = window
+        self.max_fanout = max(max_fanout, 1)
+        self.flights = {}
+
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.fanout_limited = 0
+        self.cancelled = 0
+
+    async def run(self, key: str, upstream: Upstream, messages: list, is_stream: bool = False,
+                  is_chat: bool = False, on_result: Callable = None):
+        flight = self.flights.get(key)
+        if flight is not None and flight.is_joinable(self.window, self.max_fanout):
+            self.coalesced += 1
+        else:
+            if flight is not None and not flight.done and flight.subscribers >= self.max_fanout:
+                self.fanout_limited += 1
+            flight = self.start(key, upstream, messages, on_result)
+
+        flight.subscribers += 1
+        try:
+            # upstream errors before the first byte are raised to every caller as usual
+            await asyncio.shield(flight.opened)
+        except BaseException:
+            self.leave(flight)
+            raise
+        if is_stream:
+            frames = self.subscribe(flight)
+            return StreamingResponse(encode_stream(frames, is_chat, policy=stream_flush_policy.get()),
+                                     media_type="text/event-stream")
+        try:
+            await asyncio.shield(flight.task)
+        finally:
+            self.leave(flight)
+        if flight.error is not None:
+            raise flight.error
+        if flight.result is None:
+            return None
+        return flight.result.to_dict(is_chat)
+
+    def start(self, key: str, upstream: Upstream, messages: list, on_result: Callable = None) -> Flight:
+        self.upstream_calls += 1
+        flight = Flight(key)
+        self.flights[key] = flight
+        flight.task = asyncio.ensure_future(self.fly(flight, upstream, messages, on_result))
+        flight.task.add_done_callback(lambda _: self.land(flight))
+        return flight
+
+    async def fly(self, flight: Flight, upstream: Upstream, messages: list, on_result: Callable = None):
+        builder = ResultBuilder()
+        try:
+            reverse, ctx, chunks = await upstream.start(messages)
+            flight.opened.set_result(None)
+            frames = reverse.iter_frames(ctx, chunks)
+            try:
+                async for frame in frames:
+                    builder.add(frame)
+                    flight.append(frame)
+            finally:
+                await frames.aclose()
+        except BaseException as e:
+            flight.finish(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        flight.result = builder.result()
+        flight.finish()
+        if on_result is not None and flight.result is not None:
+            on_result(flight.result)
+
+    def land(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+        # retrieved here so an error nobody waited for isn't reported as never retrieved
+        if not flight.opened.cancelled():
+            flight.opened.exception()
+
+    def leave(self, flight: Flight):
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.done:
+            # every client went away, stop the upstream call
+            self.cancelled += 1
+            flight.task.cancel()
+
+    async def subscribe(self, flight: Flight) -> AsyncIterator[Frame]:
+        index = 0
+        try:
+            while True:
+                while index < len(flight.frames):
+                    yield flight.frames[index]
+                    index += 1
+                if flight.done:
+                    break
+                await flight.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            self.leave(flight)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self.flights),
+            'upstream_calls': self.upstream_calls,
+            'coalesced': self.coalesced,
+            'fanout_limited': self.fanout_limited,
+            'cancelled': self.cancelled,
+        }
+
+
+def create_coalescer() -> Optional[RequestCoalescer]:
+    if not COALESCE_ENABLE:
+        return None
+    return RequestCoalescer()
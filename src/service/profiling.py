@@ -0,0 +1,120 @@
+import os
+import random
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+from starlette.datastructures import Headers
+
+from src.reverse.profiler import RequestProfile, request_profile, start_sampling, stop_sampling
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# share of api requests run with the stack sampler, e.g. 0.01
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# a request sending this header (any value but 0) is sampled, only honoured for admin keys
+PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Profile')
+# requests slower than this many seconds keep their timeline, 0 keeps none
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 0))
+# timelines kept for /admin/profiles, the oldest is dropped first
+PROFILE_RING_SIZE = int(os.environ.get('PROFILE_RING_SIZE', 100))
+# comma separated api keys allowed to profile and to read /admin, empty denies every caller
+ADMIN_API_KEYS = set(filter(None, os.environ.get('ADMIN_API_KEYS', '').split(',')))
+
+ID_HEADER = 'X-Profile-Id'
+
+
+def is_admin(headers) -> bool:
+    if not ADMIN_API_KEYS:
+        return False
+    api_key = headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    return api_key in ADMIN_API_KEYS
+
+
+class RequestProfiler:
+    """
+    Decides which api requests are profiled and keeps the last PROFILE_RING_SIZE timelines.
+    """
+
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE, slow_seconds: float = PROFILE_SLOW_SECONDS,
+                 ring_size: int = PROFILE_RING_SIZE):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.ring_size = max(ring_size, 1)
+        # id -> profile, oldest first
+        self.profiles = OrderedDict()
+        self.sampled = 0
+        self.slow = 0
+
+    def begin(self, path: str, headers) -> Optional[RequestProfile]:
+        reason = None
+        flag = headers.get(PROFILE_HEADER)
+        if flag and flag != '0' and is_admin(headers):
+            reason = 'header'
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            reason = 'sampled'
+        if reason is None and self.slow_seconds <= 0:
+            return None
+        profile = RequestProfile(path, reason, sampled=reason is not None)
+        profile.join()
+        if profile.sampled:
+            start_sampling(profile)
+        return profile
+
+    def finish(self, profile: RequestProfile):
+        if profile.sampled:
+            stop_sampling(profile)
+        profile.duration = profile.elapsed()
+        profile.tasks.clear()
+        if profile.reason is None:
+            if profile.duration < self.slow_seconds:
+                return
+            profile.reason = 'slow'
+            self.slow += 1
+            logger.info(f"slow request {profile.path} took {profile.duration:.2f}s, profile {profile.id}")
+        else:
+            self.sampled += 1
+        self.profiles[profile.id] = profile
+        while len(self.profiles) > self.ring_size:
+            self.profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        return self.profiles.get(profile_id)
+
+    def stats(self) -> dict:
+        return {'kept': len(self.profiles), 'sampled': self.sampled, 'slow': self.slow}
+
+
+class ProfilingMiddleware:
+    """
+    Runs an api request under its profile, which lasts until the last byte of a streamed answer is sent.
+    """
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/v1/'):
+            return await self.app(scope, receive, send)
+        profile = self.profiler.begin(scope['path'], Headers(scope=scope))
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        async def send_profiled(message):
+            if message['type'] == 'http.response.start':
+                profile.status = message['status']
+                if profile.reason is not None:
+                    message['headers'] = list(message.get('headers', [])) + [
+                        (ID_HEADER.lower().encode('latin-1'), profile.id.encode('latin-1'))]
+            await send(message)
+
+        token = request_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            request_profile.reset(token)
+            self.profiler.finish(profile)
@@ -0,0 +1,301 @@
+import os
+import time
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Optional
+
+from dotenv import load_dotenv
+from starlette.datastructures import Headers
+
+from src.reverse.base_reverse import CompletionResult
+from src.reverse.sse_codec import dumps
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+RESPONSE_CACHE_ENABLE = os.environ.get('RESPONSE_CACHE_ENABLE', 'false').upper() == 'TRUE'
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH') or '.cache/responses'
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# seconds between two scans of the disk cache, which catch up with the entries other workers wrote or evicted
+RESPONSE_CACHE_SCAN_INTERVAL = float(os.environ.get('RESPONSE_CACHE_SCAN_INTERVAL', 60))
+# a full disk cache is evicted down to this share of its limits, so the writes after it don't scan it again
+EVICT_TARGET = 0.9
+
+BYPASS_HEADER = 'X-Cache-Bypass'
+STATUS_HEADER = 'X-Cache'
+
+# request parameters that change the answer, everything else (stream, user, ...) is ignored by the key
+KEY_PARAMS = ('temperature', 'top_p', 'n', 'max_tokens', 'stop', 'presence_penalty', 'frequency_penalty',
+              'logit_bias', 'seed', 'response_format', 'suffix', 'echo', 'best_of', 'logprobs', 'top_logprobs')
+
+
+def cache_key(model: str, batch: list, request_body: dict) -> str:
+    # batch holds the messages of every conversation of the request, already normalized to the upstream
+    # format, so a prompt and the same single user chat message share an entry
+    params = {name: request_body[name] for name in KEY_PARAMS if request_body.get(name) is not None}
+    normalized = {
+        'model': model,
+        'batch': [[(m['author']['role'], m['content']['parts']) for m in messages] for messages in batch],
+        'params': params,
+    }
+    data = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class MemoryCacheBackend:
+    """
+    In-process LRU bounded by entry count and by the serialized size of the entries.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (expires_at, value, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: dict):
+        size = len(dumps(value))
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (time.time() + self.ttl, value, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'bytes': self.size, 'evictions': self.evictions}
+
+
+class DiskCacheBackend:
+    """
+    One json file per entry, the file mtime is the last use so eviction is LRU across restarts and workers.
+    Entries and bytes are counted as they are written, the directory is only scanned when a limit is crossed
+    or every scan_interval.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, max_bytes: int,
+                 scan_interval: float = RESPONSE_CACHE_SCAN_INTERVAL):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.scan_interval = scan_interval
+        self.evictions = 0
+        self.scans = 0
+        os.makedirs(path, exist_ok=True)
+        # the writes run in threads, one of them scans while the others only count
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self.count = 0
+        self.size = 0
+        self.scanned_at = 0.0
+        self.evict()
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    async def get(self, key: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: dict):
+        await asyncio.to_thread(self._set, key, value)
+
+    def _get(self, key: str) -> Optional[dict]:
+        file = self.file(key)
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['expires_at'] <= time.time():
+                size = os.stat(file).st_size
+                os.remove(file)
+                self.counted(-1, -size)
+                return None
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"read response cache {file} failed: {e}")
+            return None
+        return entry['value']
+
+    def _set(self, key: str, value: dict):
+        file = self.file(key)
+        tmp_file = f"{file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': time.time() + self.ttl, 'value': value}, f, ensure_ascii=False)
+            size = os.stat(tmp_file).st_size
+            try:
+                replaced = os.stat(file).st_size
+            except FileNotFoundError:
+                replaced = None
+            os.replace(tmp_file, file)
+        except OSError as e:
+            logger.warning(f"write response cache {file} failed: {e}")
+            return
+        if replaced is None:
+            self.counted(1, size)
+        else:
+            self.counted(0, size - replaced)
+        if (self.count > self.max_entries or self.size > self.max_bytes
+                or time.monotonic() - self.scanned_at > self.scan_interval):
+            self.evict()
+
+    def counted(self, count: int, size: int):
+        with self._lock:
+            self.count += count
+            self.size += size
+
+    def list(self) -> list:
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        # another thread already scanning brings the counts up to date for this write too
+        if not self._scan_lock.acquire(blocking=False):
+            return
+        try:
+            # writes finishing during the scan may be missed by it, they are counted on top. counting one twice
+            # only brings the next scan forward
+            with self._lock:
+                counted = (self.count, self.size)
+            entries = sorted(self.list())
+            size = sum(entry[1] for entry in entries)
+            count = len(entries)
+            max_entries, max_bytes = self.max_entries, self.max_bytes
+            if count > max_entries or size > max_bytes:
+                max_entries, max_bytes = int(max_entries * EVICT_TARGET), int(max_bytes * EVICT_TARGET)
+            for _, file_size, file in entries:
+                if count <= max_entries and size <= max_bytes:
+                    break
+                try:
+                    os.remove(file)
+                    self.evictions += 1
+                except FileNotFoundError:
+                    # another worker evicted it first
+                    pass
+                count -= 1
+                size -= file_size
+            with self._lock:
+                self.count = count + self.count - counted[0]
+                self.size = size + self.size - counted[1]
+            self.scans += 1
+            self.scanned_at = time.monotonic()
+        except OSError as e:
+            logger.warning(f"scan response cache {self.path} failed: {e}")
+        finally:
+            self._scan_lock.release()
+
+    def stats(self) -> dict:
+        # the counts of the last scan plus this worker's writes since, the directory isn't read here
+        return {'entries': self.count, 'bytes': self.size, 'evictions': self.evictions, 'scans': self.scans}
+
+
+class ResponseCache:
+    """
+    Exact-match cache of complete answers, replayed as a json body or as an sse stream.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self._tasks = set()
+
+    def is_bypass(self, headers: Headers) -> bool:
+        if headers.get(BYPASS_HEADER, '').lower() in ('1', 'true'):
+            return True
+        cache_control = headers.get('Cache-Control', '').lower()
+        return 'no-cache' in cache_control or 'no-store' in cache_control
+
+    async def get(self, key: str) -> Optional[CompletionResult]:
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"response cache get failed: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CompletionResult(**value)
+
+    async def put(self, key: str, result: CompletionResult):
+        # truncated or interrupted answers are not worth replaying
+        if result.finish_reason != 'stop' or not result.id:
+            return
+        try:
+            await self.backend.set(key, asdict(result))
+            self.stores += 1
+        except Exception as e:
+            logger.warning(f"response cache set failed: {e}")
+
+    def store(self, key: str, result: CompletionResult):
+        # used as the on_result callback, which can't wait for a disk write
+        task = asyncio.ensure_future(self.put(key, result))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypasses': self.bypasses,
+            'stores': self.stores,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    if not RESPONSE_CACHE_ENABLE:
+        return None
+    if RESPONSE_CACHE_BACKEND == 'disk':
+        backend = DiskCacheBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES,
+                                   RESPONSE_CACHE_MAX_BYTES)
+    elif RESPONSE_CACHE_BACKEND == 'memory':
+        backend = MemoryCacheBackend(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+    else:
+        raise Exception(f"Unsupported response cache backend: {RESPONSE_CACHE_BACKEND}")
+    return ResponseCache(backend)
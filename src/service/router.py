@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import asyncio
+import fnmatch
+import logging
+from collections import deque
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from src.reverse.admission import Overloaded
+from src.reverse.base_reverse import BaseReverse, CompletionResult, RequestContext
+from src.reverse.credential_pool import route_accounts
+from src.reverse.metrics import ROUTE_DECISIONS
+from src.reverse.transport import shielded
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# json, or the path of a json file, mapping a model (fnmatch patterns allowed, first match wins) to its route:
+# {"gpt-4*": {"targets": ["chatgpt", {"backend": "claude", "accounts": ["claude-0"]}], "ttft_slo": 5},
+#  "claude*": ["claude", "chatgpt"], "*": ["chatgpt"]}
+MODEL_ROUTES = os.environ.get('MODEL_ROUTES', '')
+# seconds to the first upstream byte before a route moves on to its next backend, 0 never does
+ROUTE_TTFT_SLO = float(os.environ.get('ROUTE_TTFT_SLO', 0))
+# share of failed or too slow requests over the window that opens a backend's breaker for the cooldown
+ROUTE_ERROR_BUDGET = float(os.environ.get('ROUTE_ERROR_BUDGET', 0.5))
+ROUTE_BREAKER_WINDOW = int(os.environ.get('ROUTE_BREAKER_WINDOW', 20))
+ROUTE_BREAKER_COOLDOWN = float(os.environ.get('ROUTE_BREAKER_COOLDOWN', 30))
+
+# the behaviour before routes were configurable
+DEFAULT_ROUTES = {'claude*': ['claude'], '*': ['chatgpt']}
+
+# requests seen before the error rate of a breaker is trusted
+MIN_RESULTS = 5
+
+BACKEND_HEADER = 'X-Route-Backend'
+REASON_HEADER = 'X-Route-Reason'
+
+# (route, target, reason) of every decision made for the current request, set by the api layer
+route_trace: ContextVar[Optional[list]] = ContextVar('route_trace', default=None)
+
+
+class CircuitBreaker:
+    """
+    Opens when the failures of the last requests exceed the error budget.
+    After the cooldown a single probe request is let through, its outcome closes or reopens it.
+    """
+
+    def __init__(self, error_budget: float = ROUTE_ERROR_BUDGET, window: int = ROUTE_BREAKER_WINDOW,
+                 cooldown: float = ROUTE_BREAKER_COOLDOWN):
+        self.error_budget = error_budget
+        self.cooldown = cooldown
+        self.results = deque(maxlen=window)
+        self.open_until = 0.0
+        self.probing = False
+        self.opens = 0
+
+    @property
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(self.results) / len(self.results)
+
+    @property
+    def state(self) -> str:
+        if not self.open_until:
+            return 'closed'
+        if time.monotonic() < self.open_until or self.probing:
+            return 'open'
+        return 'half_open'
+
+    def available(self) -> bool:
+        return self.state != 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'half_open':
+            self.probing = True
+        return state != 'open'
+
+    def record(self, ok: Optional[bool]):
+        # ok is None when the request ended without a verdict, e.g. the client went away
+        if self.open_until:
+            if ok is None:
+                self.probing = False
+            elif ok:
+                self.open_until = 0.0
+                self.probing = False
+                self.results.clear()
+            else:
+                self.trip()
+            return
+        if ok is None:
+            return
+        self.results.append(0 if ok else 1)
+        if len(self.results) >= MIN_RESULTS and self.error_rate > self.error_budget:
+            self.trip()
+
+    def trip(self):
+        self.open_until = time.monotonic() + self.cooldown
+        self.probing = False
+        self.opens += 1
+        self.results.clear()
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'error_rate': self.error_rate,
+            'opens': self.opens,
+            'open_seconds': max(self.open_until - time.monotonic(), 0.0),
+        }
+
+
+async def prepend(first: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    try:
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+class RouteTarget:
+
+    def __init__(self, backend: str, accounts: Optional[List[str]], breaker: CircuitBreaker,
+                 get_backend: Callable[[str], BaseReverse]):
+        self.backend = backend
+        self.accounts = frozenset(accounts) if accounts else None
+        self.name = backend if not accounts else f"{backend}:{'+'.join(accounts)}"
+        self.breaker = breaker
+        self.get_backend = get_backend
+
+    async def open(self, messages: list, wait_first: bool) -> Tuple[BaseReverse, RequestContext, AsyncIterator]:
+        reverse = self.get_backend(self.backend)
+        # also applies to a hedge started by open
+        token = route_accounts.set(self.accounts)
+        try:
+            _, ctx, chunks = await reverse.start(messages)
+        finally:
+            route_accounts.reset(token)
+        if not wait_first:
+            return reverse, ctx, chunks
+        # the response headers can come long before anything else, the slo is about the first line
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            return reverse, ctx, chunks
+        except BaseException as e:
+            if isinstance(e, Exception):
+                reverse.record_error(ctx, e)
+            await shielded(reverse.close_stream(ctx, chunks))
+            raise e
+        return reverse, ctx, prepend(first, chunks)
+
+
+class Route:
+    """
+    An ordered list of backends for a model. A backend whose breaker is open is skipped, one that fails
+    or misses the first byte slo before the answer starts is given up for the next.
+    """
+
+    def __init__(self, name: str, targets: List[RouteTarget], ttft_slo: float = ROUTE_TTFT_SLO):
+        self.name = name
+        self.targets = targets
+        self.ttft_slo = ttft_slo
+
+    async def start(self, messages: list) -> Tuple[BaseReverse, RequestContext, AsyncIterator[bytes]]:
+        reason = 'primary'
+        error = None
+        for index, target in enumerate(self.targets):
+            if not target.breaker.allow():
+                reason = 'breaker_open' if reason == 'primary' else reason
+                continue
+            # the last usable backend is waited for however long it takes
+            has_next = any(t.breaker.available() for t in self.targets[index + 1:])
+            timeout = self.ttft_slo if self.ttft_slo > 0 and has_next else None
+            try:
+                opened = await self.open(target, messages, timeout)
+            except (asyncio.TimeoutError, httpx.HTTPError, Overloaded) as e:
+                logger.warning(f"route {self.name}: {target.name} failed, {type(e).__name__}: {e}")
+                error = e
+                reason = 'ttft_slo' if isinstance(e, asyncio.TimeoutError) else 'error'
+                continue
+            self.decide(target, reason)
+            return opened
+        if error is not None:
+            raise error
+        # every breaker is open, the primary is still better than no answer
+        target = self.targets[0]
+        opened = await self.open(target, messages, None)
+        self.decide(target, 'all_open')
+        return opened
+
+    async def open(self, target: RouteTarget, messages: list, timeout: Optional[float]):
+        start = time.perf_counter()
+        try:
+            opened = await asyncio.wait_for(target.open(messages, self.ttft_slo > 0), timeout)
+        except Overloaded:
+            # local admission limits say nothing about the upstream
+            target.breaker.record(None)
+            raise
+        except (asyncio.TimeoutError, httpx.HTTPError):
+            target.breaker.record(False)
+            raise
+        except BaseException:
+            target.breaker.record(None)
+            raise
+        slow = self.ttft_slo > 0 and time.perf_counter() - start > self.ttft_slo
+        target.breaker.record(not slow)
+        return opened
+
+    def decide(self, target: RouteTarget, reason: str):
+        ROUTE_DECISIONS.inc((self.name, target.name, reason))
+        trace = route_trace.get()
+        if trace is not None:
+            trace.append((self.name, target.name, reason))
+
+    async def run_result(self, messages: list) -> Optional[CompletionResult]:
+        reverse, ctx, chunks = await self.start(messages)
+        return await reverse.collect_result(ctx, chunks)
+
+    async def do_run(self, messages: list, is_stream: bool = False, is_chat: bool = False,
+                     on_result: Callable = None):
+        reverse, ctx, chunks = await self.start(messages)
+        return await reverse.to_openai_response(ctx, chunks, is_stream, is_chat, on_result)
+
+    def stats(self) -> dict:
+        return {
+            'ttft_slo': self.ttft_slo,
+            'targets': {target.name: target.breaker.stats() for target in self.targets},
+        }
+
+
+class ModelRouter:
+    """
+    Maps the model of a request to its Route, see MODEL_ROUTES.
+    """
+
+    def __init__(self, table: dict, get_backend: Callable[[str], BaseReverse]):
+        self.routes = {}
+        for pattern, spec in table.items():
+            self.routes[pattern] = self.build(pattern, spec, get_backend)
+
+    @staticmethod
+    def build(pattern: str, spec, get_backend: Callable[[str], BaseReverse]) -> Route:
+        if isinstance(spec, list):
+            spec = {'targets': spec}
+        targets = []
+        for target in spec['targets']:
+            if isinstance(target, str):
+                target = {'backend': target}
+            breaker = CircuitBreaker(spec.get('error_budget', ROUTE_ERROR_BUDGET), ROUTE_BREAKER_WINDOW,
+                                     spec.get('cooldown', ROUTE_BREAKER_COOLDOWN))
+            targets.append(RouteTarget(target['backend'], target.get('accounts'), breaker, get_backend))
+        if not targets:
+            raise ValueError(f"route {pattern} has no targets")
+        return Route(pattern, targets, float(spec.get('ttft_slo', ROUTE_TTFT_SLO)))
+
+    def route(self, model: Optional[str]) -> Route:
+        model = model or ''
+        route = self.routes.get(model)
+        if route is not None:
+            return route
+        for pattern, route in self.routes.items():
+            if fnmatch.fnmatchcase(model, pattern):
+                return route
+        raise ValueError(f"no route for model {model}")
+
+    def stats(self) -> dict:
+        return {pattern: route.stats() for pattern, route in self.routes.items()}
+
+
+def load_routes(value: str = MODEL_ROUTES) -> dict:
+    value = value.strip()
+    if not value:
+        return DEFAULT_ROUTES
+    if not value.startswith('{'):
+        with open(value, encoding='utf-8') as f:
+            value = f.read()
+    return json.loads(value)
+
+
+def route_headers(trace: Optional[list]) -> dict:
+    if not trace:
+        return {}
+    backends = dict.fromkeys(target for _, target, _ in trace)
+    reasons = dict.fromkeys(reason for _, _, reason in trace)
+    return {BACKEND_HEADER: ','.join(backends), REASON_HEADER: ','.join(reasons)}